@@ -120,10 +120,20 @@ flags.DEFINE_boolean("minibatch_d", False,            #
                    "Adding kernel features for minibatch diversity.")
 flags.DEFINE_boolean("unidirectional_d", False,        #
                    "Unidirectional RNN instead of bidirectional RNN for D.")
+flags.DEFINE_string("rnn_cell", 'basic',              # 'block', 'block_fused'
+                   "LSTM implementation: 'basic' (BasicLSTMCell), 'block' (LSTMBlockCell) or 'block_fused' (LSTMBlockFusedCell in D, LSTMBlockCell in G, which generates one step at a time).")
+flags.DEFINE_boolean("single_pass_d", True,           #
+                   "Run D once over real, wrong condition and generated data stacked along the batch axis, instead of once for each. Ignored with --minibatch_d.")
+flags.DEFINE_boolean("debug_prints", False,           #
+                   "Add tf.Print nodes that print intermediate values of D, minibatch features and regularization losses.")
 flags.DEFINE_boolean("profiling", False,              #
                    "Profiling. Writing a timeline.json file in plots dir.")
 flags.DEFINE_boolean("float16", False,                #
-                   "Use floa16 data type. Otherwise, use float32.")
+                   "Mixed precision: compute G and D in float16, keeping float32 master weights and losses. Otherwise, use float32.")
+flags.DEFINE_float("loss_scale", 128.0,               #
+                   "With --float16, the initial loss scale: losses are multiplied by it before computing gradients, so that small gradients do not underflow in float16. A step whose gradients overflow to inf/nan is skipped and halves the scale.")
+flags.DEFINE_integer("loss_scale_window", 1000,       #
+                   "With --float16, the loss scale is doubled after this many steps in a row with finite gradients.")
 
 flags.DEFINE_boolean("adam", False,                   #
                    "Use Adam optimizer.")
@@ -145,7 +155,7 @@ flags.DEFINE_boolean("end_classification", False, "Classify only in ends of D. O
 
 FLAGS = flags.FLAGS
 
-model_layout_flags = ['num_layers_g', 'num_layers_d', 'meta_layer_size', 'hidden_size_g', 'hidden_size_d', 'biscale_slow_layer_ticks', 'multiscale', 'multiscale', 'disable_feed_previous', 'pace_events', 'minibatch_d', 'unidirectional_d', 'feature_matching', 'composer']
+model_layout_flags = ['num_layers_g', 'num_layers_d', 'meta_layer_size', 'hidden_size_g', 'hidden_size_d', 'biscale_slow_layer_ticks', 'multiscale', 'multiscale', 'disable_feed_previous', 'pace_events', 'minibatch_d', 'unidirectional_d', 'feature_matching', 'composer', 'rnn_cell']
 
 genres = ['classical', 'jazz']
 
@@ -153,10 +163,39 @@ num_of_samples_per_genre = 1
 
 batch_size = 4
 
+def rnn_cell_class():
+  """The RNNCell class selected by --rnn_cell."""
+  if FLAGS.rnn_cell == 'basic':
+    return tf.contrib.rnn.BasicLSTMCell
+  elif FLAGS.rnn_cell in ['block', 'block_fused']:
+    return tf.contrib.rnn.LSTMBlockCell
+  raise ValueError('Unknown --rnn_cell: {}'.format(FLAGS.rnn_cell))
+
+def fused_lstm(inputs, rnn_layer_sizes, sequence_length=None, dropout_keep_prob=1.0, reverse=False):
+  """
+  Runs a stack of tf.contrib.rnn.LSTMBlockFusedCell layers over inputs,
+  [batch_size, time, features]. Each layer is one op over the whole
+  sequence. With reverse, the layers run backwards over the first
+  sequence_length steps of each sequence.
+
+  Returns the outputs of the last layer, [batch_size, time, rnn_layer_sizes[-1]].
+  """
+  # The fused cell is time major.
+  outputs = tf.transpose(inputs, perm=[1, 0, 2])
+  for i,num_units in enumerate(rnn_layer_sizes):
+    with tf.variable_scope('cell_{}'.format(i)):
+      cell = tf.contrib.rnn.LSTMBlockFusedCell(num_units)
+      if reverse:
+        cell = tf.contrib.rnn.TimeReversedFusedRNN(cell)
+      outputs, _ = cell(outputs, dtype=data_type(), sequence_length=sequence_length)
+      if dropout_keep_prob < 1:
+        outputs = tf.nn.dropout(outputs, dropout_keep_prob)
+  return tf.transpose(outputs, perm=[1, 0, 2])
+
 def make_rnn_cell(rnn_layer_sizes,
                   dropout_keep_prob=1.0,
                   attn_length=0,
-                  base_cell=tf.contrib.rnn.BasicLSTMCell,
+                  base_cell=None,
                   state_is_tuple=True,
                   reuse=False):
   """Makes a RNN cell from the given hyperparameters.
@@ -165,16 +204,23 @@ def make_rnn_cell(rnn_layer_sizes,
     rnn_layer_sizes: A list of integer sizes (in units) for each layer of the RNN.
     dropout_keep_prob: The float probability to keep the output of any given sub-cell.
     attn_length: The size of the attention vector.
-    base_cell: The base tf.contrib.rnn.RNNCell to use for sub-cells.
+    base_cell: The base tf.contrib.rnn.RNNCell to use for sub-cells. Default:
+        the one selected by --rnn_cell.
     state_is_tuple: A boolean specifying whether to use tuple of hidden matrix
         and cell matrix as a state instead of a concatenated matrix.
 
   Returns:
       A tf.contrib.rnn.MultiRNNCell based on the given hyperparameters.
   """
+  if base_cell is None:
+    base_cell = rnn_cell_class()
   cells = []
   for num_units in rnn_layer_sizes:
-    cell = base_cell(num_units, state_is_tuple=state_is_tuple)#, reuse=reuse)
+    if base_cell is tf.contrib.rnn.LSTMBlockCell:
+      # Always uses a tuple state.
+      cell = base_cell(num_units)#, reuse=reuse)
+    else:
+      cell = base_cell(num_units, state_is_tuple=state_is_tuple)#, reuse=reuse)
     cell = tf.contrib.rnn.DropoutWrapper(
         cell, output_keep_prob=dropout_keep_prob)
     cells.append(cell)
@@ -210,10 +256,76 @@ def restore_flags(save_if_none_found=True):
 
 
 
+# Keeps log() in the losses finite. The losses are computed in float32,
+# where 1e-7 is representable (unlike 1e-1000000, which is just 0.0).
+LOG_EPSILON = 1e-7
+
 def data_type():
   return tf.float16 if FLAGS.float16 else tf.float32
   #return tf.float16
 
+def float32_variable_getter(getter, name, shape=None, dtype=None, initializer=None, regularizer=None, trainable=True, *args, **kwargs):
+  """
+  Custom getter for mixed precision. Trainable variables are stored (and
+  updated by the optimizers) in float32, and cast to the requested dtype,
+  e.g. float16, where they are used. Regularizers see the float32 variables.
+  """
+  storage_dtype = tf.float32 if trainable else dtype
+  variable = getter(name, shape, dtype=storage_dtype, initializer=initializer, regularizer=regularizer, trainable=trainable, *args, **kwargs)
+  if trainable and dtype is not None and dtype != tf.float32:
+    variable = tf.cast(variable, dtype)
+  return variable
+
+def variable_getter():
+  """The custom getter to build the model with: float32_variable_getter with --float16, else None."""
+  return float32_variable_getter if FLAGS.float16 else None
+
+class LossScale(object):
+  """
+  Dynamic loss scale of one optimizer, for --float16. The loss is multiplied
+  by the scale before differentiating, and the gradients divided by it, so
+  that small gradients survive the float16 part of the backward pass.
+
+  The scale starts at --loss_scale. A step where any gradient is inf/nan is
+  skipped, leaving the float32 variables as they are, and halves the scale.
+  After --loss_scale_window steps in a row with finite gradients, the scale
+  is doubled.
+  """
+  def __init__(self, name):
+    self.scale = tf.Variable(FLAGS.loss_scale, trainable=False, dtype=tf.float32, name=name+'_loss_scale')
+    self.finite_steps = tf.Variable(0, trainable=False, dtype=tf.int32, name=name+'_finite_steps')
+
+  def gradients(self, loss, params):
+    grads = tf.gradients(loss*self.scale, params)
+    return [None if grad is None else grad/self.scale for grad in grads]
+
+  def apply_gradients(self, optimizer, grads, params):
+    all_finite = tf.reduce_all([tf.reduce_all(tf.is_finite(grad)) for grad in grads if grad is not None])
+    def apply():
+      with tf.control_dependencies([optimizer.apply_gradients(zip(grads, params))]):
+        grow = self.finite_steps+1 >= FLAGS.loss_scale_window
+        return tf.group(tf.assign(self.scale, tf.where(grow, self.scale*2.0, self.scale)),
+                        tf.assign(self.finite_steps, tf.where(grow, 0, self.finite_steps+1)))
+    def skip():
+      return tf.group(tf.assign(self.scale, tf.maximum(self.scale/2.0, 1.0)),
+                      tf.assign(self.finite_steps, 0))
+    return tf.cond(all_finite, apply, skip)
+
+def clipped_update(optimizer, loss, params, loss_scale=None):
+  """
+  The op that applies the gradients of loss, clipped to --max_grad_norm, to
+  params with optimizer. With a LossScale (--float16), the gradients are
+  computed through it, and steps where they overflow are skipped.
+  """
+  if loss_scale is None:
+    grads = tf.gradients(loss, params)
+  else:
+    grads = loss_scale.gradients(loss, params)
+  grads, _ = tf.clip_by_global_norm(grads, FLAGS.max_grad_norm)
+  if loss_scale is None:
+    return optimizer.apply_gradients(zip(grads, params))
+  return loss_scale.apply_gradients(optimizer, grads, params)
+
 def my_reduce_mean(what_to_take_mean_over):
   return tf.reshape(what_to_take_mean_over, shape=[-1])[0]
   denom = 1.0
@@ -226,6 +338,15 @@ def my_reduce_mean(what_to_take_mean_over):
       denom = denom*d
   return tf.reduce_sum(what_to_take_mean_over)/denom
 
+def debug_print(inp, data, message):
+  """
+  tf.Print(inp, data, message) when --debug_prints is set, otherwise just inp,
+  so the default graph has no Print nodes.
+  """
+  if not FLAGS.debug_prints:
+    return inp
+  return tf.Print(inp, data, message, summarize=20, first_n=20)
+
 def linear(inp, output_dim, scope=None, stddev=1.0, reuse_scope=False):
   norm = tf.random_normal_initializer(stddev=stddev, dtype=data_type())
   const = tf.constant_initializer(0.0, dtype=data_type())
@@ -238,6 +359,26 @@ def linear(inp, output_dim, scope=None, stddev=1.0, reuse_scope=False):
     b = tf.get_variable('b', [output_dim], initializer=const, dtype=data_type())
   return tf.matmul(inp, w) + b
 
+def time_distributed(layer, inp, *args, **kwargs):
+  """
+  Applies layer (e.g. linear) to every step of inp, [batch_size, time, features],
+  as one batched matmul. Returns [batch_size, time, output features].
+  """
+  inp_shape = tf.shape(inp)
+  outp = layer(tf.reshape(inp, [-1, inp.get_shape()[2].value]), *args, **kwargs)
+  output_dim = outp.get_shape()[1].value
+  outp = tf.reshape(outp, tf.stack([inp_shape[0], inp_shape[1], output_dim]))
+  outp.set_shape(inp.get_shape()[:2].concatenate([output_dim]))
+  return outp
+
+def concat_meta(meta, inputs):
+  """
+  Concatenates meta, [batch_size, meta features], to every step of
+  inputs, [batch_size, time, features].
+  """
+  meta = tf.tile(tf.expand_dims(meta, 1), [1, tf.shape(inputs)[1], 1])
+  return tf.concat([meta, inputs], 2)
+
 def minibatch(inp, num_kernels=25, kernel_dim=10, scope=None, msg='', reuse_scope=False):
   """
    Borrowed from http://blog.aylien.com/introduction-generative-adversarial-networks-code-tensorflow/
@@ -247,22 +388,22 @@ def minibatch(inp, num_kernels=25, kernel_dim=10, scope=None, msg='', reuse_scop
     if reuse_scope:
       scope.reuse_variables()
   
-    inp = tf.Print(inp, [inp],
-            '{} inp = '.format(msg), summarize=20, first_n=20)
+    inp = debug_print(inp, [inp],
+            '{} inp = '.format(msg))
     x = tf.sigmoid(linear(inp, num_kernels * kernel_dim, scope))
     activation = tf.reshape(x, (-1, num_kernels, kernel_dim))
-    activation = tf.Print(activation, [activation],
-            '{} activation = '.format(msg), summarize=20, first_n=20)
+    activation = debug_print(activation, [activation],
+            '{} activation = '.format(msg))
     diffs = tf.expand_dims(activation, 3) - \
                 tf.expand_dims(tf.transpose(activation, [1, 2, 0]), 0)
-    diffs = tf.Print(diffs, [diffs],
-            '{} diffs = '.format(msg), summarize=20, first_n=20)
+    diffs = debug_print(diffs, [diffs],
+            '{} diffs = '.format(msg))
     abs_diffs = tf.reduce_sum(tf.abs(diffs), 2)
-    abs_diffs = tf.Print(abs_diffs, [abs_diffs],
-            '{} abs_diffs = '.format(msg), summarize=20, first_n=20)
+    abs_diffs = debug_print(abs_diffs, [abs_diffs],
+            '{} abs_diffs = '.format(msg))
     minibatch_features = tf.reduce_sum(tf.exp(-abs_diffs), 2)
-    minibatch_features = tf.Print(minibatch_features, [tf.reduce_min(minibatch_features), tf.reduce_max(minibatch_features)],
-            '{} minibatch_features (min,max) = '.format(msg), summarize=20, first_n=20)
+    minibatch_features = debug_print(minibatch_features, [tf.reduce_min(minibatch_features), tf.reduce_max(minibatch_features)],
+            '{} minibatch_features (min,max) = '.format(msg))
   return tf.concat( [inp, minibatch_features],1)
 
 class RNNGAN(object):
@@ -354,7 +495,8 @@ class RNNGAN(object):
     self._final_state = state
 
     # These are used both for pretraining and for D/G training further down.
-    self._lr = tf.Variable(FLAGS.learning_rate, trainable=False, dtype=data_type())
+    # The optimizers work on float32 variables, also with --float16.
+    self._lr = tf.Variable(FLAGS.learning_rate, trainable=False, dtype=tf.float32)
     self.g_params = [v for v in tf.trainable_variables() if v.name.startswith('model/G/')]
     if FLAGS.adam:
       g_optimizer = tf.train.AdamOptimizer(self._lr)
@@ -364,8 +506,8 @@ class RNNGAN(object):
     reg_losses = tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)
     reg_constant = 0.1  # Choose an appropriate one.
     reg_loss = reg_constant * sum(reg_losses)
-    reg_loss = tf.Print(reg_loss, reg_losses,
-                  'reg_losses = ', summarize=20, first_n=20)
+    reg_loss = debug_print(reg_loss, reg_losses,
+                  'reg_losses = ')
     #if not FLAGS.disable_l2_regularizer:
     #  print('L2 regularization. Reg losses: {}'.format([v.name for v in reg_losses]))
    
@@ -373,13 +515,17 @@ class RNNGAN(object):
     
     # print(tf.transpose(tf.stack(self._generated_features_pretraining), perm=[1, 0, 2]).get_shape())
     # print(self._input_songdata.get_shape())
-    self.rnn_pretraining_loss = tf.reduce_mean(tf.squared_difference(x=tf.transpose(tf.stack(self._generated_features_pretraining), perm=[1, 0, 2]), y=self._input_songdata))
+    # Losses are computed in float32, also with --float16.
+    self.rnn_pretraining_loss = tf.reduce_mean(tf.squared_difference(x=tf.cast(tf.transpose(tf.stack(self._generated_features_pretraining), perm=[1, 0, 2]), tf.float32), y=tf.cast(self._input_songdata, tf.float32)))
     if not FLAGS.disable_l2_regularizer:
       self.rnn_pretraining_loss = self.rnn_pretraining_loss+reg_loss
     
     
-    pretraining_grads, _ = tf.clip_by_global_norm(tf.gradients(self.rnn_pretraining_loss, self.g_params), FLAGS.max_grad_norm)
-    self.opt_pretraining = g_optimizer.apply_gradients(zip(pretraining_grads, self.g_params))
+    # One loss scale per update op, since opt_d and opt_g run in the same step.
+    self.loss_scales = {}
+    if FLAGS.float16:
+      self.loss_scales = dict((name, LossScale(name)) for name in ['pretraining', 'd', 'g'])
+    self.opt_pretraining = clipped_update(g_optimizer, self.rnn_pretraining_loss, self.g_params, self.loss_scales.get('pretraining'))
 
     # ---END, PRETRAINING---
 
@@ -390,38 +536,50 @@ class RNNGAN(object):
     # as you cannot use the same network with different inputs in TensorFlow.
     with tf.variable_scope('D') as scope:
       scope.set_regularizer(tf.contrib.layers.l2_regularizer(scale=FLAGS.reg_scale))
-      # Make list of tensors. One per step in recurrence.
-      # Each tensor is batchsize*numfeatures.
+      # Inputs are [batch_size, songlength, features] tensors.
       # TODO: (possibly temporarily) disabling meta info
       # print('self._input_songdata shape {}'.format(self._input_songdata.get_shape()))
       # print('generated data shape {}'.format(self._generated_features[0].get_shape()))
       
       # TODO: (possibly temporarily) disabling meta info
       #if FLAGS.generate_meta:
-      conditioned_songdata_inputs = [tf.concat([self._input_metadata, songdata_input],1) for songdata_input in songdata_inputs]
-      self.real_d,self.real_d_features = self.discriminator(conditioned_songdata_inputs, is_training, msg='real')
-
-      scope.reuse_variables()
-
+      conditioned_songdata_inputs = concat_meta(self._input_metadata, self._input_songdata)
       # real data but wrong condition
-      songdata_wrong_condition_inputs = [tf.concat([self._input_metadata_wrong, songdata_input],1) for songdata_input in songdata_inputs]
-      self.wrong_d,self.wrong_d_features = self.discriminator(songdata_wrong_condition_inputs, is_training, msg='wrong')
-      #if FLAGS.generate_meta:
+      songdata_wrong_condition_inputs = concat_meta(self._input_metadata_wrong, self._input_songdata)
       #if FLAGS.generate_meta:
-      generated_data = [tf.concat([self._input_metadata, songdata_input],1) for songdata_input in self._generated_features]
+      generated_data = concat_meta(self._input_metadata, tf.stack(self._generated_features, axis=1))
       #else:
       #  generated_data = self._generated_features
-      if conditioned_songdata_inputs[0].get_shape() != generated_data[0].get_shape():
-        print('songdata_inputs shape {} != generated data shape {}'.format(conditioned_songdata_inputs[0].get_shape(), generated_data[0].get_shape()))
-      self.generated_d,self.generated_d_features = self.discriminator(generated_data, is_training, msg='generated')
+      if conditioned_songdata_inputs.get_shape() != generated_data.get_shape():
+        print('songdata_inputs shape {} != generated data shape {}'.format(conditioned_songdata_inputs.get_shape(), generated_data.get_shape()))
+      if FLAGS.single_pass_d and not FLAGS.minibatch_d:
+        # Minibatch discrimination compares the samples of a batch, so it
+        # needs the three inputs in separate passes.
+        d, d_features = self.discriminator(tf.concat([conditioned_songdata_inputs, songdata_wrong_condition_inputs, generated_data], 0), is_training, msg='real_wrong_generated', num_passes=3)
+        self.real_d, self.wrong_d, self.generated_d = tf.split(d, 3, 0)
+        self.real_d_features, self.wrong_d_features, self.generated_d_features = tf.split(d_features, 3, 0)
+      else:
+        self.real_d,self.real_d_features = self.discriminator(conditioned_songdata_inputs, is_training, msg='real')
+
+        scope.reuse_variables()
+
+        self.wrong_d,self.wrong_d_features = self.discriminator(songdata_wrong_condition_inputs, is_training, msg='wrong')
+        self.generated_d,self.generated_d_features = self.discriminator(generated_data, is_training, msg='generated')
+
+    # Losses are computed in float32, also with --float16.
+    self.real_d = tf.cast(self.real_d, tf.float32)
+    self.wrong_d = tf.cast(self.wrong_d, tf.float32)
+    self.generated_d = tf.cast(self.generated_d, tf.float32)
+    self.real_d_features = tf.cast(self.real_d_features, tf.float32)
+    self.generated_d_features = tf.cast(self.generated_d_features, tf.float32)
 
     # Define the loss for discriminator and generator networks (see the original
     # paper for details), and create optimizers for both
-    self.d_loss = tf.reduce_mean(-2*tf.log(tf.clip_by_value(self.real_d, 1e-1000000, 1.0)) \
-                                 -tf.log(1 - tf.clip_by_value(self.generated_d, 0.0, 1.0-1e-1000000)) \
-                                 -2*tf.log(1 - tf.clip_by_value(self.wrong_d, 0.0, 1.0-1e-1000000)))
+    self.d_loss = tf.reduce_mean(-2*tf.log(tf.clip_by_value(self.real_d, LOG_EPSILON, 1.0)) \
+                                 -tf.log(1 - tf.clip_by_value(self.generated_d, 0.0, 1.0-LOG_EPSILON)) \
+                                 -2*tf.log(1 - tf.clip_by_value(self.wrong_d, 0.0, 1.0-LOG_EPSILON)))
     self.g_loss_feature_matching = tf.reduce_sum(tf.squared_difference(self.real_d_features, self.generated_d_features))
-    self.g_loss = tf.reduce_mean(-tf.log(tf.clip_by_value(self.generated_d, 1e-1000000, 1.0)))
+    self.g_loss = tf.reduce_mean(-tf.log(tf.clip_by_value(self.generated_d, LOG_EPSILON, 1.0)))
 
     if not FLAGS.disable_l2_regularizer:
       self.d_loss = self.d_loss+reg_loss
@@ -429,29 +587,29 @@ class RNNGAN(object):
       self.g_loss = self.g_loss+reg_loss
     self.d_params = [v for v in tf.trainable_variables() if v.name.startswith('model/D/')]
 
+    # Fetched in place of an optimizer when G or D is frozen. Built once here,
+    # since creating ops in the training loop keeps growing the graph.
+    self.no_op = tf.no_op(name='no_op')
+
     if not is_training:
       return
 
     d_optimizer = tf.train.GradientDescentOptimizer(self._lr*FLAGS.d_lr_factor)
-    d_grads, _ = tf.clip_by_global_norm(tf.gradients(self.d_loss, self.d_params),
-                                        FLAGS.max_grad_norm)
-    self.opt_d = d_optimizer.apply_gradients(zip(d_grads, self.d_params))
+    self.opt_d = clipped_update(d_optimizer, self.d_loss, self.d_params, self.loss_scales.get('d'))
     if FLAGS.feature_matching:
-      g_grads, _ = tf.clip_by_global_norm(tf.gradients(self.g_loss_feature_matching,
-                                                       self.g_params),
-                                        FLAGS.max_grad_norm)
+      self.opt_g = clipped_update(g_optimizer, self.g_loss_feature_matching, self.g_params, self.loss_scales.get('g'))
     else:
-      g_grads, _ = tf.clip_by_global_norm(tf.gradients(self.g_loss, self.g_params),
-                                        FLAGS.max_grad_norm)
-    self.opt_g = g_optimizer.apply_gradients(zip(g_grads, self.g_params))
+      self.opt_g = clipped_update(g_optimizer, self.g_loss, self.g_params, self.loss_scales.get('g'))
 
-    self._new_lr = tf.placeholder(shape=[], name="new_learning_rate", dtype=data_type())
+    self._new_lr = tf.placeholder(shape=[], name="new_learning_rate", dtype=tf.float32)
     self._lr_update = tf.assign(self._lr, self._new_lr)
 
-  def discriminator(self, inputs, is_training, msg=''):
-    # RNN discriminator:
+  def discriminator(self, inputs, is_training, msg='', num_passes=1):
+    # RNN discriminator, over inputs of shape [batch_size, songlength, features].
+    # With num_passes > 1, inputs are num_passes batches stacked along the batch axis.
+    batch_size = self.batch_size*num_passes
     if is_training and FLAGS.keep_prob < 1:
-      inputs = [tf.nn.dropout(input_, FLAGS.keep_prob) for input_ in inputs]
+      inputs = tf.nn.dropout(inputs, FLAGS.keep_prob)
     
     #lstm_cell = tf.nn.rnn_cell.BasicLSTMCell(FLAGS.hidden_size_d, forget_bias=1.0, state_is_tuple=True)
     if is_training and FLAGS.keep_prob < 1:
@@ -463,31 +621,40 @@ class RNNGAN(object):
       
       cell_bw = make_rnn_cell([FLAGS.hidden_size_d]* FLAGS.num_layers_d)
     #cell_fw = tf.nn.rnn_cell.MultiRNNCell([lstm_cell for _ in range( FLAGS.num_layers_d)], state_is_tuple=True)
-    self._initial_state_fw = cell_fw.zero_state(self.batch_size, data_type())
-    if not FLAGS.unidirectional_d:
-      self._initial_state_bw = cell_bw.zero_state(self.batch_size, data_type())
-      outputs, state_fw, state_bw = tf.contrib.rnn.static_bidirectional_rnn(cell_fw, cell_bw, inputs, initial_state_fw=self._initial_state_fw, initial_state_bw=self._initial_state_bw)
+    self._initial_state_fw = cell_fw.zero_state(batch_size, data_type())
+    if FLAGS.rnn_cell == 'block_fused':
+      # One op per layer and direction, over the whole sequence.
+      keep_prob = FLAGS.keep_prob if is_training else 1.0
+      with tf.variable_scope('fused_rnn'):
+        with tf.variable_scope('fw'):
+          outputs = fused_lstm(inputs, [FLAGS.hidden_size_d]*FLAGS.num_layers_d, sequence_length=None, dropout_keep_prob=keep_prob)
+        if not FLAGS.unidirectional_d:
+          with tf.variable_scope('bw'):
+            outputs_bw = fused_lstm(inputs, [FLAGS.hidden_size_d]*FLAGS.num_layers_d, sequence_length=None, dropout_keep_prob=keep_prob, reverse=True)
+          outputs = tf.concat([outputs, outputs_bw], 2)
+    elif not FLAGS.unidirectional_d:
+      self._initial_state_bw = cell_bw.zero_state(batch_size, data_type())
+      # Same variable names as tf.contrib.rnn.static_bidirectional_rnn.
+      (outputs_fw, outputs_bw), _ = tf.nn.bidirectional_dynamic_rnn(cell_fw, cell_bw, inputs, initial_state_fw=self._initial_state_fw, initial_state_bw=self._initial_state_bw)
+      outputs = tf.concat([outputs_fw, outputs_bw], 2)
       
     else:
-      outputs, state = tf.nn.rnn(cell_fw, inputs, initial_state=self._initial_state_fw)
+      outputs, state = tf.nn.dynamic_rnn(cell_fw, inputs, initial_state=self._initial_state_fw)
 
     if FLAGS.minibatch_d:
-      outputs = [minibatch(tf.reshape(outp, shape=[FLAGS.batch_size, -1]), msg=msg, reuse_scope=(i!=0)) for i,outp in enumerate(outputs)]
+      # Minibatch discrimination compares the samples of the batch, one step at a time.
+      outputs = tf.stack([minibatch(outp, msg=msg, reuse_scope=(i!=0)) for i,outp in enumerate(tf.unstack(outputs, axis=1))], axis=1)
     # decision = tf.sigmoid(linear(outputs[-1], 1, 'decision'))
     if FLAGS.end_classification:
-      decisions = [tf.sigmoid(linear(output, 1, 'decision', reuse_scope=(i!=0))) for i,output in enumerate([outputs[0], outputs[-1]])]
-      decisions = tf.stack(decisions)
-      decisions = tf.transpose(decisions, perm=[1,0,2])
+      decisions = tf.sigmoid(time_distributed(linear, tf.stack([outputs[:,0], outputs[:,-1]], axis=1), 1, 'decision'))
       print('shape, decisions: {}'.format(decisions.get_shape()))
     else:
-      decisions = [tf.sigmoid(linear(output, 1, 'decision', reuse_scope=(i!=0))) for i,output in enumerate(outputs)]
-      decisions = tf.stack(decisions)
-      decisions = tf.transpose(decisions, perm=[1,0,2])
+      decisions = tf.sigmoid(time_distributed(linear, outputs, 1, 'decision'))
       # print('shape, decisions: {}'.format(decisions.get_shape()))
     decision = tf.reduce_mean(decisions, reduction_indices=[1,2])
-    decision = tf.Print(decision, [decision],
-            '{} decision = '.format(msg), summarize=20, first_n=20)
-    return (decision,tf.transpose(tf.stack(outputs), perm=[1,0,2]))
+    decision = debug_print(decision, [decision],
+            '{} decision = '.format(msg))
+    return (decision,outputs)
       
 
   
@@ -573,23 +740,23 @@ def run_epoch(session, model, loader, datasetlabel, eval_op_g, eval_op_d, pretra
         break
       elif d_loss == 0.0:
         #print('D train loss is zero. Freezing optimization. G loss: {:.3f}'.format(g_loss))
-        op_g = tf.no_op()
+        op_g = model.no_op
       elif g_loss == 0.0: 
         #print('G train loss is zero. Freezing optimization. D loss: {:.3f}'.format(d_loss))
-        op_d = tf.no_op()
+        op_d = model.no_op
       elif g_loss < 2.0 or d_loss < 2.0:
         if g_loss*.7 > d_loss:
           #print('G train loss is {:.3f}, D train loss is {:.3f}. Freezing optimization of D'.format(g_loss, d_loss))
-          op_g = tf.no_op()
+          op_g = model.no_op
         #elif d_loss*.7 > g_loss:
           #print('G train loss is {:.3f}, D train loss is {:.3f}. Freezing optimization of G'.format(g_loss, d_loss))
-        op_d = tf.no_op()
+        op_d = model.no_op
     #fetches = [model.cost, model.final_state, eval_op]
     if pretraining:
       if pretraining_d:
         fetches = [model.rnn_pretraining_loss, model.d_loss, op_g, op_d]
       else:
-        fetches = [model.rnn_pretraining_loss, tf.no_op(), op_g, op_d]
+        fetches = [model.rnn_pretraining_loss, model.no_op, op_g, op_d]
     else:
       fetches = [model.g_loss, model.d_loss, op_g, op_d]
     feed_dict = {}
@@ -718,7 +885,7 @@ def main(_):
     FLAGS.songlength = int(min((global_step+1)*4,songlength_ceiling))
  
   with tf.Graph().as_default(), tf.Session(config=tf.ConfigProto(log_device_placement=FLAGS.log_device_placement)) as session:
-    with tf.variable_scope("model", reuse=None) as scope:
+    with tf.variable_scope("model", reuse=None, custom_getter=variable_getter()) as scope:
       scope.set_regularizer(tf.contrib.layers.l2_regularizer(scale=FLAGS.reg_scale))
       m = RNNGAN(is_training=True, num_song_features=num_song_features, num_meta_features=num_meta_features)
 
@@ -765,10 +932,16 @@ def main(_):
         if new_songlength != FLAGS.songlength:
           print('Changing songlength, now training on {} events from songs.'.format(new_songlength))
           FLAGS.songlength = new_songlength
-          with tf.variable_scope("model", reuse=True) as scope:
+          with tf.variable_scope("model", reuse=True, custom_getter=variable_getter()) as scope:
             scope.set_regularizer(tf.contrib.layers.l2_regularizer(scale=FLAGS.reg_scale))
             m = RNNGAN(is_training=True, num_song_features=num_song_features, num_meta_features=num_meta_features)
 
+        if FLAGS.songlength == songlength_ceiling and not session.graph.finalized:
+          # No more models are built from here on. Any op created by
+          # mistake in the loop below now raises instead of growing the graph.
+          print('Finalizing graph: {} ops.'.format(len(session.graph.get_operations())))
+          session.graph.finalize()
+
         if not FLAGS.adam:
           m.assign_lr(session, FLAGS.learning_rate * lr_decay)
 
@@ -777,7 +950,7 @@ def main(_):
 
         print("Epoch: {} Learning rate: {:.3f}, pretraining: {}".format(i, session.run(m.lr), (i<FLAGS.pretraining_epochs)))
         if i < FLAGS.pretraining_epochs:
-          opt_d = tf.no_op()
+          opt_d = m.no_op
           if FLAGS.pretraining_d:
             opt_d = m.opt_d
           train_g_loss,train_d_loss = run_epoch(session, m, loader, 'train', m.opt_pretraining, opt_d, pretraining = True, verbose=True, run_metadata=run_metadata, pretraining_d=FLAGS.pretraining_d)
@@ -795,7 +968,7 @@ def main(_):
             print("Epoch: {} Train loss: G: {:.3f}, D: {:.3f}".format(i, train_g_loss, train_d_loss))
           except:
             print("Epoch: {} Train loss: G: {}, D: {}".format(i, train_g_loss, train_d_loss))
-        valid_g_loss,valid_d_loss = run_epoch(session, m, loader, 'validation', tf.no_op(), tf.no_op())
+        valid_g_loss,valid_d_loss = run_epoch(session, m, loader, 'validation', m.no_op, m.no_op)
         try:
           print("Epoch: {} Valid loss: G: {:.3f}, D: {:.3f}".format(i, valid_g_loss, valid_d_loss))
         except:
@@ -894,7 +1067,7 @@ def main(_):
         sys.stdout.flush()
 
 
-      test_g_loss,test_d_loss = run_epoch(session, m, loader, 'test', tf.no_op(), tf.no_op())
+      test_g_loss,test_d_loss = run_epoch(session, m, loader, 'test', m.no_op, m.no_op)
       print("Test loss G: %.3f, D: %.3f" %(test_g_loss, test_d_loss))
 
     # song_data = sample(session, m)
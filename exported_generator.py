@@ -0,0 +1,251 @@
+# Lightweight loader for a generator exported with rnn_gan.py --export_dir.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+
+Loads only the G SavedModel, so generating songs needs neither the dataset
+nor the D and optimizer variables of the training checkpoint.
+
+To export, and then generate n_songs songs of songlength events into out_dir:
+
+$ python rnn_gan.py --datadir data --traindir dir-for-checkpoints-and-plots --export_dir export-dir
+$ python exported_generator.py export-dir out_dir [n_songs] [songlength] [seed]
+
+Long songs can be generated chunk by chunk, with the LSTM state carried
+over, by generate_stream() and stream_midi_events().
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json, os, sys
+
+import numpy as np
+import tensorflow as tf
+
+import music_data_utils
+
+CONFIG_FILENAME = 'generator_config.json'
+SIGNATURE_KEY = 'generate'
+
+class ExportedGenerator(object):
+  """
+  A generator loaded from a SavedModel written by rnn_gan.Generator.export().
+  """
+  def __init__(self, export_dir, session_config=None):
+    with open(os.path.join(export_dir, CONFIG_FILENAME), 'r') as f:
+      self.config = json.load(f)
+    self.genres = self.config.get('genres', [])
+    self.composers = self.config.get('composers', [])
+    self.max_batch_size = self.config['max_batch_size']
+    self.graph = tf.Graph()
+    self.session = tf.Session(graph=self.graph, config=session_config)
+    meta_graph_def = tf.saved_model.loader.load(self.session, [tf.saved_model.tag_constants.SERVING], export_dir)
+    signature = meta_graph_def.signature_def[SIGNATURE_KEY]
+    self._inputs = dict((key, self.graph.get_tensor_by_name(tensor_info.name)) for key,tensor_info in signature.inputs.items())
+    self._outputs = dict((key, self.graph.get_tensor_by_name(tensor_info.name)) for key,tensor_info in signature.outputs.items())
+    self._songs = self._outputs['songs']
+    self._loader = None
+
+  def close(self):
+    self.session.close()
+
+  def meta(self, genre=None, composer=None):
+    """
+    The meta features (one-hot genre, then one-hot composer) for genre and
+    composer, as used for conditioning by generate().
+    """
+    meta = np.zeros([self.config['num_meta_features']], dtype=np.float32)
+    if genre is not None:
+      meta[self.genres.index(genre)] = 1
+    if composer is not None:
+      meta[len(self.genres)+self.composers.index(composer)] = 1
+    return meta
+
+  def generate(self, n_songs, songlength=None, seed=None, conditioning=None):
+    """
+    Generates n_songs songs of songlength events (default: the songlength
+    the model was trained with), in runs of at most max_batch_size songs.
+
+    With a seed, the noise (including that of the generated meta features,
+    with --generate_meta) is drawn from np.random.RandomState(seed), and the
+    same seed gives the same songs. Otherwise, the model draws its own noise.
+
+    conditioning (only for models trained with --generate_meta) is a meta
+    feature vector, e.g. from meta(), for all songs, or one per song.
+
+    Returns an array [n_songs, songlength, num_song_features].
+    """
+    songlength = songlength or self.config['songlength']
+    if conditioning is not None:
+      if 'meta' not in self._inputs:
+        raise ValueError('Conditioning needs a model trained with --generate_meta.')
+      conditioning = np.broadcast_to(conditioning, [n_songs, self.config['num_meta_features']])
+    random_state = None
+    if seed is not None:
+      random_state = np.random.RandomState(seed)
+    songs = []
+    for start in range(0, n_songs, self.max_batch_size):
+      batch_size = min(self.max_batch_size, n_songs-start)
+      random_inputs, initial_point, meta_inputs = None, None, None
+      if random_state is not None:
+        random_inputs, initial_point = self.noise(random_state, batch_size, songlength)
+        meta_inputs = self.meta_noise(random_state, batch_size)
+      meta = None
+      if conditioning is not None:
+        meta = conditioning[start:start+batch_size]
+      songs.append(self.generate_batch(batch_size, songlength, random_inputs, initial_point, meta, meta_inputs))
+    return np.concatenate(songs, axis=0)
+
+  def noise(self, random_state, batch_size, songlength):
+    """Draws (random_inputs, initial_point) for generate_batch() from random_state."""
+    numpy_type = np.dtype(self.config['data_type'])
+    random_inputs = random_state.uniform(size=[batch_size, songlength, self.config['num_random_features']]).astype(numpy_type)
+    initial_point = random_state.uniform(size=[batch_size, self.config['num_song_features']]).astype(numpy_type)
+    return (random_inputs, initial_point)
+
+  def meta_noise(self, random_state, batch_size):
+    """
+    Draws the meta_inputs for generate_batch() from random_state: the noise
+    the meta features are generated from. None for models without
+    --generate_meta (and for exports that do not take it).
+    """
+    if 'meta_inputs' not in self._inputs:
+      return None
+    numpy_type = np.dtype(self.config['data_type'])
+    return random_state.uniform(size=[batch_size, self.config['num_meta_random_features']]).astype(numpy_type)
+
+  def _feed_dict(self, batch_size, songlength, random_inputs, initial_point, meta, meta_inputs):
+    feed_dict = {self._inputs['batch_size']: batch_size, self._inputs['songlength']: songlength}
+    if random_inputs is not None:
+      feed_dict[self._inputs['random_inputs']] = random_inputs
+    if initial_point is not None:
+      feed_dict[self._inputs['initial_point']] = initial_point
+    if meta is not None:
+      feed_dict[self._inputs['meta']] = meta
+    elif meta_inputs is not None:
+      feed_dict[self._inputs['meta_inputs']] = meta_inputs
+    return feed_dict
+
+  def generate_batch(self, batch_size, songlength, random_inputs=None, initial_point=None, meta=None, meta_inputs=None):
+    """
+    Generates batch_size songs in one session.run. The noise, and the meta
+    features (with --generate_meta), are drawn by the model unless given.
+    meta_inputs (from meta_noise()) is the noise the meta features are
+    generated from, when meta is not given.
+    Returns an array [batch_size, songlength, num_song_features].
+    """
+    return self.session.run(self._songs, self._feed_dict(batch_size, songlength, random_inputs, initial_point, meta, meta_inputs))
+
+  def generate_chunk(self, batch_size, songlength, random_inputs=None, initial_point=None, meta=None, state=None, meta_inputs=None):
+    """
+    Like generate_batch(), but also takes the flattened LSTM state of G
+    ([batch_size, state_size], default zero) to continue from.
+    Returns (songs, final_state, last_point, meta): songs is
+    [batch_size, songlength, num_song_features], and final_state,
+    last_point and meta (None without --generate_meta) continue the songs
+    when fed back in as state, initial_point and meta.
+    """
+    if 'state' not in self._inputs:
+      raise ValueError('Continuing songs needs a generator exported with its state.')
+    feed_dict = self._feed_dict(batch_size, songlength, random_inputs, initial_point, meta, meta_inputs)
+    if state is not None:
+      feed_dict[self._inputs['state']] = state
+    fetches = [self._songs, self._outputs['final_state'], self._outputs['last_point']]
+    if 'meta' in self._outputs:
+      fetches.append(self._outputs['meta'])
+    results = self.session.run(fetches, feed_dict)
+    if len(results) == 3:
+      results.append(None)
+    return tuple(results)
+
+  def generate_stream(self, n_songs, chunk_length, num_chunks=None, seed=None, conditioning=None, prefetch=1):
+    """
+    Generates n_songs songs (at most max_batch_size) chunk by chunk, and
+    yields each chunk, [n_songs, chunk_length, num_song_features], as soon
+    as it is done. Each chunk continues from the state and last point of the
+    previous one, so the chunks together are one song per row, and only one
+    chunk is held at a time. Without num_chunks, the stream is endless.
+
+    seed and conditioning are as in generate(). With prefetch > 0, up to
+    prefetch chunks are generated ahead, while the caller handles the last.
+    """
+    if n_songs > self.max_batch_size:
+      raise ValueError('Can stream at most {} songs at a time.'.format(self.max_batch_size))
+    if conditioning is not None:
+      if 'meta' not in self._inputs:
+        raise ValueError('Conditioning needs a model trained with --generate_meta.')
+      conditioning = np.broadcast_to(conditioning, [n_songs, self.config['num_meta_features']])
+
+    def chunks():
+      random_state = None
+      if seed is not None:
+        random_state = np.random.RandomState(seed)
+      state, last_point, meta = None, None, conditioning
+      chunk_index = 0
+      while num_chunks is None or chunk_index < num_chunks:
+        random_inputs, initial_point, meta_inputs = None, last_point, None
+        if random_state is not None:
+          random_inputs, random_point = self.noise(random_state, n_songs, chunk_length)
+          if last_point is None:
+            initial_point = random_point
+            meta_inputs = self.meta_noise(random_state, n_songs)
+        songs, state, last_point, meta = self.generate_chunk(n_songs, chunk_length, random_inputs, initial_point, meta, state, meta_inputs)
+        chunk_index += 1
+        yield songs
+
+    if prefetch <= 0:
+      return chunks()
+    return music_data_utils.prefetch_iterator(chunks(), prefetch, name='generate-stream')
+
+  def stream_midi_events(self, chunk_length, num_chunks=None, seed=None, conditioning=None, prefetch=1):
+    """
+    Generates one song chunk by chunk (generate_stream()) and yields its
+    midi events (MusicDataLoader.iter_midi_events()) while later chunks are
+    still being generated.
+    """
+    chunks = self.generate_stream(1, chunk_length, num_chunks, seed, conditioning, prefetch)
+    return self.loader.iter_midi_events(chunk[0] for chunk in chunks)
+
+  @property
+  def loader(self):
+    """A MusicDataLoader for converting songs to midi. Without a datadir, it reads no data."""
+    if self._loader is None:
+      self._loader = music_data_utils.MusicDataLoader(datadir=None, select_validation_percentage=0.0, select_test_percentage=0.0, tones_per_cell=self.config.get('tones_per_cell', 1))
+    return self._loader
+
+  def save_midi(self, filename, song_data):
+    """Saves one generated song, [songlength, num_song_features], as a midi file."""
+    self.loader.save_midi_events(filename, self.loader.get_midi_event_arrays([song_data])[0])
+
+def main():
+  export_dir = sys.argv[1]
+  out_dir = sys.argv[2]
+  n_songs = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+  songlength = int(sys.argv[4]) if len(sys.argv) > 4 else None
+  seed = int(sys.argv[5]) if len(sys.argv) > 5 else None
+  generator = ExportedGenerator(export_dir)
+  songs = generator.generate(n_songs, songlength, seed=seed)
+  try: os.makedirs(out_dir)
+  except: pass
+  for i,events in enumerate(generator.loader.get_midi_event_arrays(songs)):
+    filename = os.path.join(out_dir, 'generated-{}.mid'.format(i))
+    generator.loader.save_midi_events(filename, events)
+    print('Saved {}.'.format(filename))
+  generator.close()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,218 @@
+# HTTP server that generates midi files on demand from an exported generator.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+
+Keeps one generator session warm, and answers
+
+  GET /generate?songlength=200&seed=1&genre=classical&composer=mozart
+
+with the bytes of a generated .mid file. All parameters are optional.
+Concurrent requests are coalesced into one batched session.run, of at most
+--max_batch_size songs, waiting at most --max_latency_ms for a batch to fill.
+GET /health answers 200 when the server is up.
+
+To run, on a generator exported with rnn_gan.py --export_dir:
+
+$ python generation_server.py --export_dir export-dir --port 8000
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import queue, threading, time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import tensorflow as tf
+
+from exported_generator import ExportedGenerator
+
+flags = tf.app.flags
+flags.DEFINE_string("export_dir", None, "Directory of the generator exported with rnn_gan.py --export_dir.")
+flags.DEFINE_string("host", "127.0.0.1", "Host to listen on.")
+flags.DEFINE_integer("port", 8000, "Port to listen on.")
+flags.DEFINE_integer("max_batch_size", 0, "Maximum number of songs per session.run. Default (0): the batch size of the export.")
+flags.DEFINE_float("max_latency_ms", 20.0, "How long the first request of a batch waits for more requests.")
+flags.DEFINE_integer("max_songlength", 2000, "Longest song a request can ask for.")
+FLAGS = flags.FLAGS
+
+class GenerationRequest(object):
+  """One song to generate. Done when event is set, with song or error."""
+  def __init__(self, songlength, seed=None, meta=None):
+    self.songlength = songlength
+    self.seed = seed
+    self.meta = meta
+    self.event = threading.Event()
+    self.song = None
+    self.error = None
+
+class GenerationBatcher(object):
+  """
+  Runs the requests put by generate() (from any thread) in batches, on one
+  worker thread that owns the generator session.
+
+  A batch is generated at the longest songlength in it, and each song is cut
+  to its own songlength. As G only looks back, the songs do not depend on
+  which other songs share their batch. Each song gets its own noise (and,
+  unless conditioned, its own meta noise with --generate_meta), drawn from
+  its seed if it has one, so a seed always gives the same song.
+  """
+  def __init__(self, generator, max_batch_size, max_latency):
+    self.generator = generator
+    self.max_batch_size = max_batch_size
+    self.max_latency = max_latency
+    self._requests = queue.Queue()
+    self._random_state = np.random.RandomState()
+    self.batches, self.songs = 0, 0
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def generate(self, songlength, seed=None, meta=None):
+    """Returns one generated song, [songlength, num_song_features]. Blocks until done."""
+    request = GenerationRequest(songlength, seed, meta)
+    self._requests.put(request)
+    request.event.wait()
+    if request.error is not None:
+      raise request.error
+    return request.song
+
+  def _run(self):
+    while True:
+      batch = [self._requests.get()]
+      deadline = time.time()+self.max_latency
+      while len(batch) < self.max_batch_size:
+        timeout = deadline-time.time()
+        if timeout <= 0:
+          break
+        try:
+          batch.append(self._requests.get(timeout=timeout))
+        except queue.Empty:
+          break
+      # The meta input of the model is either fed for all songs in a
+      # session.run, or generated for all of them.
+      for conditioned in [False, True]:
+        requests = [r for r in batch if (r.meta is not None) == conditioned]
+        if requests:
+          self._run_batch(requests)
+
+  def _run_batch(self, requests):
+    try:
+      songlength = max(r.songlength for r in requests)
+      random_inputs, initial_point, meta_inputs = [], [], []
+      for r in requests:
+        random_state = self._random_state if r.seed is None else np.random.RandomState(r.seed)
+        r_random_inputs, r_initial_point = self.generator.noise(random_state, 1, r.songlength)
+        # Drawn before the padding, so it only depends on the seed.
+        meta_inputs.append(self.generator.meta_noise(random_state, 1))
+        if r.songlength < songlength:
+          # Padding, only seen after the end of this song.
+          padding, _ = self.generator.noise(self._random_state, 1, songlength-r.songlength)
+          r_random_inputs = np.concatenate([r_random_inputs, padding], axis=1)
+        random_inputs.append(r_random_inputs)
+        initial_point.append(r_initial_point)
+      meta = None
+      if requests[0].meta is not None:
+        meta = np.stack([r.meta for r in requests])
+      # None for models without --generate_meta.
+      meta_inputs = None if meta_inputs[0] is None else np.concatenate(meta_inputs)
+      songs = self.generator.generate_batch(len(requests), songlength, np.concatenate(random_inputs), np.concatenate(initial_point), meta, meta_inputs)
+      self.batches += 1
+      self.songs += len(requests)
+      for r,song in zip(requests, songs):
+        r.song = song[:r.songlength]
+    except Exception as e:
+      for r in requests:
+        r.error = e
+    for r in requests:
+      r.event.set()
+
+def midi_bytes(loader, song_data):
+  """The contents of a .mid file of song_data, [songlength, num_song_features]."""
+  return loader.get_midi_file_bytes(loader.get_midi_event_arrays([song_data])[0])
+
+class GenerationRequestHandler(BaseHTTPRequestHandler):
+  # Set by serve().
+  batcher = None
+
+  def do_GET(self):
+    url = urlparse(self.path)
+    if url.path == '/health':
+      self._respond(200, 'text/plain', b'ok\n')
+      return
+    if url.path != '/generate':
+      self._respond(404, 'text/plain', b'Not found.\n')
+      return
+    generator = self.batcher.generator
+    try:
+      params = dict((k,v[0]) for k,v in parse_qs(url.query).items())
+      songlength = int(params.get('songlength', generator.config['songlength']))
+      if songlength < 1 or songlength > FLAGS.max_songlength:
+        raise ValueError('songlength must be in 1..{}.'.format(FLAGS.max_songlength))
+      seed = int(params['seed']) if 'seed' in params else None
+      meta = None
+      if 'genre' in params or 'composer' in params:
+        if not generator.config.get('generate_meta'):
+          raise ValueError('Conditioning needs a model trained with --generate_meta.')
+        meta = generator.meta(params.get('genre'), params.get('composer'))
+    except ValueError as e:
+      self._respond(400, 'text/plain', '{}\n'.format(e).encode('utf-8'))
+      return
+    try:
+      song = self.batcher.generate(songlength, seed, meta)
+      body = midi_bytes(generator.loader, song)
+    except Exception as e:
+      print('Generation failed: {}'.format(e))
+      self._respond(500, 'text/plain', 'Generation failed: {}\n'.format(e).encode('utf-8'))
+      return
+    self._respond(200, 'audio/midi', body)
+
+  def _respond(self, code, content_type, body):
+    self.send_response(code)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+def serve(export_dir, host, port, max_batch_size=0, max_latency=0.02):
+  generator = ExportedGenerator(export_dir)
+  # Warm up, so the first request does not pay for graph setup.
+  generator.generate(1, 1)
+  GenerationRequestHandler.batcher = GenerationBatcher(generator, max_batch_size or generator.max_batch_size, max_latency)
+  server = ThreadingHTTPServer((host, port), GenerationRequestHandler)
+  print('Serving generated midi on http://{}:{}/generate'.format(host, port))
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+    generator.close()
+
+def main(_):
+  if not FLAGS.export_dir:
+    raise ValueError("Must set --export_dir to an exported generator.")
+  serve(FLAGS.export_dir, FLAGS.host, FLAGS.port, FLAGS.max_batch_size, FLAGS.max_latency_ms/1000.0)
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -0,0 +1,91 @@
+# Load test for generation_server.py.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+
+Sends num_requests generate requests to a running generation_server.py,
+concurrency at a time, and reports latency percentiles and songs/s.
+
+$ python load_test_generation_server.py http://127.0.0.1:8000 [num_requests] [concurrency] [songlength]
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys, threading, time
+from urllib.request import urlopen
+
+import numpy as np
+
+def load_test(url, num_requests=200, concurrency=16, songlength=None):
+  """
+  Returns a dict with the number of requests, errors, midi bytes received,
+  latency percentiles (seconds) and songs/s over the whole test.
+  """
+  generate_url = '{}/generate'.format(url.rstrip('/'))
+  if songlength is not None:
+    generate_url += '?songlength={}'.format(songlength)
+  latencies = []
+  errors = [0]
+  num_bytes = [0]
+  lock = threading.Lock()
+  remaining = [num_requests]
+
+  def worker():
+    while True:
+      with lock:
+        if remaining[0] == 0:
+          return
+        remaining[0] -= 1
+      start_time = time.time()
+      try:
+        body = urlopen(generate_url).read()
+      except Exception as e:
+        print('Request failed: {}'.format(e))
+        with lock:
+          errors[0] += 1
+        continue
+      latency = time.time()-start_time
+      with lock:
+        latencies.append(latency)
+        num_bytes[0] += len(body)
+
+  start_time = time.time()
+  threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  total_time = time.time()-start_time
+  results = {'requests': num_requests, 'errors': errors[0], 'bytes': num_bytes[0], 'seconds': total_time,
+             'songs_per_s': len(latencies)/total_time}
+  if latencies:
+    results['p50'], results['p90'], results['p99'] = np.percentile(latencies, [50, 90, 99])
+  return results
+
+def main():
+  url = sys.argv[1]
+  num_requests = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+  concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+  songlength = int(sys.argv[4]) if len(sys.argv) > 4 else None
+  results = load_test(url, num_requests, concurrency, songlength)
+  print('Requests: {}, errors: {}, concurrency: {}.'.format(results['requests'], results['errors'], concurrency))
+  if 'p50' in results:
+    print('Latency: p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms.'.format(1000*results['p50'], 1000*results['p90'], 1000*results['p99']))
+  print('Throughput: {:.2f} songs/s ({:.1f} s total, {} bytes of midi).'.format(results['songs_per_s'], results['seconds'], results['bytes']))
+
+if __name__ == "__main__":
+  main()
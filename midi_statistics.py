@@ -17,7 +17,8 @@
 # ==============================================================================
 
 
-import sys, os, midi, math, string, time
+import sys, os, bisect, csv, midi, math, multiprocessing, random, string, time
+import numpy as np
 
 GENRE      = 0
 COMPOSER   = 1
@@ -70,194 +71,147 @@ tone_names = {}
 for tone_name in base_tones:
   tone_names[base_tones[tone_name]] = tone_name
 
+# Rows: (base tone, scale) in the order of base_tones and scale. Column
+# pc is 1 if pitch class pc is in that scale. As in the original
+# membership test, pc-base_tone is not wrapped around the octave, so
+# pitch classes below the base tone are never in its scales.
+scale_names = [(base_tone, scale_label) for base_tone in base_tones for scale_label in scale]
+scale_mask = np.array([[int(pc-base_tones[base_tone] in scale[scale_label]) for pc in range(12)] for base_tone,scale_label in scale_names], dtype=np.int64)
 
-def get_tones(midi_pattern):
+# One note (note on event with a velocity) per row of a note table.
+NOTE_TABLE_DTYPE = np.dtype([('abs_tick', np.int64), ('tone', np.int32), ('velocity', np.int32), ('channel', np.int32)])
+
+
+def get_note_table(midi_pattern):
   """
-  returns a dict of statistics, keys: [scale_distribution,
+  returns the notes of midi_pattern as an array of NOTE_TABLE_DTYPE, in
+  the order of the tracks and their events, walking the pattern once.
+
+  The statistics functions below all take it as notes=, so that
+  get_all_stats only walks the pattern once.
   """
-  
-  tones = []
-  
+  notes = []
   for track in midi_pattern:
+    abs_tick=0
     for event in track:
-      if type(event) == midi.events.SetTempoEvent:
-        pass # These are currently ignored
-      elif (type(event) == midi.events.NoteOffEvent) or \
-           (type(event) == midi.events.NoteOnEvent and \
-            event.velocity == 0):
-        pass # not needed here
-      elif type(event) == midi.events.NoteOnEvent:
-        tones.append(event.data[0])
-  return tones 
-
-def detect_beat(midi_pattern):
+      abs_tick += event.tick
+      # Tempo events are currently ignored, and note offs (or note ons
+      # with velocity 0) are not needed.
+      if type(event) == midi.events.NoteOnEvent and event.velocity != 0:
+        notes.append((abs_tick, event.data[0], event.velocity, event.channel))
+  return np.array(notes, dtype=NOTE_TABLE_DTYPE)
+
+def get_tones(midi_pattern, notes=None):
+  """
+  returns the tones of the notes in midi_pattern, in track order.
+  """
+  if notes is None:
+    notes = get_note_table(midi_pattern)
+  return notes['tone'].tolist()
+
+def detect_beat(midi_pattern, notes=None):
   """
   returns a dict of statistics, keys: [scale_distribution,
   """
-  
-  abs_ticks = []
+  if notes is None:
+    notes = get_note_table(midi_pattern)
   
   # Tempo:
   ticks_per_quarter_note = float(midi_pattern.resolution)
   
-  for track in midi_pattern:
-    abs_tick=0
-    for event in track:
-      abs_tick += event.tick
-      if type(event) == midi.events.SetTempoEvent:
-        pass # These are currently ignored
-      elif (type(event) == midi.events.NoteOffEvent) or \
-           (type(event) == midi.events.NoteOnEvent and \
-            event.velocity == 0):
-        pass
-      elif type(event) == midi.events.NoteOnEvent:
-        abs_ticks.append(abs_tick)
+  abs_ticks = notes['abs_tick']
   stats = {}
   for quarter_note_estimate in range(int(ticks_per_quarter_note), int(0.75*ticks_per_quarter_note), -1):
     #print('est: {}'.format(quarter_note_estimate))
-    avg_ticks_off = []
-    for begin_tick in range(quarter_note_estimate):
-      ticks_off = []
-      for abs_tick in abs_ticks:
-        #print('abs_tick: {} % {}'.format(abs_tick, quarter_note_estimate/4))
-        sixteenth_note_estimate = quarter_note_estimate//4
-        ticks_off_sixteenths = int((begin_tick+abs_tick)%sixteenth_note_estimate)
-        if ticks_off_sixteenths > sixteenth_note_estimate//2:
-          # off, but before beat 
-          ticks_off_sixteenths = -(ticks_off_sixteenths-sixteenth_note_estimate)
-        #print('ticks_off: {}'.format(ticks_off_sixteenths))
-        ticks_off.append(ticks_off_sixteenths)
-      avg_ticks_off.append(float(sum(ticks_off))/float(len(ticks_off)))
-      #print('avg_ticks_off: {}. min: {}.'.format(avg_ticks_off, min(avg_ticks_off)))
-    stats[quarter_note_estimate] = min(avg_ticks_off)
+    sixteenth_note_estimate = quarter_note_estimate//4
+    # How far each residue (tick modulo a sixteenth) is from the beat,
+    # after the beat or, past half a sixteenth, before it.
+    residues = np.arange(sixteenth_note_estimate)
+    ticks_off_residue = np.where(residues > sixteenth_note_estimate//2, sixteenth_note_estimate-residues, residues)
+    # The ticks off only depend on the residues of the note onsets, and
+    # on the phase (begin_tick) modulo a sixteenth, which all
+    # begin_tick in range(quarter_note_estimate) cover.
+    residue_counts = np.bincount(abs_ticks%sixteenth_note_estimate, minlength=sixteenth_note_estimate)
+    shifted_residues = (residues[:,np.newaxis]+residues[np.newaxis,:])%sixteenth_note_estimate
+    # Total ticks off for each phase.
+    ticks_off = ticks_off_residue[shifted_residues].dot(residue_counts)
+    stats[quarter_note_estimate] = float(ticks_off.min())/float(len(abs_ticks))
   return stats
 
-def get_abs_ticks(midi_pattern):
-  abs_ticks = []
-  for track in midi_pattern:
-    abs_tick=0
-    for event in track:
-      abs_tick += event.tick
-      if type(event) == midi.events.SetTempoEvent:
-        pass # These are currently ignored
-      elif (type(event) == midi.events.NoteOffEvent) or \
-           (type(event) == midi.events.NoteOnEvent and \
-            event.velocity == 0):
-        pass
-      elif type(event) == midi.events.NoteOnEvent:
-        abs_ticks.append(abs_tick)
-  abs_ticks.sort()
-  return abs_ticks
-
-def get_top_k_intervals(midi_pattern, k):
+def get_abs_ticks(midi_pattern, notes=None):
   """
-  returns a fraction of the noteon events in midi_pattern that are polyphonous
-  (several notes occurring at the same time).
-  Here, two note on events are counted as the same event if they
-  occur at the same time, and in this case it is considered a polyphonous event.
+  returns the sorted absolute ticks of the notes in midi_pattern.
+  """
+  if notes is None:
+    notes = get_note_table(midi_pattern)
+  return np.sort(notes['abs_tick']).tolist()
+
+def get_top_k_intervals(midi_pattern, k, notes=None):
+  """
+  returns the k most common intervals between consecutive note ons
+  (the first from tick 0) in midi_pattern, with the fraction of note ons
+  after each. Ties are in the order the intervals first occur.
   """
-  intervals = {}
-  abs_ticks = get_abs_ticks(midi_pattern)
-  accumulator = 0
-  last_abs_tick = 0
-  for abs_tick in abs_ticks:
-    interval = abs_tick-last_abs_tick
-    if interval not in intervals:
-      intervals[interval] = 0
-    intervals[interval] += 1
-    accumulator += 1
-    last_abs_tick = abs_tick
-  intervals_list = [(interval, intervals[interval]/float(accumulator)) for interval in intervals]
+  abs_ticks = np.sort(get_note_table(midi_pattern)['abs_tick'] if notes is None else notes['abs_tick'])
+  if not len(abs_ticks):
+    return []
+  intervals, first_index, counts = np.unique(np.diff(abs_ticks, prepend=0), return_index=True, return_counts=True)
+  order = np.argsort(first_index, kind='stable')
+  intervals_list = [(interval, count/float(len(abs_ticks))) for interval,count in zip(intervals[order].tolist(), counts[order].tolist())]
   intervals_list.sort(key=lambda i: i[1], reverse=True)
   return intervals_list[:k]
 
 
-def get_polyphony_score(midi_pattern):
+def get_polyphony_score(midi_pattern, notes=None):
   """
   returns a fraction of the noteon events in midi_pattern that are polyphonous
   (several notes occurring at the same time).
   Here, two note on events are counted as the same event if they
   occur at the same time, and in this case it is considered a polyphonous event.
   """
-  
-  abs_ticks = get_abs_ticks(midi_pattern)
-  monophonous_events = 0
-  polyphonous_events = 0
-  
-  last_abs_tick = 0
-  tones_in_current_event = 0
-  for abs_tick in abs_ticks:
-    if abs_tick == last_abs_tick:
-      tones_in_current_event += 1
-    else:
-      if tones_in_current_event == 1:
-        monophonous_events += 1
-      elif tones_in_current_event > 1:
-        polyphonous_events += 1
-      tones_in_current_event = 1
-    last_abs_tick = abs_tick
-    if tones_in_current_event == 1:
-      monophonous_events += 1
-    elif tones_in_current_event > 1:
-      polyphonous_events += 1
+  abs_ticks = np.sort(get_note_table(midi_pattern)['abs_tick'] if notes is None else notes['abs_tick'])
+  if not len(abs_ticks):
+    return 0.0
+  # Note ons at the same tick form one event. Notes at tick 0 continue
+  # the event before the first note (so that the first note is counted
+  # as starting an event either way).
+  event_starts = np.flatnonzero(np.diff(abs_ticks, prepend=0) != 0)
+  if not len(event_starts) or event_starts[0] != 0:
+    event_starts = np.concatenate([[0], event_starts])
+  tones_in_events = np.diff(np.append(event_starts, len(abs_ticks)))
+  # Each note on is counted, as monophonous if it is the first in its
+  # event and as polyphonous otherwise, and so is each event but the last
+  # once the next one starts, by its number of tones.
+  monophonous_events = len(event_starts)+np.count_nonzero(tones_in_events[:-1] == 1)
+  polyphonous_events = (len(abs_ticks)-len(event_starts))+np.count_nonzero(tones_in_events[:-1] > 1)
   if polyphonous_events == 0:
     return 0.0
   return float(polyphonous_events)/(polyphonous_events+monophonous_events)
 
 
-def get_rhythm_stats(midi_pattern):
+def get_rhythm_stats(midi_pattern, notes=None):
   """
-  returns a dict of statistics, keys: [scale_distribution,
+  returns a dict from ticks since the last quarter note to the number of
+  note ons at that tick.
   """
-  
-  abs_ticks = []
+  if notes is None:
+    notes = get_note_table(midi_pattern)
   
   # Tempo:
   ticks_per_quarter_note = float(midi_pattern.resolution)
   
-  # Multiply with output_ticks_pr_input_tick for output ticks.
-  for track in midi_pattern:
-    abs_tick=0
-    for event in track:
-      abs_tick += event.tick
-      if type(event) == midi.events.SetTempoEvent:
-        pass # These are currently ignored
-      elif (type(event) == midi.events.NoteOffEvent) or \
-           (type(event) == midi.events.NoteOnEvent and \
-            event.velocity == 0):
-        pass
-      elif type(event) == midi.events.NoteOnEvent:
-        abs_ticks.append(abs_tick)
-  stats = {}
-  for abs_tick in abs_ticks:
-    ticks_since_quarter_note = int(abs_tick%ticks_per_quarter_note)
-    if ticks_since_quarter_note not in stats:
-      stats[ticks_since_quarter_note] = 1
-    else:
-      stats[ticks_since_quarter_note] += 1
-  return stats
+  ticks_since_quarter_note = (notes['abs_tick']%ticks_per_quarter_note).astype(np.int64)
+  values, counts = np.unique(ticks_since_quarter_note, return_counts=True)
+  return dict(zip(values.tolist(), counts.tolist()))
 
 
-def get_intensities(midi_pattern):
+def get_intensities(midi_pattern, notes=None):
   """
-  returns a dict of statistics, keys: [scale_distribution,
+  returns (min, max) of the velocities of the notes in midi_pattern.
   """
-  
-  intensities = []
-  
-  for track in midi_pattern:
-    abs_tick=0
-    for event in track:
-      abs_tick += event.tick
-      if type(event) == midi.events.SetTempoEvent:
-        pass # These are currently ignored
-      elif (type(event) == midi.events.NoteOffEvent) or \
-           (type(event) == midi.events.NoteOnEvent and \
-            event.velocity == 0):
-        pass
-      elif type(event) == midi.events.NoteOnEvent:
-        intensities.append(event.velocity)
-  return (min(intensities), max(intensities))
+  if notes is None:
+    notes = get_note_table(midi_pattern)
+  return (int(notes['velocity'].min()), int(notes['velocity'].max()))
 
 
 def get_midi_pattern(filename):
@@ -287,33 +241,55 @@ def tones_to_scales(tones):
 
    One octave is 12 tones.
   """
-  counts = {}
-  for base_tone in base_tones:
-    counts[base_tone] = {}
-    counts[base_tone]['major'] = 0
-    counts[base_tone]['natural_minor'] = 0
-    counts[base_tone]['harmonic_minor'] = 0
-
-  if not len(tones):
-    frequencies = {}
-    for base_tone in base_tones:
-      frequencies[base_tone] = {}
-      for scale_label in scale:
-        frequencies[base_tone][scale_label] = 0.0
-    return frequencies
-  for tone in tones:
-    for base_tone in base_tones:
-      for scale_label in scale:
-        if tone%12-base_tones[base_tone] in scale[scale_label]:
-          counts[base_tone][scale_label] += 1
+  counts = scale_counts(pitch_class_histogram(tones)).tolist()
   frequencies = {}
-  for base_tone in counts:
-    frequencies[base_tone] = {}
-    for scale_label in counts[base_tone]:
-      frequencies[base_tone][scale_label] = float(counts[base_tone][scale_label])/float(len(tones))
+  for (base_tone,scale_label),count in zip(scale_names, counts):
+    if base_tone not in frequencies:
+      frequencies[base_tone] = {}
+    frequencies[base_tone][scale_label] = float(count)/float(len(tones)) if len(tones) else 0.0
   return frequencies
 
+def pitch_class_histogram(tones):
+  """
+  returns the number of tones of each pitch class (tone%12), [12].
+  """
+  return np.bincount(np.mod(np.asarray(tones, dtype=np.int64), 12), minlength=12)
+
+def scale_counts(histograms):
+  """
+  returns the number of tones in each scale of scale_names, [..., 36],
+  from pitch class histograms, [..., 12]. For a batch of songs, this is
+  one matrix product.
+  """
+  return np.dot(histograms, scale_mask.T)
+
 def repetitions(tones):
+  """
+  For each window length l in 2..9 (below half the song), counts the pairs
+  of non-overlapping windows of l tones that are equal. (Windows start at
+  most len(tones)-l-1, so the last tone is never part of one.)
+
+  Windows are grouped by their tones, so each window is hashed once per
+  length, and the pairs in a group are counted by bisecting its sorted
+  start positions: O(n log n) per length, instead of comparing all pairs.
+  The counts are those of _repetitions_pairwise().
+  """
+  rs = {}
+  for l in range(2, min(len(tones)//2, 10)):
+    positions = {}
+    for i in range(len(tones)-l):
+      positions.setdefault(tuple(tones[i:i+l]), []).append(i)
+    count = 0
+    for starts in positions.values():
+      # starts is increasing. Pairs (i, j) with j-i >= l do not overlap.
+      for j in starts[1:]:
+        count += bisect.bisect_right(starts, j-l)
+    if count:
+      rs[l] = count
+  return rs
+
+def _repetitions_pairwise(tones):
+  """The original, quadratic, repetitions(). Used by benchmark_repetitions()."""
   rs = {}
   #print(tones)
   #print(len(tones)/2)
@@ -332,6 +308,34 @@ def repetitions(tones):
   return rs2
       
 
+def benchmark_repetitions(songlengths=(1000, 2000, 5000, 10000, 20000, 50000), max_pairwise_songlength=5000):
+  """
+  Times repetitions() on random songs of songlengths tones, and checks it
+  against _repetitions_pairwise() (too slow beyond max_pairwise_songlength).
+  """
+  rng = random.Random(0)
+  for songlength in songlengths:
+    # Random tones from a small range, with repeated phrases, like music.
+    tones = []
+    while len(tones) < songlength:
+      if tones and rng.random() < 0.3:
+        start = rng.randint(0, len(tones)-1)
+        tones.extend(tones[start:start+rng.randint(2, 12)])
+      else:
+        tones.append(rng.randint(55, 75))
+    tones = tones[:songlength]
+    start_time = time.time()
+    rs = repetitions(tones)
+    hashed_time = time.time()-start_time
+    if songlength <= max_pairwise_songlength:
+      start_time = time.time()
+      rs_pairwise = _repetitions_pairwise(tones)
+      pairwise_time = time.time()-start_time
+      assert rs == rs_pairwise, 'repetitions() differs from _repetitions_pairwise() on {} tones.'.format(songlength)
+      print('{} tones: {:.4f} s, pairwise: {:.2f} s ({:.0f}x).'.format(songlength, hashed_time, pairwise_time, pairwise_time/max(hashed_time, 1e-9)))
+    else:
+      print('{} tones: {:.4f} s.'.format(songlength, hashed_time))
+
 def tone_to_tone_name(tone):
   """
    Midi to tone name (octave: -5):
@@ -356,13 +360,26 @@ def tone_to_tone_name(tone):
   return '{} {}'.format(base_tone, octave)
 
 def max_likelihood_scale(tones):
-  scale_statistics = tones_to_scales(tones) 
-  stat_list = []
-  for base_tone in scale_statistics:
-    for scale_label in scale_statistics[base_tone]:
-      stat_list.append((base_tone, scale_label, scale_statistics[base_tone][scale_label]))
-  stat_list.sort(key=lambda e: e[2], reverse=True)
-  return (stat_list[0][0]+' '+stat_list[0][1], stat_list[0][2])
+  """
+  returns (name, frequency) of the scale with the most of the tones in it.
+  Of equally likely scales, the first in scale_names is chosen.
+  """
+  return max_likelihood_scales([tones])[0]
+
+def max_likelihood_scales(songs_tones):
+  """
+  max_likelihood_scale for each of songs_tones (a list of lists of tones),
+  with the scale counts of all songs from one matrix product.
+  """
+  histograms = np.array([pitch_class_histogram(tones) for tones in songs_tones]).reshape([len(songs_tones), 12])
+  counts = scale_counts(histograms)
+  results = []
+  for tones,song_counts in zip(songs_tones, counts):
+    # argmax picks the first of equal counts.
+    base_tone, scale_label = scale_names[int(np.argmax(song_counts))]
+    frequency = float(song_counts.max())/float(len(tones)) if len(tones) else 0.0
+    results.append((base_tone+' '+scale_label, frequency))
+  return results
 
 def tone_to_freq(tone):
   """
@@ -395,12 +412,17 @@ def freq_to_tone(freq):
 def cents_to_pitchwheel_units(cents):
   return int(40.96*(float(cents)))
 
+# The statistics of get_all_stats that are written out (gnuplot, corpus CSV).
+STATS_KEYS_STRING = ['scale']
+STATS_KEYS = ['scale_score', 'tone_min', 'tone_max', 'tone_span', 'freq_min', 'freq_max', 'freq_span', 'tones_unique', 'repetitions_2', 'repetitions_3', 'repetitions_4', 'repetitions_5', 'repetitions_6', 'repetitions_7', 'repetitions_8', 'repetitions_9', 'estimated_beat', 'estimated_beat_avg_ticks_off', 'intensity_min', 'intensity_max', 'intensity_span', 'polyphony_score', 'top_2_interval_difference', 'top_3_interval_difference', 'num_tones']
+
 def get_all_stats(midi_pattern):
   stats = {}
   if not midi_pattern:
     print('Failed to read midi pattern.')
     return None
-  tones = get_tones(midi_pattern)
+  notes = get_note_table(midi_pattern)
+  tones = get_tones(midi_pattern, notes)
   if len(tones) == 0:
     print('This is an empty song.')
     return None
@@ -423,7 +445,7 @@ def get_all_stats(midi_pattern):
   stats['scale'] = ml[0]
   stats['scale_score'] = ml[1]
   
-  beat_stats = detect_beat(midi_pattern)
+  beat_stats = detect_beat(midi_pattern, notes)
   minval = float(midi_pattern.resolution)
   argmin = -1
   for beat in beat_stats:
@@ -433,13 +455,13 @@ def get_all_stats(midi_pattern):
       argmin = beat
   stats['estimated_beat'] = argmin
   stats['estimated_beat_avg_ticks_off'] = minval
-  (min_int, max_int) = get_intensities(midi_pattern)
+  (min_int, max_int) = get_intensities(midi_pattern, notes)
   stats['intensity_min'] = min_int
   stats['intensity_max'] = max_int
   stats['intensity_span'] = max_int-min_int
 
-  stats['polyphony_score'] = get_polyphony_score(midi_pattern)
-  stats['top_10_intervals'] = get_top_k_intervals(midi_pattern, 10)
+  stats['polyphony_score'] = get_polyphony_score(midi_pattern, notes)
+  stats['top_10_intervals'] = get_top_k_intervals(midi_pattern, 10, notes)
   stats['top_2_interval_difference'] = 0.0
   if len(stats['top_10_intervals']) > 1:
     stats['top_2_interval_difference'] = abs(stats['top_10_intervals'][1][0]-stats['top_10_intervals'][0][0])
@@ -457,8 +479,8 @@ def get_gnuplot_line(midi_patterns, i, showheader=True):
     stats.append(get_all_stats(p))
   print('done. time: {}'.format(time.time()-stats_time))
   #print(stats)
-  stats_keys_string = ['scale']
-  stats_keys = ['scale_score', 'tone_min', 'tone_max', 'tone_span', 'freq_min', 'freq_max', 'freq_span', 'tones_unique', 'repetitions_2', 'repetitions_3', 'repetitions_4', 'repetitions_5', 'repetitions_6', 'repetitions_7', 'repetitions_8', 'repetitions_9', 'estimated_beat', 'estimated_beat_avg_ticks_off', 'intensity_min', 'intensity_max', 'intensity_span', 'polyphony_score', 'top_2_interval_difference', 'top_3_interval_difference', 'num_tones']
+  stats_keys_string = STATS_KEYS_STRING
+  stats_keys = STATS_KEYS
   gnuplotline = ''
   if showheader:
     gnuplotline = '# global-step {} {}\n'.format(' '.join([s.replace(' ', '_') for s in stats_keys_string]), ' '.join(stats_keys))
@@ -466,9 +488,143 @@ def get_gnuplot_line(midi_patterns, i, showheader=True):
   return gnuplotline
 
 
+CORPUS_KEYS = ['genre', 'composer', 'filename']
+
+def open_csv(filename, mode):
+  """Opens filename for the csv module, on python 2 and 3."""
+  if sys.version_info[0] < 3:
+    return open(filename, mode+'b')
+  return open(filename, mode, newline='')
+
+def get_corpus_files(datadir):
+  """
+  returns (genre, composer, filename) for each file in datadir, laid out as
+  by music_data_utils: a subdir per genre, and a subsubdir per composer.
+  """
+  files = []
+  for genre in sorted(os.listdir(datadir)):
+    if not os.path.isdir(os.path.join(datadir, genre)):
+      continue
+    for composer in sorted(os.listdir(os.path.join(datadir, genre))):
+      composer_dir = os.path.join(datadir, genre, composer)
+      if not os.path.isdir(composer_dir):
+        continue
+      for filename in sorted(os.listdir(composer_dir)):
+        if os.path.isfile(os.path.join(composer_dir, filename)):
+          files.append((genre, composer, filename))
+  return files
+
+def corpus_stats_job(job):
+  """
+  Worker of corpus_stats: returns the CSV row of one file. The statistics
+  are left empty when they can not be extracted.
+  """
+  datadir, genre, composer, filename = job
+  row = {'genre': genre, 'composer': composer, 'filename': filename}
+  try:
+    stats = get_all_stats(get_midi_pattern(os.path.join(datadir, genre, composer, filename)))
+  except Exception as e:
+    print('Failed to get stats for {}: {}'.format(os.path.join(genre, composer, filename), e))
+    stats = None
+  if stats is not None:
+    for key in STATS_KEYS_STRING+STATS_KEYS:
+      row[key] = stats[key]
+  return row
+
+class CorpusStatsAggregator(object):
+  """
+  Running means of the statistics in corpus CSV rows, over the whole corpus,
+  per genre and per composer, updated one row at a time.
+  """
+  def __init__(self):
+    self.groups = {}
+
+  def add(self, row):
+    for group in [('all', '', ''), ('genre', row['genre'], ''), ('composer', row['genre'], row['composer'])]:
+      if group not in self.groups:
+        self.groups[group] = {'files': 0, 'songs': 0, 'sums': dict((key, 0.0) for key in STATS_KEYS)}
+      aggregate = self.groups[group]
+      aggregate['files'] += 1
+      if row.get('num_tones') not in (None, ''):
+        aggregate['songs'] += 1
+        for key in STATS_KEYS:
+          aggregate['sums'][key] += float(row[key])
+
+  def rows(self):
+    rows = []
+    for group in sorted(self.groups):
+      aggregate = self.groups[group]
+      row = {'level': group[0], 'genre': group[1], 'composer': group[2], 'files': aggregate['files'], 'songs': aggregate['songs']}
+      for key in STATS_KEYS:
+        row[key] = aggregate['sums'][key]/aggregate['songs'] if aggregate['songs'] else ''
+      rows.append(row)
+    return rows
+
+  def save(self, filename):
+    with open_csv(filename, 'w') as f:
+      writer = csv.DictWriter(f, ['level', 'genre', 'composer', 'files', 'songs']+STATS_KEYS)
+      writer.writeheader()
+      for row in self.rows():
+        writer.writerow(row)
+
+def corpus_stats(datadir, filename, num_workers=None):
+  """
+  Computes get_all_stats for every file in datadir (see get_corpus_files),
+  on num_workers processes (default: one per cpu). Each file's statistics
+  are appended to the CSV filename as soon as they are done, so an
+  interrupted run resumes where it stopped: files already in filename are
+  skipped. The means per genre and per composer, over all rows of
+  filename, are written to filename with -aggregates before the
+  extension, and returned (CorpusStatsAggregator).
+  """
+  aggregator = CorpusStatsAggregator()
+  done = set()
+  if os.path.exists(filename):
+    # A line cut off by an interruption is dropped, and done again.
+    with open(filename, 'rb') as f:
+      contents = f.read()
+    if not contents.endswith(b'\n'):
+      with open(filename, 'wb') as f:
+        f.write(contents[:contents.rfind(b'\n')+1])
+    with open_csv(filename, 'r') as f:
+      for row in csv.DictReader(f):
+        done.add((row['genre'], row['composer'], row['filename']))
+        aggregator.add(row)
+  jobs = [(datadir, genre, composer, f) for genre, composer, f in get_corpus_files(datadir) if (genre, composer, f) not in done]
+  print('Getting stats for {} files ({} already done).'.format(len(jobs), len(done)))
+  start_time = time.time()
+  pool = multiprocessing.Pool(num_workers or multiprocessing.cpu_count())
+  try:
+    write_header = not os.path.exists(filename) or not os.path.getsize(filename)
+    with open_csv(filename, 'a') as f:
+      writer = csv.DictWriter(f, CORPUS_KEYS+STATS_KEYS_STRING+STATS_KEYS)
+      if write_header:
+        writer.writeheader()
+      for n,row in enumerate(pool.imap_unordered(corpus_stats_job, jobs)):
+        writer.writerow(row)
+        f.flush()
+        aggregator.add(row)
+        if n % 100 == 99:
+          print('Stats: {}/{} files, {:.1f} files/s.'.format(n+1, len(jobs), (n+1)/max(time.time()-start_time, 1e-6)))
+  finally:
+    pool.terminate()
+    pool.join()
+    aggregates_filename = '{}-aggregates{}'.format(*os.path.splitext(filename))
+    aggregator.save(aggregates_filename)
+  print('Done in {:.1f} s. Stats in {}, aggregates in {}.'.format(time.time()-start_time, filename, aggregates_filename))
+  return aggregator
+
 
 def main():
-  if len(sys.argv) > 2 and sys.argv[1] == '--gnuplot':
+  if len(sys.argv) > 1 and sys.argv[1] == '--benchmark_repetitions':
+    benchmark_repetitions()
+  elif len(sys.argv) > 3 and sys.argv[1] == '--corpus':
+    # midi_statistics.py --corpus datadir stats.csv [num_workers]
+    aggregator = corpus_stats(sys.argv[2], sys.argv[3], int(sys.argv[4]) if len(sys.argv) > 4 else None)
+    for row in aggregator.rows():
+      if row['level'] != 'composer':
+        print('{}: {} files, {} songs. Scale consistency: {}, tone span: {}, polyphony: {}.'.format(row['genre'] or 'All', row['files'], row['songs'], row['scale_score'], row['tone_span'], row['polyphony_score']))
+  elif len(sys.argv) > 2 and sys.argv[1] == '--gnuplot':
     #number = sys.argv[2]
     patterns = []
     for i in range(3,len(sys.argv)):
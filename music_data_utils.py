@@ -18,7 +18,8 @@
 
 from urllib.parse import urlparse
 from urllib.request import urlopen
-import os, midi, math, random, re, string, sys
+import os, heapq, midi, math, multiprocessing, queue, random, re, string, struct, sys, threading, time
+import pickle as pkl
 import numpy as np
 from io import BytesIO
 
@@ -35,8 +36,21 @@ VELOCITY   = 3
 # INDICES IN SONG DATA (NOT YET BATCHED):
 BEGIN_TICK = 0
 
+# Song data is stored as one [num_notes, NUM_FEATURES_PER_TONE+1] array per song,
+# columns indexed as above, rows sorted on BEGIN_TICK.
+SONG_DATA_DTYPE = np.float32
+
 NUM_FEATURES_PER_TONE = 3
 
+# One midi note event per row, as made by MusicDataLoader.get_midi_event_arrays().
+# tick is relative to the previous event, as in a midi track.
+MIDI_EVENT_DTYPE = np.dtype([('tick', np.int64), ('note_on', np.bool_), ('pitch', np.int32), ('velocity', np.int32)])
+
+# Parsed song_data is cached in datadir, see MusicDataLoader.read_data().
+# Bump the version whenever the format returned by read_one_file() changes.
+SONG_CACHE_FILENAME = 'song_data_cache.pkl'
+SONG_CACHE_VERSION  = 2
+
 debug = ''
 #debug = 'overfit'
 
@@ -677,11 +691,14 @@ file_list['test'] = ['classical/mozart/245div1.mid', \
 
 class MusicDataLoader(object):
 
-  def __init__(self, datadir, select_validation_percentage, select_test_percentage, works_per_composer=None, pace_events=False, synthetic=None, tones_per_cell=1, single_composer=None):
+  def __init__(self, datadir, select_validation_percentage, select_test_percentage, works_per_composer=None, pace_events=False, synthetic=None, tones_per_cell=1, single_composer=None, use_cache=True, num_workers=1):
     self.datadir = datadir
     self.output_ticks_per_quarter_note = 384.0
     self.tones_per_cell = tones_per_cell
     self.single_composer = single_composer
+    self.use_cache = use_cache
+    self.num_workers = num_workers
+    self.chord_groups = {}
     self.pointer = {}
     self.pointer['validation'] = 0
     self.pointer['test'] = 0
@@ -874,9 +891,10 @@ class MusicDataLoader(object):
         pace_tick = 0.0
         song_tick_length = song_data[-1][BEGIN_TICK]+song_data[-1][LENGTH]
         while pace_tick < song_tick_length:
-          song_data.append([0.0, 440.0, 0.0, pace_tick, 0.0])
-          pace_tick += float(ticks_per_quarter_note)/input_ticks_per_output_tick
+          song_data.append(pace_event(pace_tick))
+          pace_tick += float(ticks_per_quarter_note)
         song_data.sort(key=lambda e: e[BEGIN_TICK])
+      song_data = song_data_to_array(song_data)
       if self.datadir is not None and i==0:
         filename = os.path.join(self.datadir, '{}.mid'.format(i))
         if not os.path.exists(filename):
@@ -909,6 +927,8 @@ class MusicDataLoader(object):
 
     returns a list of tuples, [genre, composer, song_data]
     Also saves this list in self.songs.
+    song_data is a [num_notes, NUM_FEATURES_PER_TONE+1] array,
+    see song_data_to_array().
 
     Time steps will be fractions of beat notes (32th notes).
     """
@@ -943,7 +963,7 @@ class MusicDataLoader(object):
           if not os.path.exists(current_path):
             print ( 'Path does not exist: {}'.format(current_path))
             continue
-          files = os.listdir(current_path)
+          files = sorted(os.listdir(current_path))
           works_read = 0
           for i,f in enumerate(files):
             if os.path.isfile(os.path.join(current_path,f)):
@@ -971,6 +991,9 @@ class MusicDataLoader(object):
     # OVERFIT
     count = 0
 
+    # Collect the files first, in a fixed order, so that self.songs comes out
+    # the same no matter how many workers parse them.
+    jobs = []
     for genre in self.genres:
       # OVERFIT
       if debug == 'overfit' and count > 20: break
@@ -982,7 +1005,7 @@ class MusicDataLoader(object):
         if not os.path.exists(current_path):
           print ( 'Path does not exist: {}'.format(current_path))
           continue
-        files = os.listdir(current_path)
+        files = sorted(os.listdir(current_path))
         #composer_id += 1
         #if composer_id > max_composers:
         #  print (('Only using {} composers.'.format(max_composers))
@@ -995,19 +1018,50 @@ class MusicDataLoader(object):
           if works_per_composer is not None and i >= works_per_composer:
             break
           
-          if i % 100 == 99 or i+1 == len(files) or i+1 == works_per_composer:
-            print ( 'Reading files {}/{}: {}'.format(genre, composer, (i+1)))
           if os.path.isfile(os.path.join(current_path,f)):
-            song_data = self.read_one_file(current_path, f, pace_events)
-            if song_data is None:
-              continue
-            if os.path.join(os.path.join(genre, composer), f) in file_list['validation']:
-              self.songs['validation'].append([genre, composer, song_data])
-            elif os.path.join(os.path.join(genre, composer), f) in file_list['test']:
-              self.songs['test'].append([genre, composer, song_data])
-            else:
-              self.songs['train'].append([genre, composer, song_data])
+            jobs.append((genre, composer, f))
           #b0reak
+
+    read_start_time = time.time()
+    song_cache = self.load_song_cache()
+    songs_data = [self.get_cached_song(song_cache, os.path.join(genre, composer), f, pace_events) for genre, composer, f in jobs]
+    uncached = [j for j in range(len(jobs)) if songs_data[j] is False]
+    parse_jobs = [(os.path.join(self.datadir, os.path.join(jobs[j][0], jobs[j][1])), jobs[j][2], pace_events, self.output_ticks_per_quarter_note) for j in uncached]
+    print ( 'Reading {} files ({} from song cache, {} workers).'.format(len(jobs), len(jobs)-len(uncached), self.num_workers))
+    if self.num_workers > 1 and len(parse_jobs) > 1:
+      pool = multiprocessing.Pool(self.num_workers)
+      try:
+        parsed = pool.imap(read_one_file_job, parse_jobs, chunksize=8)
+        for n,(j,song_data) in enumerate(zip(uncached, parsed)):
+          if n % 100 == 99:
+            print ( 'Reading files: {}/{}'.format(n+1, len(uncached)))
+          songs_data[j] = song_data
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      for n,(j,parse_job) in enumerate(zip(uncached, parse_jobs)):
+        if n % 100 == 99:
+          print ( 'Reading files: {}/{}'.format(n+1, len(uncached)))
+        songs_data[j] = read_one_file_job(parse_job)
+    for j in uncached:
+      genre, composer, f = jobs[j]
+      self.set_cached_song(song_cache, os.path.join(genre, composer), f, pace_events, songs_data[j])
+    self.save_song_cache(song_cache)
+    read_time = time.time()-read_start_time
+    print ( 'Read {} files in {:.1f} s, {:.1f} files/s.'.format(len(jobs), read_time, len(jobs)/max(read_time, 1e-6)))
+
+    validation_files = set(file_list['validation'])
+    test_files = set(file_list['test'])
+    for (genre, composer, f),song_data in zip(jobs, songs_data):
+      if song_data is None:
+        continue
+      if os.path.join(os.path.join(genre, composer), f) in validation_files:
+        self.songs['validation'].append([genre, composer, song_data])
+      elif os.path.join(os.path.join(genre, composer), f) in test_files:
+        self.songs['test'].append([genre, composer, song_data])
+      else:
+        self.songs['train'].append([genre, composer, song_data])
     random.shuffle(self.songs['train'])
     self.pointer['validation'] = 0
     self.pointer['test'] = 0
@@ -1023,6 +1077,72 @@ class MusicDataLoader(object):
     #print (('lens: train: {}, val: {}, test: {}'.format(len(self.songs['train']), len(self.songs['validation']), len(self.songs['test'])))
     return self.songs
 
+  def load_song_cache(self):
+    """
+    load_song_cache returns the cache of parsed song_data stored in datadir,
+    as a dict {'version': SONG_CACHE_VERSION, 'entries': {relpath: (key, song_data)},
+    'modified': False}.
+    Returns an empty cache if caching is disabled, or if the file is missing,
+    unreadable or was written by another version of this code.
+    """
+    song_cache = {'version': SONG_CACHE_VERSION, 'entries': {}, 'modified': False}
+    if not self.use_cache:
+      return song_cache
+    cache_filename = os.path.join(self.datadir, SONG_CACHE_FILENAME)
+    if not os.path.exists(cache_filename):
+      return song_cache
+    try:
+      with open(cache_filename, 'rb') as f:
+        saved_cache = pkl.load(f)
+    except Exception as e:
+      print ( 'Error reading song cache {}: {}. Rebuilding.'.format(cache_filename, e))
+      return song_cache
+    if saved_cache.get('version') != SONG_CACHE_VERSION:
+      print ( 'Song cache {} has version {}, expected {}. Rebuilding.'.format(cache_filename, saved_cache.get('version'), SONG_CACHE_VERSION))
+      return song_cache
+    song_cache['entries'] = saved_cache['entries']
+    print ( 'Song cache: {} entries in {}'.format(len(song_cache['entries']), cache_filename))
+    return song_cache
+
+  def save_song_cache(self, song_cache):
+    """
+    save_song_cache writes song_cache back to datadir, if any entry changed.
+    The file is written to a temporary name first, so that an interrupted
+    run never leaves a truncated cache behind.
+    """
+    if not self.use_cache or not song_cache['modified']:
+      return
+    cache_filename = os.path.join(self.datadir, SONG_CACHE_FILENAME)
+    tmp_filename = cache_filename+'.tmp'
+    try:
+      with open(tmp_filename, 'wb') as f:
+        pkl.dump({'version': SONG_CACHE_VERSION, 'entries': song_cache['entries']}, f, protocol=pkl.HIGHEST_PROTOCOL)
+      os.replace(tmp_filename, cache_filename)
+      song_cache['modified'] = False
+      print ( 'Saved song cache: {} entries in {}'.format(len(song_cache['entries']), cache_filename))
+    except Exception as e:
+      print ( 'Error writing song cache {}: {}'.format(cache_filename, e))
+
+  def cache_key(self, reldir, filename, pace_events):
+    stat = os.stat(os.path.join(self.datadir, os.path.join(reldir, filename)))
+    return (stat.st_mtime, stat.st_size, bool(pace_events), self.output_ticks_per_quarter_note)
+
+  def get_cached_song(self, song_cache, reldir, filename, pace_events):
+    """
+    get_cached_song returns the song_data for datadir/reldir/filename from
+    song_cache if the file is unchanged (same mtime and size) and was
+    parsed with the same parameters. Files that failed to parse are cached
+    as None. Returns False on a cache miss.
+    """
+    entry = song_cache['entries'].get(os.path.join(reldir, filename))
+    if entry is not None and entry[0] == self.cache_key(reldir, filename, pace_events):
+      return entry[1]
+    return False
+
+  def set_cached_song(self, song_cache, reldir, filename, pace_events, song_data):
+    song_cache['entries'][os.path.join(reldir, filename)] = (self.cache_key(reldir, filename, pace_events), song_data)
+    song_cache['modified'] = True
+
   def read_one_file(self, path, filename, pace_events):
     try:
       if debug:
@@ -1128,20 +1248,40 @@ class MusicDataLoader(object):
         e[LENGTH] = float(ticks_per_quarter_note)/input_ticks_per_output_tick
         song_data.append(e)
     song_data.sort(key=lambda e: e[BEGIN_TICK])
-    if (pace_events):
+    if pace_events and song_data:
       pace_event_list = []
       pace_tick = 0.0
       song_tick_length = song_data[-1][BEGIN_TICK]+song_data[-1][LENGTH]
       while pace_tick < song_tick_length:
-        song_data.append([0.0, 440.0, 0.0, pace_tick, 0.0])
+        song_data.append(pace_event(pace_tick))
         pace_tick += float(ticks_per_quarter_note)/input_ticks_per_output_tick
       song_data.sort(key=lambda e: e[BEGIN_TICK])
-    return song_data
+    return song_data_to_array(song_data)
 
   def rewind(self, part='train'):
     self.pointer[part] = 0
 
-  def get_batch(self, batchsize, songlength, part='train'):
+  def iterate_batches(self, batchsize, songlength, part='train', prefetch=0, window_length=None):
+    """
+    iterate_batches rewinds part and yields the [genrecomposer, song_data]
+    batches from get_batch() until part is exhausted.
+
+    With prefetch > 0, a background thread prepares up to prefetch batches
+    ahead, so that batch construction overlaps with whatever the caller
+    does with the current batch (e.g. session.run). Batches come out in the
+    same order as without prefetching.
+    """
+    def batches():
+      self.rewind(part=part)
+      batch = self.get_batch(batchsize, songlength, part=part, window_length=window_length)
+      while batch[0] is not None:
+        yield batch
+        batch = self.get_batch(batchsize, songlength, part=part, window_length=window_length)
+    if prefetch <= 0:
+      return batches()
+    return prefetch_iterator(batches(), prefetch, name='batch-prefetch-{}'.format(part))
+
+  def get_batch(self, batchsize, songlength, part='train', window_length=None):
     """
       get_batch() returns a batch from self.songs, as a
       pair of tensors (genrecomposer, song_data).
@@ -1172,6 +1312,12 @@ class MusicDataLoader(object):
       
       A tone  has a feature telling us the pause before it.
 
+      window_length (default: songlength) is the number of events that
+      will be used from each song matrix. The random position in the
+      song is drawn for window_length events, so that a model that is fed
+      longer matrices but trains on their first window_length events
+      sees the same windows as one fed window_length events.
+
     """
     #print (('get_batch(): pointer: {}, len: {}, batchsize: {}'.format(self.pointer[part], len(self.songs[part]), batchsize))
     if self.pointer[part] > len(self.songs[part])-batchsize:
@@ -1179,68 +1325,78 @@ class MusicDataLoader(object):
     if self.songs[part]:
       batch = self.songs[part][self.pointer[part]:self.pointer[part]+batchsize]
       self.pointer[part] += batchsize
-      # subtract two for start-time and channel, which we don't include.
       num_meta_features = len(self.genres)+len(self.composers)
       # All features except timing are multiplied with tones_per_cell (default 1)
       num_song_features = NUM_FEATURES_PER_TONE*self.tones_per_cell+1
-      batch_genrecomposer = np.ndarray(shape=[batchsize, num_meta_features])
-      batch_songs = np.ndarray(shape=[batchsize, songlength, num_song_features])
-      #print ( 'batch shape: {}'.format(batch_songs.shape)
-      zeroframe = np.zeros(shape=[num_song_features])
+      batch_genrecomposer = np.zeros(shape=[batchsize, num_meta_features])
+      batch_songs = np.zeros(shape=[batchsize, songlength, num_song_features])
       for s in range(len(batch)):
-        songmatrix = np.ndarray(shape=[songlength, num_song_features])
-        composeronehot = onehot(self.composers.index(batch[s][1]), len(self.composers))
-        genreonehot = onehot(self.genres.index(batch[s][0]), len(self.genres))
-        genrecomposer = np.concatenate([genreonehot, composeronehot])
-        
+        batch_genrecomposer[s, self.genres.index(batch[s][0])] = 1
+        batch_genrecomposer[s, len(self.genres)+self.composers.index(batch[s][1])] = 1
         
         #random position:
+        if window_length is None:
+          window_length = songlength
         begin = 0
-        if len(batch[s][SONG_DATA]) > songlength*self.tones_per_cell:
-          begin = random.randint(0, len(batch[s][SONG_DATA])-songlength*self.tones_per_cell)
-        matrixrow = 0
-        n = begin
-        while matrixrow < songlength:
-          eventindex = 0
-          event = np.zeros(shape=[num_song_features])
-          if n < len(batch[s][SONG_DATA]):
-            event[LENGTH]   = batch[s][SONG_DATA][n][LENGTH]
-            event[FREQ]     = batch[s][SONG_DATA][n][FREQ]
-            event[VELOCITY] = batch[s][SONG_DATA][n][VELOCITY]
-            ticks_from_start_of_prev_tone = 0.0
-            if n>0:
-              # beginning of this tone, minus starting of previous
-              ticks_from_start_of_prev_tone = batch[s][SONG_DATA][n][BEGIN_TICK]-batch[s][SONG_DATA][n-1][BEGIN_TICK]
-              # we don't include start-time at index 0:
-              # and not channel at -1.
-            # tones are allowed to overlap. This is indicated with
-            # relative time zero in the midi spec.
-            event[TICKS_FROM_PREV_START] = ticks_from_start_of_prev_tone
-            tone_count = 1
-            for simultaneous in range(1,self.tones_per_cell):
-              if n+simultaneous >= len(batch[s][SONG_DATA]):
-                break
-              if batch[s][SONG_DATA][n+simultaneous][BEGIN_TICK]-batch[s][SONG_DATA][n][BEGIN_TICK] == 0:
-                offset = simultaneous*NUM_FEATURES_PER_TONE
-                event[offset+LENGTH]   = batch[s][SONG_DATA][n+simultaneous][LENGTH]
-                event[offset+FREQ]     = batch[s][SONG_DATA][n+simultaneous][FREQ]
-                event[offset+VELOCITY] = batch[s][SONG_DATA][n+simultaneous][VELOCITY]
-                tone_count += 1
-              else:
-                break
-          songmatrix[matrixrow,:] = event
-          matrixrow += 1
-          n += tone_count
-        #if s == 0 and self.pointer[part] == batchsize:
-        #  print ( songmatrix[0:10,:]
-        batch_genrecomposer[s,:] = genrecomposer
-        batch_songs[s,:,:] = songmatrix
-      #batched_sequence = np.split(batch_songs, indices_or_sections=songlength, axis=1)
-      #return [np.squeeze(s, axis=1) for s in batched_sequence]
-      #print (('batch returns [0:10]: {}'.format(batch_songs[0,0:10,:]))
+        if len(batch[s][SONG_DATA]) > window_length*self.tones_per_cell:
+          begin = random.randint(0, len(batch[s][SONG_DATA])-window_length*self.tones_per_cell)
+        self.fill_song_matrix(batch_songs[s], batch[s][SONG_DATA], begin)
       return [batch_genrecomposer, batch_songs]
     else:
       raise 'get_batch() called but self.songs is not initialized.'
+
+  def get_chord_groups(self, song_data):
+    """
+    get_chord_groups returns (run_end, row_starts) for song_data, computed
+    once per song and kept in self.chord_groups.
+
+    Simultaneous tones (equal BEGIN_TICK) form a chord group. run_end[n] is the
+    index just past the group that note n belongs to. row_starts are the
+    indices of the notes that begin a row in a song matrix read from the first
+    note: each group is split into rows of at most self.tones_per_cell tones.
+    """
+    entry = self.chord_groups.get(id(song_data))
+    if entry is not None and entry[0] is song_data:
+      return entry[1]
+    begin_ticks = song_data[:, BEGIN_TICK]
+    group_starts = np.flatnonzero(np.concatenate([[True], begin_ticks[1:] != begin_ticks[:-1]]))
+    group_lengths = np.diff(np.append(group_starts, len(song_data)))
+    run_end = np.repeat(group_starts+group_lengths, group_lengths)
+    rows_per_group = (group_lengths+self.tones_per_cell-1)//self.tones_per_cell
+    first_row_of_group = np.cumsum(rows_per_group)-rows_per_group
+    row_in_group = np.arange(rows_per_group.sum())-np.repeat(first_row_of_group, rows_per_group)
+    row_starts = np.repeat(group_starts, rows_per_group)+row_in_group*self.tones_per_cell
+    self.chord_groups[id(song_data)] = (song_data, (run_end, row_starts))
+    return (run_end, row_starts)
+
+  def fill_song_matrix(self, songmatrix, song_data, begin):
+    """
+    fill_song_matrix writes the song_data events starting at note begin into
+    songmatrix ([songlength, num_song_features], zero-initialized).
+
+    Each row holds one tone, plus up to tones_per_cell-1 following tones that
+    start at the same tick. TICKS_FROM_PREV_START is the distance from the
+    beginning of the previous note in song_data (zero within a chord, and for
+    the first note of the song). Rows after the end of the song stay zero.
+    """
+    if not len(song_data):
+      return
+    songlength = songmatrix.shape[0]
+    run_end, row_starts = self.get_chord_groups(song_data)
+    # begin may be in the middle of a chord group. Read the rest of that
+    # group, then continue with whole groups.
+    head = np.arange(begin, run_end[begin], self.tones_per_cell)
+    next_group = np.searchsorted(row_starts, run_end[begin])
+    rows = np.concatenate([head, row_starts[next_group:next_group+songlength]])[:songlength]
+    tones = rows[:,np.newaxis]+np.arange(self.tones_per_cell)[np.newaxis,:]
+    in_chord = tones < run_end[rows][:,np.newaxis]
+    tones = np.minimum(tones, len(song_data)-1)
+    for feature in [LENGTH, FREQ, VELOCITY]:
+      songmatrix[:len(rows), feature::NUM_FEATURES_PER_TONE] = np.where(in_chord, song_data[tones, feature], 0.0)
+    # tones are allowed to overlap. This is indicated with
+    # relative time zero in the midi spec.
+    prev_begin_ticks = song_data[np.maximum(rows-1, 0), BEGIN_TICK]
+    songmatrix[:len(rows), TICKS_FROM_PREV_START] = np.where(rows > 0, song_data[rows, BEGIN_TICK]-prev_begin_ticks, 0.0)
   
   def get_num_song_features(self):
     return NUM_FEATURES_PER_TONE*self.tones_per_cell+1
@@ -1305,59 +1461,187 @@ class MusicDataLoader(object):
     
     # Tempo:
     # Multiply with output_ticks_pr_input_tick for output ticks.
+    return self.midi_pattern_from_event_array(self.get_midi_event_arrays([song_data])[0])
+
+  def get_midi_event_arrays(self, songs_data):
+    """
+    get_midi_event_arrays takes a batch of songs in internal representation
+    (dimensions [batch_size, songlength, self.num_song_features]), and
+    returns, for each song, its note events as an array of MIDI_EVENT_DTYPE,
+    in track order: the events of get_midi_pattern(), without making any
+    midi objects. The conversion is done for the whole batch at once.
+    """
+    songs_data = np.asarray(songs_data, dtype=np.float64)
+    batch_size, songlength = songs_data.shape[:2]
+    tones_data = songs_data[:,:,1:1+self.tones_per_cell*NUM_FEATURES_PER_TONE].reshape([batch_size, songlength, self.tones_per_cell, NUM_FEATURES_PER_TONE])
+    # Features of each tone, [batch_size, songlength, tones_per_cell].
+    # Tones with non-finite features (from a diverged model) are skipped.
+    finite = np.all(np.isfinite(tones_data), axis=-1)
+    tones_data = np.where(finite[...,np.newaxis], tones_data, 0.0)
+    tick_len = np.round(tones_data[:,:,:,LENGTH-1]).astype(np.int64)
+    velocity = np.minimum(np.round(tones_data[:,:,:,VELOCITY-1]), 127).astype(np.int64)
+    freq = tones_data[:,:,:,FREQ-1]
+    tone, _ = freq_to_tone_array(freq)
+    valid = finite & (freq > 0.0) & (velocity > 0) & (tick_len > 0)
+    abs_tick_note_beginning = np.cumsum(songs_data[:,:,TICKS_FROM_PREV_START], axis=1)[:,:,np.newaxis]
+    # Note on, then note off, for each tone: [batch_size, songlength, tones_per_cell, 2],
+    # in the order get_midi_pattern() makes them.
+    abs_ticks = np.stack([np.broadcast_to(abs_tick_note_beginning, tick_len.shape), abs_tick_note_beginning+tick_len], axis=-1)
+    pitch = np.repeat(fold_tone_array(tone)[...,np.newaxis], 2, axis=-1)
+    event_velocity = np.stack([velocity, np.zeros_like(velocity)], axis=-1)
+    note_on = np.broadcast_to(np.array([True, False]), abs_ticks.shape)
+    valid = np.repeat(valid[...,np.newaxis], 2, axis=-1)
+    event_arrays = []
+    for i in range(batch_size):
+      song_valid = valid[i].ravel()
+      song_abs_ticks = abs_ticks[i].ravel()[song_valid]
+      order = np.argsort(song_abs_ticks, kind='stable')
+      song_abs_ticks = song_abs_ticks[order]
+      events = np.empty([len(order)], dtype=MIDI_EVENT_DTYPE)
+      events['tick'] = np.round(np.diff(song_abs_ticks, prepend=0.0))
+      events['note_on'] = note_on[i].ravel()[song_valid][order]
+      events['pitch'] = pitch[i].ravel()[song_valid][order]
+      events['velocity'] = event_velocity[i].ravel()[song_valid][order]
+      event_arrays.append(events)
+    return event_arrays
+
+  def midi_pattern_from_event_array(self, events):
+    """
+    Makes the midi pattern of one song from its events, as returned by
+    get_midi_event_arrays().
+    """
     midi_pattern = midi.Pattern([], resolution=int(self.output_ticks_per_quarter_note))
     cur_track = midi.Track([])
     cur_track.append(midi.events.SetTempoEvent(tick=0, bpm=45))
-    future_events = {}
-    last_event_tick = 0
-    
-    ticks_to_this_tone = 0.0
-    song_events_absolute_ticks = []
-    abs_tick_note_beginning = 0.0
-    for frame in song_data:
-      abs_tick_note_beginning += frame[TICKS_FROM_PREV_START]
-      for subframe in range(self.tones_per_cell):
-        offset = subframe*NUM_FEATURES_PER_TONE
-        tick_len           = int(round(frame[offset+LENGTH]))
-        freq               = frame[offset+FREQ]
-        velocity           = min(int(round(frame[offset+VELOCITY])),127)
-        #print (('tick_len: {}, freq: {}, velocity: {}, ticks_from_prev_start: {}'.format(tick_len, freq, velocity, frame[TICKS_FROM_PREV_START]))
-        d = freq_to_tone(freq)
-        #print (('d: {}'.format(d))
-        if d is not None and velocity > 0 and tick_len > 0:
-          # range-check with preserved tone, changed one octave:
-          tone = d['tone']
-          while tone < 0:   tone += 12
-          while tone > 127: tone -= 12
-          pitch_wheel = cents_to_pitchwheel_units(d['cents'])
-          #print (('tick_len: {}, freq: {}, tone: {}, pitch_wheel: {}, velocity: {}'.format(tick_len, freq, tone, pitch_wheel, velocity))
-          #if pitch_wheel != 0:
-          #midi.events.PitchWheelEvent(tick=int(ticks_to_this_tone),
-          #                                            pitch=pitch_wheel)
-          song_events_absolute_ticks.append((abs_tick_note_beginning,
-                                             midi.events.NoteOnEvent(
-                                                   tick=0,
-                                                   velocity=velocity,
-                                                   pitch=tone)))
-          song_events_absolute_ticks.append((abs_tick_note_beginning+tick_len,
-                                             midi.events.NoteOffEvent(
-                                                    tick=0,
-                                                    velocity=0,
-                                                    pitch=tone)))
-    song_events_absolute_ticks.sort(key=lambda e: e[0])
-    abs_tick_note_beginning = 0.0
-    for abs_tick,event in song_events_absolute_ticks:
-      rel_tick = abs_tick-abs_tick_note_beginning
-      event.tick = int(round(rel_tick))
-      cur_track.append(event)
-      abs_tick_note_beginning=abs_tick
-    
+    for tick,note_on,pitch,velocity in events.tolist():
+      if note_on:
+        cur_track.append(midi.events.NoteOnEvent(tick=tick, velocity=velocity, pitch=pitch))
+      else:
+        cur_track.append(midi.events.NoteOffEvent(tick=tick, velocity=velocity, pitch=pitch))
     cur_track.append(midi.EndOfTrackEvent(tick=int(self.output_ticks_per_quarter_note)))
     midi_pattern.append(cur_track)
     #print ( 'print (ing midi track.'
     #print ( midi_pattern
     return midi_pattern
 
+  def frame_events(self, frame, abs_tick_note_beginning):
+    """
+    frame_events returns the (absolute tick, event) pairs, note on and note
+    off, of the tones in one frame of a song in internal representation,
+    whose notes begin at abs_tick_note_beginning.
+    """
+    events = []
+    for subframe in range(self.tones_per_cell):
+      offset = subframe*NUM_FEATURES_PER_TONE
+      tick_len           = int(round(frame[offset+LENGTH]))
+      freq               = frame[offset+FREQ]
+      velocity           = min(int(round(frame[offset+VELOCITY])),127)
+      #print (('tick_len: {}, freq: {}, velocity: {}, ticks_from_prev_start: {}'.format(tick_len, freq, velocity, frame[TICKS_FROM_PREV_START]))
+      d = freq_to_tone(freq)
+      #print (('d: {}'.format(d))
+      if d is not None and velocity > 0 and tick_len > 0:
+        # range-check with preserved tone, changed one octave:
+        tone = d['tone']
+        while tone < 0:   tone += 12
+        while tone > 127: tone -= 12
+        pitch_wheel = cents_to_pitchwheel_units(d['cents'])
+        #print (('tick_len: {}, freq: {}, tone: {}, pitch_wheel: {}, velocity: {}'.format(tick_len, freq, tone, pitch_wheel, velocity))
+        #if pitch_wheel != 0:
+        #midi.events.PitchWheelEvent(tick=int(ticks_to_this_tone),
+        #                                            pitch=pitch_wheel)
+        events.append((abs_tick_note_beginning,
+                       midi.events.NoteOnEvent(
+                             tick=0,
+                             velocity=velocity,
+                             pitch=tone)))
+        events.append((abs_tick_note_beginning+tick_len,
+                       midi.events.NoteOffEvent(
+                              tick=0,
+                              velocity=0,
+                              pitch=tone)))
+    return events
+
+  def iter_midi_events(self, song_chunks):
+    """
+    iter_midi_events is a streaming get_midi_pattern(). It takes the chunks
+    of one song in internal representation (e.g. as they are generated),
+    each of dimensions [chunklength, self.num_song_features], and yields the
+    events of the midi track, with relative ticks, as soon as no later chunk
+    can come before them. Only the note offs of tones still sounding are
+    kept between chunks, so memory does not grow with the song length.
+
+    The events are the same as in get_midi_pattern(song_data) for the
+    concatenated chunks, when no note begins before the previous one. If
+    one does, its events before already streamed ones come at tick 0.
+    """
+    yield midi.events.SetTempoEvent(tick=0, bpm=45)
+    # Heap of (absolute tick, order of creation, event). The order keeps
+    # events at the same tick in the order of get_midi_pattern.
+    pending = []
+    order = 0
+    last_event_tick = 0.0
+    abs_tick_note_beginning = 0.0
+    for chunk in song_chunks:
+      for frame in chunk:
+        abs_tick_note_beginning += frame[TICKS_FROM_PREV_START]
+        for abs_tick,event in self.frame_events(frame, abs_tick_note_beginning):
+          heapq.heappush(pending, (abs_tick, order, event))
+          order += 1
+      # Later notes begin at abs_tick_note_beginning or later.
+      while pending and pending[0][0] <= abs_tick_note_beginning:
+        abs_tick,_,event = heapq.heappop(pending)
+        event.tick = max(int(round(abs_tick-last_event_tick)), 0)
+        last_event_tick = max(abs_tick, last_event_tick)
+        yield event
+    while pending:
+      abs_tick,_,event = heapq.heappop(pending)
+      event.tick = max(int(round(abs_tick-last_event_tick)), 0)
+      last_event_tick = max(abs_tick, last_event_tick)
+      yield event
+    yield midi.EndOfTrackEvent(tick=int(self.output_ticks_per_quarter_note))
+
+  def get_midi_file_bytes(self, events):
+    """
+    Encodes one song, from its events as returned by get_midi_event_arrays(),
+    as the bytes of a Standard MIDI File, without making any midi objects.
+    The bytes are those midi.write_midifile() writes for the pattern of
+    midi_pattern_from_event_array(events): format 1, one track, with the
+    same tempo, running status and end of track.
+    """
+    num_events = len(events)
+    # Each event is one row of up to 7 bytes: the delta time as a
+    # variable-length quantity (1-4 bytes), the status byte (left out when
+    # it is the same as for the previous event, i.e. running status), and
+    # pitch and velocity. Rows are packed by dropping the unused bytes.
+    event_bytes = np.zeros([num_events, 7], dtype=np.uint8)
+    used = np.zeros([num_events, 7], dtype=np.bool_)
+    event_bytes[:,:4], used[:,:4] = midi_varlen_array(events['tick'])
+    event_bytes[:,4] = np.where(events['note_on'], 0x90, 0x80)
+    used[:,4] = np.concatenate([[True], events['note_on'][1:] != events['note_on'][:-1]])[:num_events]
+    event_bytes[:,5] = events['pitch']
+    event_bytes[:,6] = events['velocity']
+    used[:,5:] = True
+    mpqn = int(float(6e7)/45)
+    end_tick_bytes, end_tick_used = midi_varlen_array([int(self.output_ticks_per_quarter_note)])
+    track = b''.join([
+        # SetTempoEvent(tick=0, bpm=45).
+        bytes([0x00, 0xFF, 0x51, 0x03, (mpqn >> 16) & 0xFF, (mpqn >> 8) & 0xFF, mpqn & 0xFF]),
+        event_bytes[used].tobytes(),
+        # EndOfTrackEvent(tick=output_ticks_per_quarter_note).
+        end_tick_bytes[end_tick_used].tobytes(),
+        bytes([0xFF, 0x2F, 0x00])])
+    header = b'MThd' + struct.pack('>LHHH', 6, 1, 1, int(self.output_ticks_per_quarter_note))
+    return header + b'MTrk' + struct.pack('>L', len(track)) + track
+
+  def save_midi_events(self, filename, events):
+    """
+    Saves one song, from its events as returned by get_midi_event_arrays(),
+    as a midi file (get_midi_file_bytes()).
+    """
+    if filename is not None:
+      with open(filename, 'wb') as f:
+        f.write(self.get_midi_file_bytes(events))
+
   def save_midi_pattern(self, filename, midi_pattern):
     if filename is not None:
       midi.write_midifile(filename, midi_pattern)
@@ -1378,6 +1662,76 @@ class MusicDataLoader(object):
     self.save_midi_pattern(filename, midi_pattern)
     return midi_pattern
 
+def prefetch_iterator(iterable, size, name='prefetch'):
+  """
+  Yields the items of iterable, in order, while a background thread
+  produces up to size items ahead of the caller. Exceptions in the
+  producer are raised in the caller. If the caller stops iterating early,
+  the producer stops too.
+  """
+  items = queue.Queue(maxsize=size)
+  stop = threading.Event()
+  done = object()
+  def put(item):
+    while not stop.is_set():
+      try:
+        items.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+  def produce():
+    try:
+      for item in iterable:
+        if stop.is_set():
+          return
+        put((False, item))
+      put((False, done))
+    except Exception as e:
+      put((True, e))
+  producer = threading.Thread(target=produce, name=name)
+  producer.daemon = True
+  producer.start()
+  try:
+    while True:
+      is_exception, item = items.get()
+      if is_exception:
+        raise item
+      if item is done:
+        break
+      yield item
+  finally:
+    # Also reached when the caller stops iterating early.
+    stop.set()
+    producer.join()
+
+def song_data_to_array(song_data):
+  """
+  song_data_to_array takes a list of notes, each a list
+  [BEGIN_TICK, LENGTH, FREQ, VELOCITY], and returns them as one contiguous
+  [num_notes, NUM_FEATURES_PER_TONE+1] array of SONG_DATA_DTYPE.
+  """
+  return np.array(song_data, dtype=SONG_DATA_DTYPE).reshape([-1, NUM_FEATURES_PER_TONE+1])
+
+def pace_event(pace_tick):
+  """
+  pace_event returns a silent note (zero length and velocity) at pace_tick.
+  """
+  note = [0.0]*(NUM_FEATURES_PER_TONE+1)
+  note[FREQ]       = 440.0
+  note[BEGIN_TICK] = pace_tick
+  return note
+
+def read_one_file_job(job):
+  """
+  read_one_file_job parses one midi file. job is a tuple
+  (path, filename, pace_events, output_ticks_per_quarter_note).
+  Module level, so that it can be sent to the worker processes in read_data().
+  """
+  path, filename, pace_events, output_ticks_per_quarter_note = job
+  loader = MusicDataLoader(datadir=None, select_validation_percentage=None, select_test_percentage=None)
+  loader.output_ticks_per_quarter_note = output_ticks_per_quarter_note
+  return loader.read_one_file(path, filename, pace_events)
+
 def tone_to_freq(tone):
   """
     returns the frequency of a tone. 
@@ -1406,6 +1760,43 @@ def freq_to_tone(freq):
   cents = int(1200*math.log(float(freq)/tone_to_freq(int_tone), 2))
   return {'tone': int_tone, 'cents': cents}
 
+def freq_to_tone_array(freqs):
+  """
+    freq_to_tone() for an array of frequencies. Returns (tones, cents),
+    integer arrays of the shape of freqs. Where freq <= 0.0, for which
+    freq_to_tone() returns None, both are 0.
+  """
+  freqs = np.asarray(freqs, dtype=np.float64)
+  valid = freqs > 0.0
+  safe_freqs = np.where(valid, freqs, 440.0)
+  float_tone = 69.0+12*(np.log(safe_freqs/440.0)/math.log(2))
+  int_tone = np.trunc(float_tone)
+  tone_freqs = np.power(2, (int_tone-69.0)/12.0) * 440.0
+  cents = np.trunc(1200*(np.log(safe_freqs/tone_freqs)/math.log(2)))
+  return (np.where(valid, int_tone, 0).astype(np.int64), np.where(valid, cents, 0).astype(np.int64))
+
+def fold_tone_array(tones):
+  """Moves tones outside 0..127 into it by whole octaves, preserving the tone."""
+  tones = np.asarray(tones)
+  tones = np.where(tones < 0, tones+12*((-tones+11)//12), tones)
+  return np.where(tones > 127, tones-12*((tones-127+11)//12), tones)
+
+def midi_varlen_array(values):
+  """
+    Encodes integers as midi variable-length quantities, as python-midi's
+    write_varlen() does: at most four bytes, so only the low 28 bits are
+    kept, and negative values take all four.
+    Returns (value_bytes, used), both [len(values), 4]: the bytes of each
+    value are value_bytes[i][used[i]].
+  """
+  values = np.asarray(values, dtype=np.int64)
+  shifts = np.array([21, 14, 7, 0])
+  value_bytes = ((values[:,np.newaxis] >> shifts) & 0x7F) | np.array([0x80, 0x80, 0x80, 0])
+  # The number of bytes needed, 1-4.
+  num_bytes = 1+(values >> 7 != 0)+(values >> 14 != 0)+(values >> 21 != 0)
+  used = np.arange(4, 0, -1) <= num_bytes[:,np.newaxis]
+  return (value_bytes.astype(np.uint8), used)
+
 def cents_to_pitchwheel_units(cents):
   return int(40.96*(float(cents)))
 
@@ -37,13 +37,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import time, datetime, os, sys
+import time, datetime, functools, json, os, sys
 import _pickle as pkl
 from subprocess import call, Popen
 
 import numpy as np
 import tensorflow as tf
 from tensorflow.python.client import timeline
+from tensorflow.python.util import nest
 
 
 import music_data_utils
@@ -67,6 +68,10 @@ flags.DEFINE_integer("select_test_percentage", None,
                      "Select random percentage of data as test set.")
 flags.DEFINE_boolean("sample", False,
                      "Sample output from the model. Assume training was already done. Save sample output to file.")
+flags.DEFINE_integer("num_samples", 1,
+                     "Number of songs to generate with --sample.")
+flags.DEFINE_string("export_dir", None,
+                     "Export G from the latest checkpoint in traindir as a SavedModel to this dir, for exported_generator.py, and exit.")
 flags.DEFINE_integer("works_per_composer", None,
                      "Limit number of works per composer that is loaded.")
 flags.DEFINE_boolean("disable_feed_previous", False,
@@ -89,6 +94,8 @@ flags.DEFINE_integer("num_layers_d", 2,                 # 2
                    "Number of stacked recurrent cells in D.")
 flags.DEFINE_integer("songlength", 100,               # 200, 500
                    "Limit song inputs to this number of events.")
+flags.DEFINE_integer("songlength_buckets", 4,          # 
+                   "Number of models, of evenly spaced lengths up to songlength, shared by the pretraining songlength curriculum.")
 flags.DEFINE_integer("meta_layer_size", 200,          # 300, 600
                    "Size of hidden layer for meta information module.")
 flags.DEFINE_integer("hidden_size_g", 100,              # 200, 1500
@@ -115,14 +122,36 @@ flags.DEFINE_boolean("ignore_saved_args", False,      #
                    "Tells the program to ignore saved arguments, and instead use the ones provided as CLI arguments.")
 flags.DEFINE_boolean("pace_events", False,            #
                    "When parsing input data, insert one dummy event at each quarter note if there is no tone.")
+flags.DEFINE_boolean("disable_data_cache", False,     #
+                   "Always parse the midi files, instead of reusing parsed songs cached in datadir.")
+flags.DEFINE_integer("prefetch_batches", 2,           #
+                   "Number of batches to prepare in a background thread while the graph runs. 0 disables prefetching.")
+flags.DEFINE_boolean("dataset_input", False,          #
+                   "Read batches through a tf.data pipeline inside the graph instead of feeding them with feed_dict.")
+flags.DEFINE_integer("data_workers", 1,               #
+                   "Number of processes parsing midi files when loading the data. 1 parses in the main process.")
 flags.DEFINE_boolean("minibatch_d", False,            #
                    "Adding kernel features for minibatch diversity.")
 flags.DEFINE_boolean("unidirectional_d", False,        #
                    "Unidirectional RNN instead of bidirectional RNN for D.")
+flags.DEFINE_string("rnn_cell", 'basic',              # 'block', 'block_fused'
+                   "LSTM implementation: 'basic' (BasicLSTMCell), 'block' (LSTMBlockCell) or 'block_fused' (LSTMBlockFusedCell in D, LSTMBlockCell in G, which generates one step at a time).")
+flags.DEFINE_boolean("single_pass_d", True,           #
+                   "Run D once over real and generated data stacked along the batch axis, instead of once for each. Ignored with --minibatch_d.")
+flags.DEFINE_boolean("benchmark_rnn_cells", False,     #
+                   "Print training steps/s on CPU for each --rnn_cell, over a range of hidden sizes for G and D, and exit.")
+flags.DEFINE_boolean("benchmark_float16", False,       #
+                   "Print training steps/s and peak memory on CPU in float32 and with --float16, over a range of hidden sizes for G and D, and exit.")
+flags.DEFINE_boolean("debug_prints", False,           #
+                   "Add tf.Print nodes that print intermediate values of D, minibatch features and regularization losses.")
 flags.DEFINE_boolean("profiling", False,              #
                    "Profiling. Writing a timeline.json file in plots dir.")
 flags.DEFINE_boolean("float16", False,                #
-                   "Use floa16 data type. Otherwise, use float32.")
+                   "Mixed precision: compute G and D in float16, keeping float32 master weights and losses. Otherwise, use float32.")
+flags.DEFINE_float("loss_scale", 128.0,               #
+                   "With --float16, the initial loss scale: losses are multiplied by it before computing gradients, so that small gradients do not underflow in float16. A step whose gradients overflow to inf/nan is skipped and halves the scale.")
+flags.DEFINE_integer("loss_scale_window", 1000,       #
+                   "With --float16, the loss scale is doubled after this many steps in a row with finite gradients.")
 
 flags.DEFINE_boolean("adam", False,                   #
                    "Use Adam optimizer.")
@@ -144,12 +173,41 @@ flags.DEFINE_boolean("end_classification", False, "Classify only in ends of D. O
 
 FLAGS = flags.FLAGS
 
-model_layout_flags = ['num_layers_g', 'num_layers_d', 'meta_layer_size', 'hidden_size_g', 'hidden_size_d', 'biscale_slow_layer_ticks', 'multiscale', 'multiscale', 'disable_feed_previous', 'pace_events', 'minibatch_d', 'unidirectional_d', 'feature_matching', 'composer']
+model_layout_flags = ['num_layers_g', 'num_layers_d', 'meta_layer_size', 'hidden_size_g', 'hidden_size_d', 'biscale_slow_layer_ticks', 'multiscale', 'multiscale', 'disable_feed_previous', 'pace_events', 'minibatch_d', 'unidirectional_d', 'feature_matching', 'composer', 'rnn_cell']
+
+def rnn_cell_class():
+  """The RNNCell class selected by --rnn_cell."""
+  if FLAGS.rnn_cell == 'basic':
+    return tf.contrib.rnn.BasicLSTMCell
+  elif FLAGS.rnn_cell in ['block', 'block_fused']:
+    return tf.contrib.rnn.LSTMBlockCell
+  raise ValueError('Unknown --rnn_cell: {}'.format(FLAGS.rnn_cell))
+
+def fused_lstm(inputs, rnn_layer_sizes, sequence_length=None, dropout_keep_prob=1.0, reverse=False):
+  """
+  Runs a stack of tf.contrib.rnn.LSTMBlockFusedCell layers over inputs,
+  [batch_size, time, features]. Each layer is one op over the whole
+  sequence. With reverse, the layers run backwards over the first
+  sequence_length steps of each sequence.
+
+  Returns the outputs of the last layer, [batch_size, time, rnn_layer_sizes[-1]].
+  """
+  # The fused cell is time major.
+  outputs = tf.transpose(inputs, perm=[1, 0, 2])
+  for i,num_units in enumerate(rnn_layer_sizes):
+    with tf.variable_scope('cell_{}'.format(i)):
+      cell = tf.contrib.rnn.LSTMBlockFusedCell(num_units)
+      if reverse:
+        cell = tf.contrib.rnn.TimeReversedFusedRNN(cell)
+      outputs, _ = cell(outputs, dtype=data_type(), sequence_length=sequence_length)
+      if dropout_keep_prob < 1:
+        outputs = tf.nn.dropout(outputs, dropout_keep_prob)
+  return tf.transpose(outputs, perm=[1, 0, 2])
 
 def make_rnn_cell(rnn_layer_sizes,
                   dropout_keep_prob=1.0,
                   attn_length=0,
-                  base_cell=tf.contrib.rnn.BasicLSTMCell,
+                  base_cell=None,
                   state_is_tuple=True,
                   reuse=False):
   """Makes a RNN cell from the given hyperparameters.
@@ -158,16 +216,23 @@ def make_rnn_cell(rnn_layer_sizes,
     rnn_layer_sizes: A list of integer sizes (in units) for each layer of the RNN.
     dropout_keep_prob: The float probability to keep the output of any given sub-cell.
     attn_length: The size of the attention vector.
-    base_cell: The base tf.contrib.rnn.RNNCell to use for sub-cells.
+    base_cell: The base tf.contrib.rnn.RNNCell to use for sub-cells. Default:
+        the one selected by --rnn_cell.
     state_is_tuple: A boolean specifying whether to use tuple of hidden matrix
         and cell matrix as a state instead of a concatenated matrix.
 
   Returns:
       A tf.contrib.rnn.MultiRNNCell based on the given hyperparameters.
   """
+  if base_cell is None:
+    base_cell = rnn_cell_class()
   cells = []
   for num_units in rnn_layer_sizes:
-    cell = base_cell(num_units, state_is_tuple=state_is_tuple, reuse=reuse)
+    if base_cell is tf.contrib.rnn.LSTMBlockCell:
+      # Always uses a tuple state.
+      cell = base_cell(num_units, reuse=reuse)
+    else:
+      cell = base_cell(num_units, state_is_tuple=state_is_tuple, reuse=reuse)
     cell = tf.contrib.rnn.DropoutWrapper(
         cell, output_keep_prob=dropout_keep_prob)
     cells.append(cell)
@@ -203,10 +268,76 @@ def restore_flags(save_if_none_found=True):
 
 
 
+# Keeps log() in the losses finite. The losses are computed in float32,
+# where 1e-7 is representable (unlike 1e-1000000, which is just 0.0).
+LOG_EPSILON = 1e-7
+
 def data_type():
   return tf.float16 if FLAGS.float16 else tf.float32
   #return tf.float16
 
+def float32_variable_getter(getter, name, shape=None, dtype=None, initializer=None, regularizer=None, trainable=True, *args, **kwargs):
+  """
+  Custom getter for mixed precision. Trainable variables are stored (and
+  updated by the optimizers) in float32, and cast to the requested dtype,
+  e.g. float16, where they are used. Regularizers see the float32 variables.
+  """
+  storage_dtype = tf.float32 if trainable else dtype
+  variable = getter(name, shape, dtype=storage_dtype, initializer=initializer, regularizer=regularizer, trainable=trainable, *args, **kwargs)
+  if trainable and dtype is not None and dtype != tf.float32:
+    variable = tf.cast(variable, dtype)
+  return variable
+
+def variable_getter():
+  """The custom getter to build the model with: float32_variable_getter with --float16, else None."""
+  return float32_variable_getter if FLAGS.float16 else None
+
+class LossScale(object):
+  """
+  Dynamic loss scale of one optimizer, for --float16. The loss is multiplied
+  by the scale before differentiating, and the gradients divided by it, so
+  that small gradients survive the float16 part of the backward pass.
+
+  The scale starts at --loss_scale. A step where any gradient is inf/nan is
+  skipped, leaving the float32 variables as they are, and halves the scale.
+  After --loss_scale_window steps in a row with finite gradients, the scale
+  is doubled.
+  """
+  def __init__(self, name):
+    self.scale = tf.Variable(FLAGS.loss_scale, trainable=False, dtype=tf.float32, name=name+'_loss_scale')
+    self.finite_steps = tf.Variable(0, trainable=False, dtype=tf.int32, name=name+'_finite_steps')
+
+  def gradients(self, loss, params):
+    grads = tf.gradients(loss*self.scale, params)
+    return [None if grad is None else grad/self.scale for grad in grads]
+
+  def apply_gradients(self, optimizer, grads, params):
+    all_finite = tf.reduce_all([tf.reduce_all(tf.is_finite(grad)) for grad in grads if grad is not None])
+    def apply():
+      with tf.control_dependencies([optimizer.apply_gradients(zip(grads, params))]):
+        grow = self.finite_steps+1 >= FLAGS.loss_scale_window
+        return tf.group(tf.assign(self.scale, tf.where(grow, self.scale*2.0, self.scale)),
+                        tf.assign(self.finite_steps, tf.where(grow, 0, self.finite_steps+1)))
+    def skip():
+      return tf.group(tf.assign(self.scale, tf.maximum(self.scale/2.0, 1.0)),
+                      tf.assign(self.finite_steps, 0))
+    return tf.cond(all_finite, apply, skip)
+
+def clipped_update(optimizer, loss, params, loss_scale=None):
+  """
+  The op that applies the gradients of loss, clipped to --max_grad_norm, to
+  params with optimizer. With a LossScale (--float16), the gradients are
+  computed through it, and steps where they overflow are skipped.
+  """
+  if loss_scale is None:
+    grads = tf.gradients(loss, params)
+  else:
+    grads = loss_scale.gradients(loss, params)
+  grads, _ = tf.clip_by_global_norm(grads, FLAGS.max_grad_norm)
+  if loss_scale is None:
+    return optimizer.apply_gradients(zip(grads, params))
+  return loss_scale.apply_gradients(optimizer, grads, params)
+
 def my_reduce_mean(what_to_take_mean_over):
   return tf.reshape(what_to_take_mean_over, shape=[-1])[0]
   denom = 1.0
@@ -219,6 +350,15 @@ def my_reduce_mean(what_to_take_mean_over):
       denom = denom*d
   return tf.reduce_sum(what_to_take_mean_over)/denom
 
+def debug_print(inp, data, message):
+  """
+  tf.Print(inp, data, message) when --debug_prints is set, otherwise just inp,
+  so the default graph has no Print nodes.
+  """
+  if not FLAGS.debug_prints:
+    return inp
+  return tf.Print(inp, data, message, summarize=20, first_n=20)
+
 def linear(inp, output_dim, scope=None, stddev=1.0, reuse_scope=False):
   norm = tf.random_normal_initializer(stddev=stddev, dtype=data_type())
   const = tf.constant_initializer(0.0, dtype=data_type())
@@ -231,6 +371,82 @@ def linear(inp, output_dim, scope=None, stddev=1.0, reuse_scope=False):
     b = tf.get_variable('b', [output_dim], initializer=const, dtype=data_type())
   return tf.matmul(inp, w) + b
 
+def time_distributed(layer, inp, *args, **kwargs):
+  """
+  Applies layer (e.g. linear) to every step of inp, [batch_size, time, features],
+  as one batched matmul. Returns [batch_size, time, output features].
+  """
+  inp_shape = tf.shape(inp)
+  outp = layer(tf.reshape(inp, [-1, inp.get_shape()[2].value]), *args, **kwargs)
+  output_dim = outp.get_shape()[1].value
+  outp = tf.reshape(outp, tf.stack([inp_shape[0], inp_shape[1], output_dim]))
+  outp.set_shape(inp.get_shape()[:2].concatenate([output_dim]))
+  return outp
+
+def generator(cell, random_inputs, initial_point, initial_state, meta=None):
+  """
+  The free-running generator. Runs cell over the steps of random_inputs
+  ([batch_size, time, random features]), feeding each generated point back
+  in as input to the next step (unless --disable_feed_previous).
+  meta, if given, is concatenated to the input at every step.
+
+  The first step is built outside the tf.while_loop, which creates (and
+  regularizes) the variables of the input layer, cell and output layer.
+  Later steps, and other calls with the scope reused, share them, so the
+  graph size does not depend on the number of steps.
+
+  Returns (generated features [batch_size, time, num_song_features], final state).
+  """
+  num_song_features = initial_point.get_shape()[1].value
+  def step(input_, generated_point, state, reuse_scope):
+    concat_values = [input_]
+    if not FLAGS.disable_feed_previous:
+      concat_values.append(generated_point)
+    if meta is not None:
+      concat_values.append(meta)
+    input_ = tf.concat(axis=1, values=concat_values)
+    input_ = tf.nn.relu(linear(input_, cell.output_size, scope='input_layer', reuse_scope=reuse_scope))
+    output, state = cell(input_, state)
+    #generated_point = tf.nn.relu(linear(output, num_song_features, scope='output_layer', reuse_scope=reuse_scope))
+    return linear(output, num_song_features, scope='output_layer', reuse_scope=reuse_scope), state
+
+  num_steps = tf.shape(random_inputs)[1]
+  inputs_ta = tf.TensorArray(random_inputs.dtype, size=num_steps).unstack(tf.transpose(random_inputs, perm=[1, 0, 2]))
+  generated_point, state = step(random_inputs[:,0,:], initial_point, initial_state, tf.get_variable_scope().reuse)
+  generated_ta = tf.TensorArray(generated_point.dtype, size=num_steps).write(0, generated_point)
+
+  def body(i, generated_point, state, generated_ta):
+    generated_point, state = step(inputs_ta.read(i), generated_point, state, True)
+    return (i+1, generated_point, state, generated_ta.write(i, generated_point))
+
+  _, _, state, generated_ta = tf.while_loop(lambda i, *_: i < num_steps, body, [tf.constant(1), generated_point, state, generated_ta])
+  generated_features = tf.transpose(generated_ta.stack(), perm=[1, 0, 2])
+  generated_features.set_shape(random_inputs.get_shape()[:2].concatenate([num_song_features]))
+  return (generated_features, state)
+
+def meta_generator(batch_size, num_meta_features, metainputs=None):
+  """
+  The part of G that generates the composer and genre (--generate_meta).
+  metainputs is its noise, [batch_size, int(random_input_scale*num_meta_features)]
+  (default: drawn in the graph).
+  Returns meta probabilities, [batch_size, num_meta_features].
+  """
+  if metainputs is None:
+    metainputs = tf.random_uniform(shape=[batch_size, int(FLAGS.random_input_scale*num_meta_features)], minval=0.0, maxval=1.0, dtype=data_type())
+  meta_g = tf.nn.relu(linear(metainputs, FLAGS.meta_layer_size, scope='meta_layer', reuse_scope=False))
+  meta_softmax_w = tf.get_variable("meta_softmax_w", [FLAGS.meta_layer_size, num_meta_features], dtype=data_type())
+  meta_softmax_b = tf.get_variable("meta_softmax_b", [num_meta_features], dtype=data_type())
+  meta_logits = tf.nn.xw_plus_b(meta_g, meta_softmax_w, meta_softmax_b)
+  return tf.nn.softmax(meta_logits)
+
+def concat_meta(meta, inputs):
+  """
+  Concatenates meta, [batch_size, meta features], to every step of
+  inputs, [batch_size, time, features].
+  """
+  meta = tf.tile(tf.expand_dims(meta, 1), [1, tf.shape(inputs)[1], 1])
+  return tf.concat([meta, inputs], 2)
+
 def minibatch(inp, num_kernels=25, kernel_dim=10, scope=None, msg='', reuse_scope=False):
   """
    Borrowed from http://blog.aylien.com/introduction-generative-adversarial-networks-code-tensorflow/
@@ -240,42 +456,101 @@ def minibatch(inp, num_kernels=25, kernel_dim=10, scope=None, msg='', reuse_scop
     if reuse_scope:
       scope.reuse_variables()
   
-    inp = tf.Print(inp, [inp],
-            '{} inp = '.format(msg), summarize=20, first_n=20)
+    inp = debug_print(inp, [inp],
+            '{} inp = '.format(msg))
     x = tf.sigmoid(linear(inp, num_kernels * kernel_dim, scope))
     activation = tf.reshape(x, (-1, num_kernels, kernel_dim))
-    activation = tf.Print(activation, [activation],
-            '{} activation = '.format(msg), summarize=20, first_n=20)
+    activation = debug_print(activation, [activation],
+            '{} activation = '.format(msg))
     diffs = tf.expand_dims(activation, 3) - \
                 tf.expand_dims(tf.transpose(activation, [1, 2, 0]), 0)
-    diffs = tf.Print(diffs, [diffs],
-            '{} diffs = '.format(msg), summarize=20, first_n=20)
+    diffs = debug_print(diffs, [diffs],
+            '{} diffs = '.format(msg))
     abs_diffs = tf.reduce_sum(tf.abs(diffs), 2)
-    abs_diffs = tf.Print(abs_diffs, [abs_diffs],
-            '{} abs_diffs = '.format(msg), summarize=20, first_n=20)
+    abs_diffs = debug_print(abs_diffs, [abs_diffs],
+            '{} abs_diffs = '.format(msg))
     minibatch_features = tf.reduce_sum(tf.exp(-abs_diffs), 2)
-    minibatch_features = tf.Print(minibatch_features, [tf.reduce_min(minibatch_features), tf.reduce_max(minibatch_features)],
-            '{} minibatch_features (min,max) = '.format(msg), summarize=20, first_n=20)
+    minibatch_features = debug_print(minibatch_features, [tf.reduce_min(minibatch_features), tf.reduce_max(minibatch_features)],
+            '{} minibatch_features (min,max) = '.format(msg))
   return tf.concat( [inp, minibatch_features],1)
 
+class DatasetInput(object):
+  """
+  Batches from a MusicDataLoader as tf.data datasets, one per part
+  (train, validation, test), behind one feedable iterator.
+
+  The model reads metadata and songdata from the iterator, so batches go
+  straight into the graph instead of being copied in with feed_dict every
+  step. Batching and shuffling are still done by the loader, so the batches
+  are the same as in feed_dict mode; the dataset prefetches them.
+  """
+
+  def __init__(self, loader, batch_size, songlength, num_song_features, num_meta_features):
+    self.loader = loader
+    self.batch_size = batch_size
+    self.songlength = songlength
+    self.window_length = None
+    output_types = (data_type(), data_type())
+    output_shapes = (tf.TensorShape([batch_size, num_meta_features]), tf.TensorShape([batch_size, songlength, num_song_features]))
+    self._handle = tf.placeholder(tf.string, shape=[], name='dataset_handle')
+    iterator = tf.data.Iterator.from_string_handle(self._handle, output_types, output_shapes)
+    self.metadata, self.songdata = iterator.get_next()
+    self._iterators = {}
+    self._string_handles = {}
+    self._handles = {}
+    for part in ['train', 'validation', 'test']:
+      dataset = tf.data.Dataset.from_generator(functools.partial(self.batches, part), output_types, output_shapes)
+      dataset = dataset.prefetch(max(FLAGS.prefetch_batches, 1))
+      self._iterators[part] = dataset.make_initializable_iterator()
+      self._string_handles[part] = self._iterators[part].string_handle()
+
+  def batches(self, part):
+    numpy_type = data_type().as_numpy_dtype
+    for batch_meta, batch_song in self.loader.iterate_batches(self.batch_size, self.songlength, part=part, window_length=self.window_length):
+      yield (batch_meta.astype(numpy_type), batch_song.astype(numpy_type))
+
+  def start(self, session, part, window_length=None):
+    """
+    start (re)initializes the iterator over part, and returns the feed_dict
+    that makes the model read from it. session.run raises
+    tf.errors.OutOfRangeError when the part is exhausted.
+    The random windows in the songs are drawn for window_length events
+    (default: songlength), see MusicDataLoader.get_batch().
+    """
+    self.window_length = window_length
+    if part not in self._handles:
+      self._handles[part] = session.run(self._string_handles[part])
+    session.run(self._iterators[part].initializer)
+    return {self._handle: self._handles[part]}
+
 class RNNGAN(object):
   """The RNNGAN model."""
 
-  def __init__(self, is_training, num_song_features=None, num_meta_features=None):
+  def __init__(self, is_training, num_song_features=None, num_meta_features=None, input_data=None, songlength=None):
     batch_size = FLAGS.batch_size
     self.batch_size =  batch_size
 	
-    songlength = FLAGS.songlength
+    if songlength is None:
+      songlength = FLAGS.songlength
     self.songlength = songlength#self.global_step            = tf.Variable(0, trainable=False)
 
     print('songlength: {}'.format(self.songlength))
-    self._input_songdata = tf.placeholder(shape=[batch_size, songlength, num_song_features], dtype=data_type())
-    self._input_metadata = tf.placeholder(shape=[batch_size, num_meta_features], dtype=data_type())
+    # Only the first input_songlength events are used, the rest is padding
+    # masked out of the losses. This lets one model train on any songlength
+    # up to self.songlength.
+    self._input_songlength = tf.placeholder_with_default(songlength, shape=[], name='input_songlength')
+    self._songlengths = tf.fill([batch_size], self._input_songlength)
+    self._songlength_mask = tf.sequence_mask(self._songlengths, songlength, dtype=data_type())
+    self.input_data = input_data
+    if input_data is not None:
+      self._input_songdata = input_data.songdata
+      self._input_metadata = input_data.metadata
+    else:
+      self._input_songdata = tf.placeholder(shape=[batch_size, songlength, num_song_features], dtype=data_type())
+      self._input_metadata = tf.placeholder(shape=[batch_size, num_meta_features], dtype=data_type())
     #_split = tf.split(self._input_songdata,songlength,1)[0]
     print("self._input_songdata",self._input_songdata, 'songlength',songlength)
     #print(tf.squeeze(_split,[1]))
-    songdata_inputs = [tf.squeeze(input_, [1])
-              for input_ in tf.split(self._input_songdata,songlength,1)]
   
     
     with tf.variable_scope('G') as scope:
@@ -293,74 +568,37 @@ class RNNGAN(object):
 
       # TODO: (possibly temporarily) disabling meta info
       if FLAGS.generate_meta:
-        metainputs = tf.random_uniform(shape=[batch_size, int(FLAGS.random_input_scale*num_meta_features)], minval=0.0, maxval=1.0)
-        meta_g = tf.nn.relu(linear(metainputs, FLAGS.meta_layer_size, scope='meta_layer', reuse_scope=False))
-        meta_softmax_w = tf.get_variable("meta_softmax_w", [FLAGS.meta_layer_size, num_meta_features])
-        meta_softmax_b = tf.get_variable("meta_softmax_b", [num_meta_features])
-        meta_logits = tf.nn.xw_plus_b(meta_g, meta_softmax_w, meta_softmax_b)
-        meta_probs = tf.nn.softmax(meta_logits)
+        meta_probs = meta_generator(batch_size, num_meta_features)
 
       random_rnninputs = tf.random_uniform(shape=[batch_size, songlength, int(FLAGS.random_input_scale*num_song_features)], minval=0.0, maxval=1.0, dtype=data_type())
 
-      # Make list of tensors. One per step in recurrence.
-      # Each tensor is batchsize*numfeatures.
-      
-      random_rnninputs = [tf.squeeze(input_, [1]) for input_ in tf.split( random_rnninputs,songlength,1)]
-      
       # REAL GENERATOR:
-      state = self._initial_state
       # as we feed the output as the input to the next, we 'invent' the initial 'output'.
       generated_point = tf.random_uniform(shape=[batch_size, num_song_features], minval=0.0, maxval=1.0, dtype=data_type())
-      outputs = []
-      self._generated_features = []
-      for i,input_ in enumerate(random_rnninputs):
-        if i > 0: scope.reuse_variables()
-        concat_values = [input_]
-        if not FLAGS.disable_feed_previous:
-          concat_values.append(generated_point)
-        if FLAGS.generate_meta:
-          concat_values.append(meta_probs)
-        if len(concat_values):
-          input_ = tf.concat(axis=1, values=concat_values)
-        input_ = tf.nn.relu(linear(input_, FLAGS.hidden_size_g,
-                            scope='input_layer', reuse_scope=(i!=0)))
-        output, state = cell(input_, state)
-        outputs.append(output)
-        #generated_point = tf.nn.relu(linear(output, num_song_features, scope='output_layer', reuse_scope=(i!=0)))
-        generated_point = linear(output, num_song_features, scope='output_layer', reuse_scope=(i!=0))
-        self._generated_features.append(generated_point)
-      
+      meta_condition = None
+      if FLAGS.generate_meta:
+        meta_condition = meta_probs
+      self._generated_features, state = generator(cell, random_rnninputs, generated_point, self._initial_state, meta_condition)
       
       # PRETRAINING GENERATOR, will feed inputs, not generated outputs:
       scope.reuse_variables()
       # as we feed the output as the input to the next, we 'invent' the initial 'output'.
       prev_target = tf.random_uniform(shape=[batch_size, num_song_features], minval=0.0, maxval=1.0, dtype=data_type())
-      outputs = []
-      self._generated_features_pretraining = []
-      for i,input_ in enumerate(random_rnninputs):
-        concat_values = [input_]
-        if not FLAGS.disable_feed_previous:
-          concat_values.append(prev_target)
-        if FLAGS.generate_meta:
-          concat_values.append(self._input_metadata)
-        if len(concat_values):
-          input_ = tf.concat(axis=1, values=concat_values)
-        input_ = tf.nn.relu(linear(input_, FLAGS.hidden_size_g, scope='input_layer', reuse_scope=(i!=0)))
-        output, state = cell(input_, state)
-        outputs.append(output)
-        #generated_point = tf.nn.relu(linear(output, num_song_features, scope='output_layer', reuse_scope=(i!=0)))
-        generated_point = linear(output, num_song_features, scope='output_layer', reuse_scope=(i!=0))
-        self._generated_features_pretraining.append(generated_point)
-        prev_target = songdata_inputs[i]
-      
-      #outputs, state = tf.nn.rnn(cell, transformed, initial_state=self._initial_state)
-
-      #self._generated_features = [tf.nn.relu(linear(output, num_song_features, scope='output_layer', reuse_scope=(i!=0))) for i,output in enumerate(outputs)]
+      concat_values = [random_rnninputs]
+      if not FLAGS.disable_feed_previous:
+        # The target of the previous step, all at once.
+        concat_values.append(tf.concat([tf.expand_dims(prev_target, 1), self._input_songdata[:,:-1,:]], 1))
+      if FLAGS.generate_meta:
+        concat_values.append(tf.tile(tf.expand_dims(self._input_metadata, 1), [1, tf.shape(self._input_songdata)[1], 1]))
+      inputs = tf.nn.relu(time_distributed(linear, tf.concat(axis=2, values=concat_values), FLAGS.hidden_size_g, scope='input_layer', reuse_scope=True))
+      outputs, state = tf.nn.dynamic_rnn(cell, inputs, initial_state=state)
+      self._generated_features_pretraining = time_distributed(linear, outputs, num_song_features, scope='output_layer', reuse_scope=True)
 
     self._final_state = state
 
     # These are used both for pretraining and for D/G training further down.
-    self._lr = tf.Variable(FLAGS.learning_rate, trainable=False, dtype=data_type())
+    # The optimizers work on float32 variables, also with --float16.
+    self._lr = tf.Variable(FLAGS.learning_rate, trainable=False, dtype=tf.float32)
     self.g_params = [v for v in tf.trainable_variables() if v.name.startswith('model/G/')]
     if FLAGS.adam:
       g_optimizer = tf.train.AdamOptimizer(self._lr)
@@ -370,22 +608,28 @@ class RNNGAN(object):
     reg_losses = tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)
     reg_constant = 0.1  # Choose an appropriate one.
     reg_loss = reg_constant * sum(reg_losses)
-    reg_loss = tf.Print(reg_loss, reg_losses,
-                  'reg_losses = ', summarize=20, first_n=20)
+    reg_loss = debug_print(reg_loss, reg_losses,
+                  'reg_losses = ')
     #if not FLAGS.disable_l2_regularizer:
     #  print('L2 regularization. Reg losses: {}'.format([v.name for v in reg_losses]))
    
     # ---BEGIN, PRETRAINING. ---
     
-    print(tf.transpose(tf.stack(self._generated_features_pretraining), perm=[1, 0, 2]).get_shape())
+    print(self._generated_features_pretraining.get_shape())
     print(self._input_songdata.get_shape())
-    self.rnn_pretraining_loss = tf.reduce_mean(tf.squared_difference(x=tf.transpose(tf.stack(self._generated_features_pretraining), perm=[1, 0, 2]), y=self._input_songdata))
+    # Losses are computed in float32, also with --float16.
+    pretraining_squared_difference = tf.reduce_sum(tf.squared_difference(x=tf.cast(self._generated_features_pretraining, tf.float32), y=tf.cast(self._input_songdata, tf.float32)), 2)
+    songlength_mask = tf.cast(self._songlength_mask, tf.float32)
+    self.rnn_pretraining_loss = tf.reduce_sum(pretraining_squared_difference*songlength_mask)/(tf.reduce_sum(songlength_mask)*num_song_features)
     if not FLAGS.disable_l2_regularizer:
       self.rnn_pretraining_loss = self.rnn_pretraining_loss+reg_loss
     
     
-    pretraining_grads, _ = tf.clip_by_global_norm(tf.gradients(self.rnn_pretraining_loss, self.g_params), FLAGS.max_grad_norm)
-    self.opt_pretraining = g_optimizer.apply_gradients(zip(pretraining_grads, self.g_params))
+    # One loss scale per update op, since opt_d and opt_g run in the same step.
+    self.loss_scales = {}
+    if FLAGS.float16:
+      self.loss_scales = dict((name, LossScale(name)) for name in ['pretraining', 'd', 'g'])
+    self.opt_pretraining = clipped_update(g_optimizer, self.rnn_pretraining_loss, self.g_params, self.loss_scales.get('pretraining'))
 
     # ---END, PRETRAINING---
 
@@ -396,35 +640,47 @@ class RNNGAN(object):
     # as you cannot use the same network with different inputs in TensorFlow.
     with tf.variable_scope('D') as scope:
       scope.set_regularizer(tf.contrib.layers.l2_regularizer(scale=FLAGS.reg_scale))
-      # Make list of tensors. One per step in recurrence.
-      # Each tensor is batchsize*numfeatures.
+      # Inputs are [batch_size, songlength, features] tensors.
       # TODO: (possibly temporarily) disabling meta info
       print('self._input_songdata shape {}'.format(self._input_songdata.get_shape()))
-      print('generated data shape {}'.format(self._generated_features[0].get_shape()))
+      print('generated data shape {}'.format(self._generated_features.get_shape()))
       # TODO: (possibly temporarily) disabling meta info
+      songdata_inputs = self._input_songdata
       if FLAGS.generate_meta:
-        songdata_inputs = [tf.concat([self._input_metadata, songdata_input],1) for songdata_input in songdata_inputs]
+        songdata_inputs = concat_meta(self._input_metadata, songdata_inputs)
       #print(songdata_inputs[0])
       #print(songdata_inputs[0])
       #print('metadata inputs shape {}'.format(self._input_metadata.get_shape()))
       #print('generated metadata shape {}'.format(meta_probs.get_shape()))
-      self.real_d,self.real_d_features = self.discriminator(songdata_inputs, is_training, msg='real')
-      scope.reuse_variables()
       # TODO: (possibly temporarily) disabling meta info
+      generated_data = self._generated_features
       if FLAGS.generate_meta:
-        generated_data = [tf.concat([meta_probs, songdata_input],1) for songdata_input in self._generated_features]
+        generated_data = concat_meta(meta_probs, generated_data)
+      if songdata_inputs.get_shape() != generated_data.get_shape():
+        print('songdata_inputs shape {} != generated data shape {}'.format(songdata_inputs.get_shape(), generated_data.get_shape()))
+      if FLAGS.single_pass_d and not FLAGS.minibatch_d:
+        # Minibatch discrimination compares the samples of a batch, so it
+        # needs real and generated data in separate passes.
+        d, d_features = self.discriminator(tf.concat([songdata_inputs, generated_data], 0), is_training, msg='real_generated', num_passes=2)
+        self.real_d, self.generated_d = tf.split(d, 2, 0)
+        self.real_d_features, self.generated_d_features = tf.split(d_features, 2, 0)
       else:
-        generated_data = self._generated_features
-      if songdata_inputs[0].get_shape() != generated_data[0].get_shape():
-        print('songdata_inputs shape {} != generated data shape {}'.format(songdata_inputs[0].get_shape(), generated_data[0].get_shape()))
-      self.generated_d,self.generated_d_features = self.discriminator(generated_data, is_training, msg='generated')
+        self.real_d,self.real_d_features = self.discriminator(songdata_inputs, is_training, msg='real')
+        scope.reuse_variables()
+        self.generated_d,self.generated_d_features = self.discriminator(generated_data, is_training, msg='generated')
+
+    # Losses are computed in float32, also with --float16.
+    self.real_d = tf.cast(self.real_d, tf.float32)
+    self.generated_d = tf.cast(self.generated_d, tf.float32)
+    self.real_d_features = tf.cast(self.real_d_features, tf.float32)
+    self.generated_d_features = tf.cast(self.generated_d_features, tf.float32)
 
     # Define the loss for discriminator and generator networks (see the original
     # paper for details), and create optimizers for both
-    self.d_loss = tf.reduce_mean(-tf.log(tf.clip_by_value(self.real_d, 1e-1000000, 1.0)) \
-                                 -tf.log(1 - tf.clip_by_value(self.generated_d, 0.0, 1.0-1e-1000000)))
+    self.d_loss = tf.reduce_mean(-tf.log(tf.clip_by_value(self.real_d, LOG_EPSILON, 1.0)) \
+                                 -tf.log(1 - tf.clip_by_value(self.generated_d, 0.0, 1.0-LOG_EPSILON)))
     self.g_loss_feature_matching = tf.reduce_sum(tf.squared_difference(self.real_d_features, self.generated_d_features))
-    self.g_loss = tf.reduce_mean(-tf.log(tf.clip_by_value(self.generated_d, 1e-1000000, 1.0)))
+    self.g_loss = tf.reduce_mean(-tf.log(tf.clip_by_value(self.generated_d, LOG_EPSILON, 1.0)))
 
     if not FLAGS.disable_l2_regularizer:
       self.d_loss = self.d_loss+reg_loss
@@ -432,38 +688,35 @@ class RNNGAN(object):
       self.g_loss = self.g_loss+reg_loss
     self.d_params = [v for v in tf.trainable_variables() if v.name.startswith('model/D/')]
 
+    # Fetched in place of an optimizer when G or D is frozen. Built once here,
+    # since creating ops in the training loop keeps growing the graph.
+    self.no_op = tf.no_op(name='no_op')
+
     if not is_training:
       return
 
     d_optimizer = tf.train.GradientDescentOptimizer(self._lr*FLAGS.d_lr_factor)
-    d_grads, _ = tf.clip_by_global_norm(tf.gradients(self.d_loss, self.d_params),
-                                        FLAGS.max_grad_norm)
-    self.opt_d = d_optimizer.apply_gradients(zip(d_grads, self.d_params))
+    self.opt_d = clipped_update(d_optimizer, self.d_loss, self.d_params, self.loss_scales.get('d'))
     if FLAGS.feature_matching:
-      g_grads, _ = tf.clip_by_global_norm(tf.gradients(self.g_loss_feature_matching,
-                                                       self.g_params),
-                                        FLAGS.max_grad_norm)
+      self.opt_g = clipped_update(g_optimizer, self.g_loss_feature_matching, self.g_params, self.loss_scales.get('g'))
     else:
-      g_grads, _ = tf.clip_by_global_norm(tf.gradients(self.g_loss, self.g_params),
-                                        FLAGS.max_grad_norm)
-    self.opt_g = g_optimizer.apply_gradients(zip(g_grads, self.g_params))
+      self.opt_g = clipped_update(g_optimizer, self.g_loss, self.g_params, self.loss_scales.get('g'))
 
-    self._new_lr = tf.placeholder(shape=[], name="new_learning_rate", dtype=data_type())
+    self._new_lr = tf.placeholder(shape=[], name="new_learning_rate", dtype=tf.float32)
     self._lr_update = tf.assign(self._lr, self._new_lr)
 
-  def discriminator(self, inputs, is_training, msg=''):
-    # RNN discriminator:
-    #for i in xrange(len(inputs)):
-    #  print('shape inputs[{}] {}'.format(i, inputs[i].get_shape()))
-    #inputs[0] = tf.Print(inputs[0], [inputs[0]],
+  def discriminator(self, inputs, is_training, msg='', num_passes=1):
+    # RNN discriminator, over inputs of shape [batch_size, songlength, features].
+    # With num_passes > 1, inputs are num_passes batches stacked along the batch axis.
+    batch_size = self.batch_size*num_passes
+    songlengths = tf.tile(self._songlengths, [num_passes])
+    songlength_mask = tf.tile(self._songlength_mask, [num_passes, 1])
+    #inputs = tf.Print(inputs, [inputs[:,0]],
     #        '{} inputs[0] = '.format(msg), summarize=20, first_n=20)
     if is_training and FLAGS.keep_prob < 1:
-      inputs = [tf.nn.dropout(input_, FLAGS.keep_prob) for input_ in inputs]
+      inputs = tf.nn.dropout(inputs, FLAGS.keep_prob)
     
-    #lstm_cell = tf.nn.rnn_cell.BasicLSTMCell(FLAGS.hidden_size_d, forget_bias=1.0, state_is_tuple=True)
     if is_training and FLAGS.keep_prob < 1:
-      #lstm_cell = tf.nn.rnn_cell.DropoutWrapper(
-      #lstm_cell, output_keep_prob=FLAGS.keep_prob)
       cell_fw = make_rnn_cell([FLAGS.hidden_size_d]* FLAGS.num_layers_d,dropout_keep_prob=FLAGS.keep_prob)
       
       cell_bw = make_rnn_cell([FLAGS.hidden_size_d]* FLAGS.num_layers_d,dropout_keep_prob=FLAGS.keep_prob)
@@ -471,49 +724,45 @@ class RNNGAN(object):
       cell_fw = make_rnn_cell([FLAGS.hidden_size_d]* FLAGS.num_layers_d)
       
       cell_bw = make_rnn_cell([FLAGS.hidden_size_d]* FLAGS.num_layers_d)
-    #cell_fw = tf.nn.rnn_cell.MultiRNNCell([lstm_cell for _ in range( FLAGS.num_layers_d)], state_is_tuple=True)
-    self._initial_state_fw = cell_fw.zero_state(self.batch_size, data_type())
-    if not FLAGS.unidirectional_d:
-      #lstm_cell = tf.nn.rnn_cell.BasicLSTMCell(FLAGS.hidden_size_g, forget_bias=1.0, state_is_tuple=True)
-      #if is_training and FLAGS.keep_prob < 1:
-      #  lstm_cell = tf.nn.rnn_cell.DropoutWrapper(
-      #      lstm_cell, output_keep_prob=FLAGS.keep_prob)
-      #cell_bw = tf.nn.rnn_cell.MultiRNNCell([lstm_cell for _ in range( FLAGS.num_layers_d)], state_is_tuple=True)
-      self._initial_state_bw = cell_bw.zero_state(self.batch_size, data_type())
+    self._initial_state_fw = cell_fw.zero_state(batch_size, data_type())
+    if FLAGS.rnn_cell == 'block_fused':
+      # One op per layer and direction, over the whole sequence.
+      keep_prob = FLAGS.keep_prob if is_training else 1.0
+      with tf.variable_scope('fused_rnn'):
+        with tf.variable_scope('fw'):
+          outputs = fused_lstm(inputs, [FLAGS.hidden_size_d]*FLAGS.num_layers_d, sequence_length=songlengths, dropout_keep_prob=keep_prob)
+        if not FLAGS.unidirectional_d:
+          with tf.variable_scope('bw'):
+            outputs_bw = fused_lstm(inputs, [FLAGS.hidden_size_d]*FLAGS.num_layers_d, sequence_length=songlengths, dropout_keep_prob=keep_prob, reverse=True)
+          outputs = tf.concat([outputs, outputs_bw], 2)
+    elif not FLAGS.unidirectional_d:
+      self._initial_state_bw = cell_bw.zero_state(batch_size, data_type())
       print("cell_fw",cell_fw.output_size)
-      #print("cell_bw",cell_bw.output_size)
-      #print("inputs",inputs)
-      #print("initial_state_fw",self._initial_state_fw)
-      #print("initial_state_bw",self._initial_state_bw)
-      outputs, state_fw, state_bw = tf.contrib.rnn.static_bidirectional_rnn(cell_fw, cell_bw, inputs, initial_state_fw=self._initial_state_fw, initial_state_bw=self._initial_state_bw)
-      #outputs[0] = tf.Print(outputs[0], [outputs[0]],
+      # Same variable names as tf.contrib.rnn.static_bidirectional_rnn.
+      (outputs_fw, outputs_bw), _ = tf.nn.bidirectional_dynamic_rnn(cell_fw, cell_bw, inputs, sequence_length=songlengths, initial_state_fw=self._initial_state_fw, initial_state_bw=self._initial_state_bw)
+      outputs = tf.concat([outputs_fw, outputs_bw], 2)
+      #outputs = tf.Print(outputs, [outputs[:,0]],
       #        '{} outputs[0] = '.format(msg), summarize=20, first_n=20)
-      #state = tf.concat(state_fw, state_bw)
-      #endoutput = tf.concat(concat_dim=1, values=[outputs[0],outputs[-1]])
     else:
-      outputs, state = tf.nn.rnn(cell_fw, inputs, initial_state=self._initial_state_fw)
-      #state = self._initial_state
-	  
-      #outputs, state = cell_fw(tf.convert_to_tensor (inputs),state)
-      #endoutput = outputs[-1]
+      outputs, state = tf.nn.dynamic_rnn(cell_fw, inputs, sequence_length=songlengths, initial_state=self._initial_state_fw)
 
     if FLAGS.minibatch_d:
-      outputs = [minibatch(tf.reshape(outp, shape=[FLAGS.batch_size, -1]), msg=msg, reuse_scope=(i!=0)) for i,outp in enumerate(outputs)]
+      # Minibatch discrimination compares the samples of the batch, one step at a time.
+      outputs = tf.stack([minibatch(outp, msg=msg, reuse_scope=(i!=0)) for i,outp in enumerate(tf.unstack(outputs, axis=1))], axis=1)
     # decision = tf.sigmoid(linear(outputs[-1], 1, 'decision'))
     if FLAGS.end_classification:
-      decisions = [tf.sigmoid(linear(output, 1, 'decision', reuse_scope=(i!=0))) for i,output in enumerate([outputs[0], outputs[-1]])]
-      decisions = tf.stack(decisions)
-      decisions = tf.transpose(decisions, perm=[1,0,2])
+      # The first output, and the last output before the padding.
+      last_output = tf.gather_nd(outputs, tf.stack([tf.range(batch_size), songlengths-1], axis=1))
+      decisions = tf.sigmoid(time_distributed(linear, tf.stack([outputs[:,0], last_output], axis=1), 1, 'decision'))
       print('shape, decisions: {}'.format(decisions.get_shape()))
+      decision = tf.reduce_mean(decisions, reduction_indices=[1,2])
     else:
-      decisions = [tf.sigmoid(linear(output, 1, 'decision', reuse_scope=(i!=0))) for i,output in enumerate(outputs)]
-      decisions = tf.stack(decisions)
-      decisions = tf.transpose(decisions, perm=[1,0,2])
+      decisions = tf.sigmoid(time_distributed(linear, outputs, 1, 'decision'))
       print('shape, decisions: {}'.format(decisions.get_shape()))
-    decision = tf.reduce_mean(decisions, reduction_indices=[1,2])
-    decision = tf.Print(decision, [decision],
-            '{} decision = '.format(msg), summarize=20, first_n=20)
-    return (decision,tf.transpose(tf.stack(outputs), perm=[1,0,2]))
+      decision = tf.reduce_sum(tf.squeeze(decisions, [2])*songlength_mask, 1)/tf.reduce_sum(songlength_mask, 1)
+    decision = debug_print(decision, [decision],
+            '{} decision = '.format(msg))
+    return (decision,outputs)
       
 
   
@@ -532,6 +781,10 @@ class RNNGAN(object):
   def input_metadata(self):
     return self._input_metadata
 
+  @property
+  def input_songlength(self):
+    return self._input_songlength
+
   @property
   def targets(self):
     return self._targets
@@ -558,7 +811,142 @@ class RNNGAN(object):
 
 
 
-def run_epoch(session, model, loader, datasetlabel, eval_op_g, eval_op_d, pretraining=False, verbose=False, run_metadata=None, pretraining_d=False):
+class Generator(object):
+  """
+  Inference-only graph of G: no D, losses or optimizers, and the batch size
+  and songlength are given at run time. Uses the variable names of RNNGAN,
+  so the G variables are restored from a training checkpoint.
+
+  generate() makes any number of songs, in runs of at most max_batch_size.
+
+  The LSTM state of G is an input (default: zero) and an output, flattened
+  to [batch_size, state_size], and so is the last generated point. Feeding
+  both back in, with the meta of the first run, continues the songs, so long
+  songs can be generated chunk by chunk in bounded memory
+  (exported_generator.ExportedGenerator.generate_stream()).
+  """
+  def __init__(self, num_song_features, num_meta_features, max_batch_size=None):
+    self.num_song_features = num_song_features
+    self.num_meta_features = num_meta_features
+    self.max_batch_size = max_batch_size or FLAGS.batch_size
+    self._batch_size = tf.placeholder(tf.int32, shape=[], name='batch_size')
+    self._songlength = tf.placeholder(tf.int32, shape=[], name='songlength')
+    self._meta = None
+    with tf.variable_scope('model', custom_getter=variable_getter()):
+      with tf.variable_scope('G'):
+        cell = make_rnn_cell([FLAGS.hidden_size_g]*FLAGS.num_layers_g)
+        zero_state = cell.zero_state(self._batch_size, data_type())
+        state_sizes = nest.flatten(cell.state_size)
+        self.state_size = sum(state_sizes)
+        self._state = tf.placeholder_with_default(tf.concat(nest.flatten(zero_state), axis=1), shape=[None, self.state_size], name='state')
+        initial_state = nest.pack_sequence_as(zero_state, tf.split(self._state, state_sizes, axis=1))
+        self._meta_inputs = None
+        self.num_meta_random_features = 0
+        if FLAGS.generate_meta:
+          # Generated from noise that can be fed (for reproducible songs),
+          # unless fed to condition the songs.
+          self.num_meta_random_features = int(FLAGS.random_input_scale*num_meta_features)
+          meta_inputs = tf.random_uniform(shape=tf.stack([self._batch_size, self.num_meta_random_features]), minval=0.0, maxval=1.0, dtype=data_type())
+          self._meta_inputs = tf.placeholder_with_default(meta_inputs, shape=[None, self.num_meta_random_features], name='meta_inputs')
+          self._meta = tf.placeholder_with_default(meta_generator(self._batch_size, num_meta_features, self._meta_inputs), shape=[None, num_meta_features], name='meta')
+        # The noise can be fed too, e.g. to make generation reproducible
+        # from a seed.
+        self.num_random_features = int(FLAGS.random_input_scale*num_song_features)
+        random_rnninputs = tf.random_uniform(shape=tf.stack([self._batch_size, self._songlength, self.num_random_features]), minval=0.0, maxval=1.0, dtype=data_type())
+        self._random_inputs = tf.placeholder_with_default(random_rnninputs, shape=[None, None, self.num_random_features], name='random_inputs')
+        generated_point = tf.random_uniform(shape=tf.stack([self._batch_size, num_song_features]), minval=0.0, maxval=1.0, dtype=data_type())
+        self._initial_point = tf.placeholder_with_default(generated_point, shape=[None, num_song_features], name='initial_point')
+        self._generated_features, final_state = generator(cell, self._random_inputs, self._initial_point, initial_state, self._meta)
+        self._final_state = tf.concat(nest.flatten(final_state), axis=1, name='final_state')
+        self._last_point = tf.identity(self._generated_features[:,-1,:], name='last_point')
+    self.variables = [v for v in tf.global_variables() if v.name.startswith('model/G/')]
+    self._saver = tf.train.Saver(self.variables)
+
+  def restore(self, session, traindir):
+    """Restores G from the latest checkpoint in traindir."""
+    checkpoint_path = tf.train.latest_checkpoint(traindir)
+    if checkpoint_path is None:
+      raise ValueError('No checkpoint found in {}.'.format(traindir))
+    print("Reading generator parameters from %s" % checkpoint_path)
+    self._saver.restore(session, checkpoint_path)
+
+  def export(self, session, export_dir, config=None):
+    """
+    Writes G as a SavedModel to export_dir, with a 'generate' signature:
+    inputs batch_size, songlength, random_inputs and initial_point (noise
+    with defaults), state (default zero), and meta and meta_inputs (the
+    noise meta is generated from, when meta is not fed) with --generate_meta,
+    outputs songs, final_state, last_point and meta (with --generate_meta).
+    config, a dict, is written next to it as generator_config.json, for
+    exported_generator.ExportedGenerator.
+    """
+    inputs = {'batch_size': self._batch_size, 'songlength': self._songlength,
+              'random_inputs': self._random_inputs, 'initial_point': self._initial_point, 'state': self._state}
+    outputs = {'songs': self._generated_features, 'final_state': self._final_state, 'last_point': self._last_point}
+    if self._meta is not None:
+      inputs['meta'] = self._meta
+      inputs['meta_inputs'] = self._meta_inputs
+      outputs['meta'] = self._meta
+    signature = tf.saved_model.signature_def_utils.predict_signature_def(inputs=inputs, outputs=outputs)
+    builder = tf.saved_model.builder.SavedModelBuilder(export_dir)
+    builder.add_meta_graph_and_variables(session, [tf.saved_model.tag_constants.SERVING], signature_def_map={'generate': signature})
+    builder.save()
+    config = dict(config or {})
+    config.update({'num_song_features': self.num_song_features, 'num_meta_features': self.num_meta_features,
+                   'num_random_features': self.num_random_features, 'state_size': self.state_size, 'max_batch_size': self.max_batch_size,
+                   'num_meta_random_features': self.num_meta_random_features,
+                   'data_type': data_type().name, 'generate_meta': self._meta is not None})
+    with open(os.path.join(export_dir, 'generator_config.json'), 'w') as f:
+      json.dump(config, f, indent=2, sort_keys=True)
+    print('Exported generator to {}.'.format(export_dir))
+
+  def generate(self, session, n_songs, songlength, conditioning=None):
+    """
+    Generates n_songs songs of songlength events, in
+    ceil(n_songs/max_batch_size) runs.
+
+    conditioning (only with --generate_meta) is the composer and genre
+    to generate, [num_meta_features] for all songs or [n_songs, num_meta_features].
+    Otherwise they are generated too.
+
+    Returns an array [n_songs, songlength, num_song_features].
+    """
+    if conditioning is not None:
+      if self._meta is None:
+        raise ValueError('Conditioning needs a model trained with --generate_meta.')
+      conditioning = np.broadcast_to(conditioning, [n_songs, self.num_meta_features])
+    songs = []
+    for start in range(0, n_songs, self.max_batch_size):
+      batch_size = min(self.max_batch_size, n_songs-start)
+      feed_dict = {self._batch_size: batch_size, self._songlength: songlength}
+      if conditioning is not None:
+        feed_dict[self._meta] = conditioning[start:start+batch_size]
+      songs.append(session.run(self._generated_features, feed_dict))
+    return np.concatenate(songs, axis=0)
+
+def epoch_feed_dicts(session, model, loader, datasetlabel, songlength=None):
+  """
+  Yields the feed_dict for each step of one epoch over datasetlabel.
+  With --dataset_input the batches come from model.input_data, and this
+  keeps yielding until session.run raises tf.errors.OutOfRangeError.
+  The model trains on the first songlength events (default: all of them).
+  """
+  if model.input_data is not None:
+    feed_dict = model.input_data.start(session, datasetlabel, window_length=songlength)
+    if songlength is not None:
+      feed_dict[model.input_songlength] = songlength
+    while True:
+      yield feed_dict
+  else:
+    for batch_meta, batch_song in loader.iterate_batches(model.batch_size, model.songlength, part=datasetlabel, prefetch=FLAGS.prefetch_batches, window_length=songlength):
+      feed_dict = {}
+      feed_dict[model.input_songdata.name] = batch_song
+      feed_dict[model.input_metadata.name] = batch_meta
+      if songlength is not None:
+        feed_dict[model.input_songlength] = songlength
+      yield feed_dict
+
+def run_epoch(session, model, loader, datasetlabel, eval_op_g, eval_op_d, pretraining=False, verbose=False, run_metadata=None, pretraining_d=False, songlength=None):
   """Runs the model on the given data."""
   #epoch_size = ((len(data) // model.batch_size) - 1) // model.songlength
   epoch_start_time = time.time()
@@ -571,12 +959,11 @@ def run_epoch(session, model, loader, datasetlabel, eval_op_g, eval_op_d, pretra
   times_in_graph = []
   times_in_python = []
   #times_in_batchreading = []
-  loader.rewind(part=datasetlabel)
-  [batch_meta, batch_song] = loader.get_batch(model.batch_size, model.songlength, part=datasetlabel)
+  feed_dicts = epoch_feed_dicts(session, model, loader, datasetlabel, songlength=songlength)
 
   run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
 
-  while batch_meta is not None and batch_song is not None:
+  for feed_dict in feed_dicts:
     op_g = eval_op_g
     op_d = eval_op_d
     if datasetlabel == 'train' and not pretraining: # and not FLAGS.feature_matching:
@@ -587,28 +974,25 @@ def run_epoch(session, model, loader, datasetlabel, eval_op_g, eval_op_d, pretra
         #break
       elif d_loss == 0.0:
         #print('D train loss is zero. Freezing optimization. G loss: {:.3f}'.format(g_loss))
-        op_g = tf.no_op()
+        op_g = model.no_op
       elif g_loss == 0.0: 
         #print('G train loss is zero. Freezing optimization. D loss: {:.3f}'.format(d_loss))
-        op_d = tf.no_op()
+        op_d = model.no_op
       elif g_loss < 2.0 or d_loss < 2.0:
         if g_loss*.7 > d_loss:
           #print('G train loss is {:.3f}, D train loss is {:.3f}. Freezing optimization of D'.format(g_loss, d_loss))
-          op_g = tf.no_op()
+          op_g = model.no_op
         #elif d_loss*.7 > g_loss:
           #print('G train loss is {:.3f}, D train loss is {:.3f}. Freezing optimization of G'.format(g_loss, d_loss))
-        op_d = tf.no_op()
+        op_d = model.no_op
     #fetches = [model.cost, model.final_state, eval_op]
     if pretraining:
       if pretraining_d:
         fetches = [model.rnn_pretraining_loss, model.d_loss, op_g, op_d]
       else:
-        fetches = [model.rnn_pretraining_loss, tf.no_op(), op_g, op_d]
+        fetches = [model.rnn_pretraining_loss, model.no_op, op_g, op_d]
     else:
       fetches = [model.g_loss, model.d_loss, op_g, op_d]
-    feed_dict = {}
-    feed_dict[model.input_songdata.name] = batch_song
-    feed_dict[model.input_metadata.name] = batch_meta
     #print(batch_song)
     #print(batch_song.shape)
     
@@ -619,10 +1003,14 @@ def run_epoch(session, model, loader, datasetlabel, eval_op_g, eval_op_d, pretra
     time_before_graph = time.time()
     if iters > 0:
       times_in_python.append(time_before_graph-time_after_graph)
-    if run_metadata:
-      g_loss, d_loss, _, _ = session.run(fetches, feed_dict, options=run_options, run_metadata=run_metadata)
-    else:
-      g_loss, d_loss, _, _ = session.run(fetches, feed_dict)
+    try:
+      if run_metadata:
+        g_loss, d_loss, _, _ = session.run(fetches, feed_dict, options=run_options, run_metadata=run_metadata)
+      else:
+        g_loss, d_loss, _, _ = session.run(fetches, feed_dict)
+    except tf.errors.OutOfRangeError:
+      # End of the dataset (--dataset_input).
+      break
     time_after_graph = time.time()
     if iters > 0:
       times_in_graph.append(time_after_graph-time_before_graph)
@@ -640,9 +1028,7 @@ def run_epoch(session, model, loader, datasetlabel, eval_op_g, eval_op_d, pretra
         print("{}: {} (pretraining) batch loss: G: {:.3f}, avg loss: G: {:.3f}, speed: {:.1f} songs/s, avg in graph: {:.1f}, avg in python: {:.1f}.".format(datasetlabel, iters, g_loss, float(g_losses)/float(iters), songs_per_sec, avg_time_in_graph, avg_time_in_python))
       else:
         print("{}: {} batch loss: G: {:.3f}, D: {:.3f}, avg loss: G: {:.3f}, D: {:.3f} speed: {:.1f} songs/s, avg in graph: {:.1f}, avg in python: {:.1f}.".format(datasetlabel, iters, g_loss, d_loss, float(g_losses)/float(iters), float(d_losses)/float(iters),songs_per_sec, avg_time_in_graph, avg_time_in_python))
-    #batchtime = time.time()
-    [batch_meta, batch_song] = loader.get_batch(model.batch_size, model.songlength, part=datasetlabel)
-    #times_in_batchreading.append(time.time()-batchtime)
+  feed_dicts.close()
 
   if iters == 0:
     return (None,None)
@@ -655,25 +1041,95 @@ def run_epoch(session, model, loader, datasetlabel, eval_op_g, eval_op_d, pretra
   return (g_mean_loss, d_mean_loss)
 
 
-def sample(session, model, batch=False):
+def sample(session, model, batch=False, songlength=None):
   """Samples from the generative model."""
   #state = session.run(model.initial_state)
   fetches = [model.generated_features]
   feed_dict = {}
   generated_features, = session.run(fetches, feed_dict)
+  if songlength is not None:
+    generated_features = generated_features[:,:songlength,:]
   #print( generated_features)
-  print( generated_features[0].shape)
-  # The following worked when batch_size=1.
-  # generated_features = [np.squeeze(x, axis=0) for x in generated_features]
+  print( generated_features.shape)
+  # generated_features is [batch_size, songlength, num_song_features].
   # If batch_size != 1, we just pick the first sample. Wastefull, yes.
   returnable = []
   if batch:
-    for batchno in range(generated_features[0].shape[0]):
-      returnable.append([x[batchno,:] for x in generated_features])
+    for batchno in range(generated_features.shape[0]):
+      returnable.append(list(generated_features[batchno]))
   else:
-    returnable = [x[0,:] for x in generated_features]
+    returnable = list(generated_features[0])
   return returnable
 
+def benchmark_train_step(num_song_features, num_meta_features, num_steps=10):
+  """
+  Builds a fresh model from the current FLAGS and runs the adversarial
+  training step (opt_d and opt_g) on random data, on CPU.
+  Returns (steps/s, peak bytes allocated during one traced step).
+  """
+  with tf.Graph().as_default(), tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})) as session:
+    with tf.variable_scope("model", reuse=None, custom_getter=variable_getter()):
+      m = RNNGAN(is_training=True, num_song_features=num_song_features, num_meta_features=num_meta_features)
+    session.run(tf.global_variables_initializer())
+    feed_dict = {m.input_songdata: np.random.uniform(size=m.input_songdata.get_shape().as_list()),
+                 m.input_metadata: np.random.uniform(size=m.input_metadata.get_shape().as_list())}
+    # The first steps include one-off setup costs.
+    for _ in range(2):
+      session.run([m.opt_d, m.opt_g], feed_dict)
+    start_time = time.time()
+    for _ in range(num_steps):
+      session.run([m.opt_d, m.opt_g], feed_dict)
+    steps_per_s = num_steps/(time.time()-start_time)
+    run_metadata = tf.RunMetadata()
+    session.run([m.opt_d, m.opt_g], feed_dict, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+    peak_bytes = max([memory.peak_bytes for dev_stats in run_metadata.step_stats.dev_stats for node_stats in dev_stats.node_stats for memory in node_stats.memory] or [0])
+  return (steps_per_s, peak_bytes)
+
+def benchmark_rnn_cells(num_song_features, num_meta_features, hidden_sizes=(100, 200, 500, 1000, 1500), num_steps=10):
+  """
+  Prints steps/s of the adversarial training step on CPU, for each
+  --rnn_cell and hidden size (used for both hidden_size_g and hidden_size_d).
+  """
+  saved_flags = (FLAGS.rnn_cell, FLAGS.hidden_size_g, FLAGS.hidden_size_d)
+  results = []
+  try:
+    for rnn_cell in ['basic', 'block', 'block_fused']:
+      for hidden_size in hidden_sizes:
+        FLAGS.rnn_cell = rnn_cell
+        FLAGS.hidden_size_g = hidden_size
+        FLAGS.hidden_size_d = hidden_size
+        steps_per_s, _ = benchmark_train_step(num_song_features, num_meta_features, num_steps)
+        results.append((rnn_cell, hidden_size, steps_per_s))
+  finally:
+    FLAGS.rnn_cell, FLAGS.hidden_size_g, FLAGS.hidden_size_d = saved_flags
+  print('rnn_cell     hidden_size steps/s')
+  for rnn_cell, hidden_size, steps_per_s in results:
+    print('{:12} {:11} {:.3f}'.format(rnn_cell, hidden_size, steps_per_s))
+  return results
+
+def benchmark_float16(num_song_features, num_meta_features, hidden_sizes=(100, 500, 1500), num_steps=10):
+  """
+  Prints steps/s and peak memory of the adversarial training step on CPU,
+  in float32 and with --float16, for each hidden size (used for both
+  hidden_size_g and hidden_size_d).
+  """
+  saved_flags = (FLAGS.float16, FLAGS.hidden_size_g, FLAGS.hidden_size_d)
+  results = []
+  try:
+    for hidden_size in hidden_sizes:
+      for float16 in [False, True]:
+        FLAGS.float16 = float16
+        FLAGS.hidden_size_g = hidden_size
+        FLAGS.hidden_size_d = hidden_size
+        steps_per_s, peak_bytes = benchmark_train_step(num_song_features, num_meta_features, num_steps)
+        results.append((data_type().name, hidden_size, steps_per_s, peak_bytes))
+  finally:
+    FLAGS.float16, FLAGS.hidden_size_g, FLAGS.hidden_size_d = saved_flags
+  print('data_type hidden_size steps/s   peak MB')
+  for dtype, hidden_size, steps_per_s, peak_bytes in results:
+    print('{:9} {:11} {:9.3f} {:7.1f}'.format(dtype, hidden_size, steps_per_s, peak_bytes/2.0**20))
+  return results
+
 def main(_):
   if not FLAGS.datadir:
     raise ValueError("Must set --datadir to midi music dir.")
@@ -715,7 +1171,7 @@ def main(_):
     print('Training on synthetic chords!')
   if FLAGS.composer is not None:
     print('Single composer: {}'.format(FLAGS.composer))
-  loader = music_data_utils.MusicDataLoader(FLAGS.datadir, FLAGS.select_validation_percentage, FLAGS.select_test_percentage, FLAGS.works_per_composer, FLAGS.pace_events, synthetic=synthetic, tones_per_cell=FLAGS.tones_per_cell, single_composer=FLAGS.composer)
+  loader = music_data_utils.MusicDataLoader(FLAGS.datadir, FLAGS.select_validation_percentage, FLAGS.select_test_percentage, FLAGS.works_per_composer, FLAGS.pace_events, synthetic=synthetic, tones_per_cell=FLAGS.tones_per_cell, single_composer=FLAGS.composer, use_cache=not FLAGS.disable_data_cache, num_workers=FLAGS.data_workers)
   if FLAGS.synthetic_chords:
     # This is just a print out, to check the generated data.
     batch = loader.get_batch(batchsize=1, songlength=400)
@@ -726,6 +1182,32 @@ def main(_):
   num_meta_features = loader.get_num_meta_features()
   print('num_meta_features:{}'.format(num_meta_features))
 
+  if FLAGS.benchmark_rnn_cells:
+    benchmark_rnn_cells(num_song_features, num_meta_features)
+    return
+  if FLAGS.benchmark_float16:
+    benchmark_float16(num_song_features, num_meta_features)
+    return
+
+  if FLAGS.export_dir:
+    with tf.Graph().as_default(), tf.Session() as session:
+      song_generator = Generator(num_song_features, num_meta_features)
+      song_generator.restore(session, FLAGS.traindir)
+      song_generator.export(session, FLAGS.export_dir, config={'genres': loader.genres, 'composers': loader.composers, 'tones_per_cell': FLAGS.tones_per_cell, 'songlength': FLAGS.songlength})
+    return
+
+  if FLAGS.sample:
+    # Only G is needed, in a graph that generates any number of songs.
+    with tf.Graph().as_default(), tf.Session(config=tf.ConfigProto(log_device_placement=FLAGS.log_device_placement)) as session:
+      song_generator = Generator(num_song_features, num_meta_features)
+      song_generator.restore(session, FLAGS.traindir)
+      songs = song_generator.generate(session, FLAGS.num_samples, FLAGS.songlength)
+    for k,song_data in enumerate(songs):
+      filename = os.path.join(generated_data_dir, 'out-{}-sample-{}-{}.mid'.format(experiment_label, k, datetime.datetime.today().strftime('%Y-%m-%d-%H-%M-%S')))
+      loader.save_data(filename, list(song_data))
+      print('Saved {}.'.format(filename))
+    return
+
   train_start_time = time.time()
   checkpoint_path = os.path.join(FLAGS.traindir, "model.ckpt")
 
@@ -735,10 +1217,31 @@ def main(_):
     FLAGS.songlength = int(min(((global_step+10)/10)*10,songlength_ceiling))
     FLAGS.songlength = int(min((global_step+1)*4,songlength_ceiling))
  
+  # The songlength curriculum trains on the first FLAGS.songlength events, using
+  # the model of the smallest bucket that fits. A bucket's model is built on
+  # first use, so each is built at most once.
+  num_buckets = max(FLAGS.songlength_buckets, 1)
+  songlength_buckets = sorted(set((songlength_ceiling*(k+1)+num_buckets-1)//num_buckets for k in range(num_buckets)))
+  print('songlength buckets: {}'.format(songlength_buckets))
+  models = {}
+
   with tf.Graph().as_default(), tf.Session(config=tf.ConfigProto(log_device_placement=FLAGS.log_device_placement)) as session:
-    with tf.variable_scope("model", reuse=None) as scope:
-      scope.set_regularizer(tf.contrib.layers.l2_regularizer(scale=FLAGS.reg_scale))
-      m = RNNGAN(is_training=True, num_song_features=num_song_features, num_meta_features=num_meta_features)
+    def get_model(songlength):
+      bucket = min(b for b in songlength_buckets if b >= songlength)
+      if bucket not in models:
+        existing_variables = set(tf.global_variables())
+        with tf.variable_scope("model", reuse=(len(models) > 0), custom_getter=variable_getter()) as scope:
+          scope.set_regularizer(tf.contrib.layers.l2_regularizer(scale=FLAGS.reg_scale))
+          input_data = None
+          if FLAGS.dataset_input:
+            input_data = DatasetInput(loader, FLAGS.batch_size, bucket, num_song_features, num_meta_features)
+          models[bucket] = RNNGAN(is_training=True, num_song_features=num_song_features, num_meta_features=num_meta_features, input_data=input_data, songlength=bucket)
+        if len(models) > 1:
+          # Variables that are not shared with the first model (learning rate, optimizer slots).
+          session.run(tf.variables_initializer([v for v in tf.global_variables() if v not in existing_variables]))
+      return models[bucket]
+
+    m = get_model(FLAGS.songlength)
 
 
     if FLAGS.initialize_d:
@@ -781,11 +1284,15 @@ def main(_):
         else:
           new_songlength = songlength_ceiling
         if new_songlength != FLAGS.songlength:
-          print('Changing songlength, now training on {} events from songs.'.format(new_songlength))
           FLAGS.songlength = new_songlength
-          with tf.variable_scope("model", reuse=True) as scope:
-            scope.set_regularizer(tf.contrib.layers.l2_regularizer(scale=FLAGS.reg_scale))
-            m = RNNGAN(is_training=True, num_song_features=num_song_features, num_meta_features=num_meta_features)
+          m = get_model(FLAGS.songlength)
+          print('Changing songlength, now training on {} events from songs (model songlength {}).'.format(new_songlength, m.songlength))
+
+        if FLAGS.songlength == songlength_ceiling and not session.graph.finalized:
+          # No more models are built from here on. Any op created by
+          # mistake in the loop below now raises instead of growing the graph.
+          print('Finalizing graph: {} ops.'.format(len(session.graph.get_operations())))
+          session.graph.finalize()
 
         if not FLAGS.adam:
           m.assign_lr(session, FLAGS.learning_rate * lr_decay)
@@ -795,10 +1302,10 @@ def main(_):
 
         print("Epoch: {} Learning rate: {:.3f}, pretraining: {}".format(i, session.run(m.lr), (i<FLAGS.pretraining_epochs)))
         if i<FLAGS.pretraining_epochs:
-          opt_d = tf.no_op()
+          opt_d = m.no_op
           if FLAGS.pretraining_d:
             opt_d = m.opt_d
-          train_g_loss,train_d_loss = run_epoch(session, m, loader, 'train', m.opt_pretraining, opt_d, pretraining = True, verbose=True, run_metadata=run_metadata, pretraining_d=FLAGS.pretraining_d)
+          train_g_loss,train_d_loss = run_epoch(session, m, loader, 'train', m.opt_pretraining, opt_d, pretraining = True, verbose=True, run_metadata=run_metadata, pretraining_d=FLAGS.pretraining_d, songlength=FLAGS.songlength)
           if FLAGS.pretraining_d:
             try:
               print("Epoch: {} Pretraining loss: G: {:.3f}, D: {:.3f}".format(i, train_g_loss, train_d_loss))
@@ -808,12 +1315,12 @@ def main(_):
           else:
             print("Epoch: {} Pretraining loss: G: {:.3f}".format(i, train_g_loss))
         else:
-          train_g_loss,train_d_loss = run_epoch(session, m, loader, 'train', m.opt_d, m.opt_g, verbose=True, run_metadata=run_metadata)
+          train_g_loss,train_d_loss = run_epoch(session, m, loader, 'train', m.opt_d, m.opt_g, verbose=True, run_metadata=run_metadata, songlength=FLAGS.songlength)
           try:
             print("Epoch: {} Train loss: G: {:.3f}, D: {:.3f}".format(i, train_g_loss, train_d_loss))
           except:
             print("Epoch: {} Train loss: G: {}, D: {}".format(i, train_g_loss, train_d_loss))
-        valid_g_loss,valid_d_loss = run_epoch(session, m, loader, 'validation', tf.no_op(), tf.no_op())
+        valid_g_loss,valid_d_loss = run_epoch(session, m, loader, 'validation', m.no_op, m.no_op, songlength=FLAGS.songlength)
         try:
           print("Epoch: {} Valid loss: G: {:.3f}, D: {:.3f}".format(i, valid_g_loss, valid_d_loss))
         except:
@@ -867,16 +1374,17 @@ def main(_):
         except:
           print('failed to run gnuplot. Please do so yourself: gnuplot gnuplot-commands.txt cwd={}'.format(plots_dir))
         
-        song_data = sample(session, m, batch=True)
-        midi_patterns = []
+        song_data = sample(session, m, batch=True, songlength=FLAGS.songlength)
         print('formatting midi...')
         midi_time = time.time()
-        for d in song_data:
-          midi_patterns.append(loader.get_midi_pattern(d))
+        # The conversion is vectorized over the batch; midi objects are
+        # only made from the event arrays for saving and statistics.
+        event_arrays = loader.get_midi_event_arrays(song_data)
+        midi_patterns = [loader.midi_pattern_from_event_array(events) for events in event_arrays]
         print('done. time: {}'.format(time.time()-midi_time))
         
         filename = os.path.join(generated_data_dir, 'out-{}-{}-{}.mid'.format(experiment_label, i, datetime.datetime.today().strftime('%Y-%m-%d-%H-%M-%S')))
-        loader.save_midi_pattern(filename, midi_patterns[0])
+        loader.save_midi_events(filename, event_arrays[0])
   
         stats = []
         print('getting stats...')
@@ -907,7 +1415,7 @@ def main(_):
         sys.stdout.flush()
 
 
-      test_g_loss,test_d_loss = run_epoch(session, m, loader, 'test', tf.no_op(), tf.no_op())
+      test_g_loss,test_d_loss = run_epoch(session, m, loader, 'test', m.no_op, m.no_op)
       print("Test loss G: %.3f, D: %.3f" %(test_g_loss, test_d_loss))
 
     song_data = sample(session, m)
@@ -0,0 +1,198 @@
+# Tests for music_data_utils.py.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+
+Checks the vectorized parts of MusicDataLoader against the loops they
+replaced. Skipped when midi (imported by music_data_utils) is not installed.
+
+$ python -m pytest -q test_music_data_utils.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os, random, shutil, tempfile, unittest
+
+import numpy as np
+
+try:
+  import midi
+  import music_data_utils
+  from music_data_utils import BEGIN_TICK, LENGTH, FREQ, VELOCITY, TICKS_FROM_PREV_START, NUM_FEATURES_PER_TONE, SONG_DATA
+except ImportError:
+  music_data_utils = None
+
+def make_loader(tones_per_cell=1):
+  return music_data_utils.MusicDataLoader(datadir=None, select_validation_percentage=0.0, select_test_percentage=0.0, tones_per_cell=tones_per_cell)
+
+def random_song(rng, num_notes):
+  """Song data with chords of up to 6 tones (notes at the same begin tick)."""
+  song_data = np.zeros([num_notes, NUM_FEATURES_PER_TONE+1], dtype=music_data_utils.SONG_DATA_DTYPE)
+  song_data[:,BEGIN_TICK] = np.cumsum(rng.choice([0, 0, 0, 12, 48, 96], size=num_notes))
+  song_data[:,LENGTH] = rng.randint(1, 400, size=num_notes)
+  song_data[:,FREQ] = rng.uniform(50, 2000, size=num_notes)
+  song_data[:,VELOCITY] = rng.randint(1, 128, size=num_notes)
+  return song_data
+
+def reference_song_matrix(song_data, begin, songlength, tones_per_cell):
+  """The per-event loop get_batch used before fill_song_matrix."""
+  num_song_features = NUM_FEATURES_PER_TONE*tones_per_cell+1
+  songmatrix = np.ndarray(shape=[songlength, num_song_features])
+  matrixrow = 0
+  n = begin
+  while matrixrow < songlength:
+    event = np.zeros(shape=[num_song_features])
+    # (Set before the song end check, for empty songs.)
+    tone_count = 1
+    if n < len(song_data):
+      event[LENGTH]   = song_data[n][LENGTH]
+      event[FREQ]     = song_data[n][FREQ]
+      event[VELOCITY] = song_data[n][VELOCITY]
+      ticks_from_start_of_prev_tone = 0.0
+      if n>0:
+        # beginning of this tone, minus starting of previous
+        ticks_from_start_of_prev_tone = song_data[n][BEGIN_TICK]-song_data[n-1][BEGIN_TICK]
+      event[TICKS_FROM_PREV_START] = ticks_from_start_of_prev_tone
+      for simultaneous in range(1,tones_per_cell):
+        if n+simultaneous >= len(song_data):
+          break
+        if song_data[n+simultaneous][BEGIN_TICK]-song_data[n][BEGIN_TICK] == 0:
+          offset = simultaneous*NUM_FEATURES_PER_TONE
+          event[offset+LENGTH]   = song_data[n+simultaneous][LENGTH]
+          event[offset+FREQ]     = song_data[n+simultaneous][FREQ]
+          event[offset+VELOCITY] = song_data[n+simultaneous][VELOCITY]
+          tone_count += 1
+        else:
+          break
+    songmatrix[matrixrow,:] = event
+    matrixrow += 1
+    n += tone_count
+  return songmatrix
+
+@unittest.skipIf(music_data_utils is None, 'needs midi')
+class GetBatchTest(unittest.TestCase):
+  def test_fill_song_matrix_matches_loop(self):
+    rng = np.random.RandomState(0)
+    for tones_per_cell in range(1, 5):
+      loader = make_loader(tones_per_cell)
+      num_song_features = loader.get_num_song_features()
+      for num_notes in [0, 1, 2, 7, 30, 200]:
+        song_data = random_song(rng, num_notes)
+        for songlength in [1, 5, 40]:
+          for begin in sorted(set([0, num_notes//3, max(num_notes-1, 0)])):
+            songmatrix = np.zeros([songlength, num_song_features])
+            loader.fill_song_matrix(songmatrix, song_data, begin)
+            np.testing.assert_array_equal(songmatrix, reference_song_matrix(song_data, begin, songlength, tones_per_cell),
+                                          'tones_per_cell {}, {} notes, songlength {}, begin {}'.format(tones_per_cell, num_notes, songlength, begin))
+
+  def test_get_batch_matches_loop(self):
+    rng = np.random.RandomState(1)
+    songlength, batchsize = 16, 5
+    for tones_per_cell in range(1, 5):
+      loader = make_loader(tones_per_cell)
+      loader.genres = ['classical', 'jazz']
+      loader.composers = ['a', 'b', 'c']
+      loader.songs = {'train': [[rng.choice(loader.genres), rng.choice(loader.composers), random_song(rng, rng.randint(0, 150))] for _ in range(3*batchsize)]}
+      # get_batch draws each song's begin with random.randint; replay them.
+      random.seed(tones_per_cell)
+      state = random.getstate()
+      loader.rewind('train')
+      while True:
+        batch_meta, batch_songs = loader.get_batch(batchsize, songlength, 'train')
+        if batch_meta is None:
+          break
+        start = loader.pointer['train']-batchsize
+        after = random.getstate()
+        random.setstate(state)
+        for s,song in enumerate(loader.songs['train'][start:start+batchsize]):
+          song_data = song[SONG_DATA]
+          begin = 0
+          if len(song_data) > songlength*tones_per_cell:
+            begin = random.randint(0, len(song_data)-songlength*tones_per_cell)
+          np.testing.assert_array_equal(batch_songs[s], reference_song_matrix(song_data, begin, songlength, tones_per_cell))
+          self.assertEqual(batch_meta[s].tolist().index(1), loader.genres.index(song[0]))
+          self.assertEqual(batch_meta[s].tolist().index(1, len(loader.genres)), len(loader.genres)+loader.composers.index(song[1]))
+        self.assertEqual(random.getstate(), after)
+        state = after
+
+  def test_window_length(self):
+    # A longer matrix (e.g. a songlength bucket) starts at the same random
+    # position as a window_length one; the events after it come after.
+    rng = np.random.RandomState(2)
+    window_length, songlength, batchsize = 8, 20, 4
+    for tones_per_cell in range(1, 3):
+      loader = make_loader(tones_per_cell)
+      loader.genres = ['classical']
+      loader.composers = ['a']
+      loader.songs = {'train': [['classical', 'a', random_song(rng, rng.randint(0, 100))] for _ in range(3*batchsize)]}
+      random.seed(tones_per_cell)
+      windows = list(loader.iterate_batches(batchsize, window_length, 'train'))
+      random.seed(tones_per_cell)
+      batches = list(loader.iterate_batches(batchsize, songlength, 'train', window_length=window_length))
+      self.assertEqual(len(batches), len(windows))
+      for (_, window_songs),(_, batch_songs) in zip(windows, batches):
+        self.assertEqual(batch_songs.shape[1], songlength)
+        np.testing.assert_array_equal(batch_songs[:,:window_length], window_songs)
+
+@unittest.skipIf(music_data_utils is None, 'needs midi')
+class MidiFileBytesTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.loader = make_loader()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def write_midifile_bytes(self, events):
+    """What midi.write_midifile writes for the pattern of events."""
+    filename = os.path.join(self.tmpdir, 'song.mid')
+    midi.write_midifile(filename, self.loader.midi_pattern_from_event_array(events))
+    with open(filename, 'rb') as f:
+      return f.read()
+
+  def assert_same_bytes(self, events):
+    self.assertEqual(self.loader.get_midi_file_bytes(events), self.write_midifile_bytes(events))
+
+  def events(self, rows):
+    return np.array(rows, dtype=music_data_utils.MIDI_EVENT_DTYPE)
+
+  def test_empty_song(self):
+    self.assert_same_bytes(self.events([]))
+
+  def test_running_status(self):
+    # Runs of note ons and of note offs share a status byte.
+    self.assert_same_bytes(self.events([(0, True, 60, 80), (0, True, 64, 80), (10, False, 60, 0), (0, False, 64, 0),
+                                        (5, True, 67, 90), (5, False, 67, 0), (0, True, 72, 1), (0, True, 0, 127)]))
+
+  def test_delta_time_boundaries(self):
+    # One byte up to 127, two up to 16383, three up to 2097151, then four.
+    ticks = [0, 1, 127, 128, 129, 16383, 16384, 16385, 2097151, 2097152, 0]
+    self.assert_same_bytes(self.events([(tick, i%2 == 0, 60, 64 if i%2 == 0 else 0) for i,tick in enumerate(ticks)]))
+
+  def test_generated_songs(self):
+    rng = np.random.RandomState(0)
+    for tones_per_cell in range(1, 4):
+      self.loader = make_loader(tones_per_cell)
+      songs = rng.uniform(0, 300, size=[4, 50, self.loader.get_num_song_features()])
+      songs[:,:,TICKS_FROM_PREV_START] = rng.choice([0, 0, 50, 200, 20000], size=[4, 50])
+      songs[:,:,FREQ::NUM_FEATURES_PER_TONE] = 440*2**(rng.randint(-40, 40, size=[4, 50, tones_per_cell])/12.0)
+      for events in self.loader.get_midi_event_arrays(songs):
+        self.assertTrue(len(events))
+        self.assert_same_bytes(events)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,213 @@
+# Tests for rnn_gan.py and the generator exported by it.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+
+Builds tiny models with rnn_gan.py. Skipped when tensorflow (or midi, needed
+by music_data_utils) is not installed.
+
+$ python -m pytest -q test_rnn_gan.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib, os, shutil, tempfile, unittest
+
+import numpy as np
+
+try:
+  import tensorflow as tf
+  import rnn_gan
+  from exported_generator import ExportedGenerator
+except ImportError:
+  tf = None
+
+@contextlib.contextmanager
+def flag_overrides(**overrides):
+  """Sets rnn_gan.FLAGS from overrides, and restores them afterwards."""
+  flags = rnn_gan.FLAGS
+  if hasattr(flags, 'mark_as_parsed'):
+    flags.mark_as_parsed()
+  elif hasattr(flags, '_parse_flags'):
+    flags._parse_flags([])
+  saved = dict((name, getattr(flags, name)) for name in overrides)
+  for name,value in overrides.items():
+    setattr(flags, name, value)
+  try:
+    yield flags
+  finally:
+    for name,value in saved.items():
+      setattr(flags, name, value)
+
+# Small enough to build and run in seconds.
+TINY_MODEL_FLAGS = {'hidden_size_g': 8, 'hidden_size_d': 8, 'num_layers_g': 1, 'num_layers_d': 1,
+                    'meta_layer_size': 8, 'batch_size': 4, 'songlength': 6}
+
+NUM_SONG_FEATURES = 4
+NUM_META_FEATURES = 5
+
+class RandomBatchLoader(object):
+  """Stands in for MusicDataLoader in run_epoch: a few random batches per part."""
+  def __init__(self, num_batches=3):
+    self.num_batches = num_batches
+    self.rng = np.random.RandomState(0)
+
+  def iterate_batches(self, batchsize, songlength, part='train', prefetch=0, window_length=None):
+    for _ in range(self.num_batches):
+      batch_meta = np.zeros([batchsize, NUM_META_FEATURES])
+      batch_meta[:,0] = 1
+      yield (batch_meta, self.rng.uniform(0, 100, size=[batchsize, songlength, NUM_SONG_FEATURES]))
+
+def build_tiny_rnngan(**overrides):
+  """Builds a tiny training RNNGAN, as main() does, in the default graph."""
+  flags = dict(TINY_MODEL_FLAGS)
+  flags.update(overrides)
+  with flag_overrides(**flags):
+    with tf.variable_scope("model", custom_getter=rnn_gan.variable_getter()) as scope:
+      scope.set_regularizer(tf.contrib.layers.l2_regularizer(scale=rnn_gan.FLAGS.reg_scale))
+      return rnn_gan.RNNGAN(is_training=True, num_song_features=NUM_SONG_FEATURES, num_meta_features=NUM_META_FEATURES, songlength=TINY_MODEL_FLAGS['songlength'])
+
+@unittest.skipIf(tf is None, 'needs tensorflow and midi')
+class RunEpochTest(unittest.TestCase):
+  def test_run_epoch_adds_no_ops(self):
+    loader = RandomBatchLoader()
+    with tf.Graph().as_default() as graph, tf.Session() as session:
+      # Without the L2 loss, the losses of the untrained model are below 2, so
+      # run_epoch freezes D (or G) while training.
+      m = build_tiny_rnngan(disable_l2_regularizer=True)
+      session.run(tf.global_variables_initializer())
+      num_ops = len(graph.get_operations())
+      with flag_overrides(prefetch_batches=0):
+        for epoch in range(2):
+          for name,kwargs in [('pretraining', dict(datasetlabel='train', eval_op_g=m.opt_pretraining, eval_op_d=m.no_op, pretraining=True)),
+                              ('pretraining D', dict(datasetlabel='train', eval_op_g=m.opt_pretraining, eval_op_d=m.opt_d, pretraining=True, pretraining_d=True)),
+                              ('train', dict(datasetlabel='train', eval_op_g=m.opt_d, eval_op_d=m.opt_g)),
+                              ('frozen G', dict(datasetlabel='train', eval_op_g=m.no_op, eval_op_d=m.opt_d)),
+                              ('frozen D', dict(datasetlabel='train', eval_op_g=m.opt_g, eval_op_d=m.no_op)),
+                              ('validation', dict(datasetlabel='validation', eval_op_g=m.no_op, eval_op_d=m.no_op))]:
+            rnn_gan.run_epoch(session, m, loader, songlength=TINY_MODEL_FLAGS['songlength'], **kwargs)
+            self.assertEqual(len(graph.get_operations()), num_ops, 'run_epoch ({}, epoch {}) added ops to the graph.'.format(name, epoch))
+
+@unittest.skipIf(tf is None, 'needs tensorflow and midi')
+class DebugPrintsTest(unittest.TestCase):
+  def print_ops(self, **overrides):
+    with tf.Graph().as_default() as graph:
+      build_tiny_rnngan(**overrides)
+      return [op.name for op in graph.get_operations() if op.type in ['Print', 'PrintV2']]
+
+  def test_no_print_ops_by_default(self):
+    self.assertEqual(self.print_ops(), [])
+
+  def test_print_ops_with_debug_prints(self):
+    self.assertTrue(self.print_ops(debug_prints=True))
+
+@unittest.skipIf(tf is None, 'needs tensorflow and midi')
+class BenchmarkTest(unittest.TestCase):
+  def test_flags_restored_after_error(self):
+    def failing_train_step(num_song_features, num_meta_features, num_steps=10):
+      raise RuntimeError('out of memory')
+    train_step = rnn_gan.benchmark_train_step
+    rnn_gan.benchmark_train_step = failing_train_step
+    try:
+      with flag_overrides(**TINY_MODEL_FLAGS) as flags:
+        saved = (flags.rnn_cell, flags.float16, flags.hidden_size_g, flags.hidden_size_d)
+        for benchmark in [rnn_gan.benchmark_rnn_cells, rnn_gan.benchmark_float16]:
+          self.assertRaises(RuntimeError, benchmark, NUM_SONG_FEATURES, NUM_META_FEATURES)
+          self.assertEqual((flags.rnn_cell, flags.float16, flags.hidden_size_g, flags.hidden_size_d), saved)
+    finally:
+      rnn_gan.benchmark_train_step = train_step
+
+@unittest.skipIf(tf is None, 'needs tensorflow and midi')
+class Float16Test(unittest.TestCase):
+  def train_step(self, **overrides):
+    """
+    Builds a tiny RNNGAN with --float16 and runs opt_d and opt_g once.
+    Returns (losses, loss scales, variables before, variables after).
+    """
+    with tf.Graph().as_default(), tf.Session() as session:
+      m = build_tiny_rnngan(float16=True, **overrides)
+      for v in tf.trainable_variables():
+        self.assertEqual(v.dtype.base_dtype, tf.float32, v.name)
+      session.run(tf.global_variables_initializer())
+      batch_meta, batch_song = next(RandomBatchLoader().iterate_batches(m.batch_size, m.songlength))
+      feed_dict = {m.input_songdata: batch_song, m.input_metadata: batch_meta}
+      variables_before = session.run(tf.trainable_variables())
+      session.run([m.opt_d, m.opt_g], feed_dict)
+      losses = session.run([m.g_loss, m.d_loss, m.rnn_pretraining_loss], feed_dict)
+      loss_scales = dict((name, session.run(loss_scale.scale)) for name,loss_scale in m.loss_scales.items())
+      return losses, loss_scales, variables_before, session.run(tf.trainable_variables())
+
+  def test_train_step(self):
+    losses, loss_scales, variables_before, variables_after = self.train_step()
+    self.assertTrue(np.all(np.isfinite(losses)), losses)
+    self.assertEqual(loss_scales, {'pretraining': 128.0, 'd': 128.0, 'g': 128.0})
+    self.assertTrue(any(np.any(before != after) for before,after in zip(variables_before, variables_after)))
+    for variable in variables_after:
+      self.assertEqual(variable.dtype, np.float32)
+      self.assertTrue(np.all(np.isfinite(variable)))
+
+  def test_overflow_skips_step(self):
+    # Scaled by 1e30, the gradients overflow in float16.
+    losses, loss_scales, variables_before, variables_after = self.train_step(loss_scale=1e30)
+    self.assertTrue(np.all(np.isfinite(losses)), losses)
+    self.assertEqual(loss_scales, {'pretraining': np.float32(1e30), 'd': np.float32(5e29), 'g': np.float32(5e29)})
+    for before,after in zip(variables_before, variables_after):
+      np.testing.assert_array_equal(before, after)
+
+  def test_scale_grows_after_finite_steps(self):
+    _, loss_scales, _, _ = self.train_step(loss_scale=2.0, loss_scale_window=1)
+    self.assertEqual(loss_scales, {'pretraining': 2.0, 'd': 4.0, 'g': 4.0})
+
+@unittest.skipIf(tf is None, 'needs tensorflow and midi')
+class ExportedGeneratorTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def export(self, **overrides):
+    export_dir = os.path.join(self.tmpdir, 'export')
+    flags = dict(TINY_MODEL_FLAGS)
+    flags.update(overrides)
+    with flag_overrides(**flags), tf.Graph().as_default(), tf.Session() as session:
+      generator = rnn_gan.Generator(num_song_features=NUM_SONG_FEATURES, num_meta_features=NUM_META_FEATURES)
+      session.run(tf.global_variables_initializer())
+      generator.export(session, export_dir, {'songlength': 6, 'tones_per_cell': 1,
+                                             'genres': ['classical', 'jazz'], 'composers': ['a', 'b', 'c']})
+    return export_dir
+
+  def assert_seed_reproducible(self, export_dir):
+    generator = ExportedGenerator(export_dir)
+    try:
+      songs = generator.generate(6, 7, seed=1)
+      np.testing.assert_array_equal(songs, generator.generate(6, 7, seed=1))
+      self.assertFalse(np.array_equal(songs, generator.generate(6, 7, seed=2)))
+      chunks = list(generator.generate_stream(3, 4, num_chunks=2, seed=1))
+      np.testing.assert_array_equal(np.concatenate(chunks, axis=1), np.concatenate(list(generator.generate_stream(3, 4, num_chunks=2, seed=1)), axis=1))
+    finally:
+      generator.close()
+
+  def test_seed_is_reproducible(self):
+    self.assert_seed_reproducible(self.export())
+
+  def test_seed_is_reproducible_with_generated_meta(self):
+    # The meta features are generated from noise drawn from the seed too.
+    self.assert_seed_reproducible(self.export(generate_meta=True))
+
+if __name__ == "__main__":
+  unittest.main()